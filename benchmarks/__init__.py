@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Les modules du projet s'importent par leur nom, comme dans les conteneurs (PYTHONPATH=/app/plugins, ml/ courant) :
+# les répertoires ml/ et plugins/ du dépôt sont ajoutés au chemin de recherche
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("plugins", "ml"):
+    path = os.path.join(REPO_DIR, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
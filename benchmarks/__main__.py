@@ -0,0 +1,51 @@
+import argparse
+import logging
+import os
+import sys
+
+from benchmarks import REPO_DIR
+from benchmarks.baseline import MEMORY_THRESHOLD, TIME_THRESHOLD, compare_results, load_results, save_results
+from benchmarks.hot_paths import BENCHMARK_SIZES, CASES, MIN_SECONDS, REPEAT, run_suite
+
+# Base dédiée aux mesures (les tables des transactions y sont recréées) ; vide = SQLite en mémoire
+BENCHMARK_DB_URI = os.environ.get("BENCHMARK_DB_URI", "")
+BASELINE_PATH = os.path.join(REPO_DIR, "benchmarks", "baseline.json")
+RESULTS_PATH = os.path.join(REPO_DIR, "benchmarks", "results.json")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmarks des chemins critiques du pipeline de détection de fraude")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCHMARK_SIZES, help="Nombres de transactions synthétiques")
+    parser.add_argument("--paths", nargs="+", choices=[case.name for case in CASES], help="Chemins à mesurer (tous par défaut)")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="Nombre minimal de mesures par chemin")
+    parser.add_argument("--min-seconds", type=float, default=MIN_SECONDS, help="Durée cumulée minimale des mesures d'un chemin")
+    parser.add_argument("--db-uri", default=BENCHMARK_DB_URI, help="Base PostgreSQL dédiée (défaut : SQLite en mémoire)")
+    parser.add_argument("--output", default=RESULTS_PATH, help="Fichier JSON des résultats")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Fichier JSON de référence")
+    parser.add_argument("--save-baseline", action="store_true", help="Enregistre les résultats comme nouvelle référence")
+    parser.add_argument("--compare", action="store_true", help="Compare à la référence, code retour 1 en cas de régression")
+    parser.add_argument("--results", help="Avec --compare : fichier de résultats existant à comparer, sans nouvelle mesure")
+    parser.add_argument("--threshold", type=float, default=TIME_THRESHOLD, help="Hausse relative tolérée du temps médian")
+    parser.add_argument("--memory-threshold", type=float, default=MEMORY_THRESHOLD, help="Hausse relative tolérée du pic de mémoire")
+    args = parser.parse_args()
+
+    if args.db_uri and args.db_uri == os.environ.get("PROD_DB_URI"):
+        parser.error("--db-uri désigne la base de production : les benchmarks recréent les tables, utilisez une base dédiée.")
+    if args.compare and not os.path.exists(args.baseline):
+        logging.error(f"❌ Référence introuvable : {args.baseline} (à créer avec --save-baseline).")
+        sys.exit(2)
+
+    if args.results:
+        current = load_results(args.results)
+    else:
+        current = run_suite(args.sizes, args.paths, args.db_uri or None, args.repeat, args.min_seconds)
+        save_results(current, args.output)
+        if args.save_baseline:
+            save_results(current, args.baseline)
+
+    if args.compare:
+        regressions = compare_results(load_results(args.baseline), current, args.threshold, args.memory_threshold)
+        if regressions:
+            logging.error(f"❌ {len(regressions)} régression(s) au-delà des seuils par rapport à {args.baseline}.")
+            sys.exit(1)
+        logging.info("✅ Aucune régression par rapport à la référence.")
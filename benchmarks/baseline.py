@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+
+# Régression : temps médian ou pic de mémoire au-delà de la référence de plus de ce ratio...
+TIME_THRESHOLD = float(os.environ.get("BENCHMARK_TIME_THRESHOLD", 0.25))
+MEMORY_THRESHOLD = float(os.environ.get("BENCHMARK_MEMORY_THRESHOLD", 0.25))
+# ... et d'au moins ces écarts absolus (les chemins de quelques millisecondes sont bruités)
+MIN_DELTA_MS = float(os.environ.get("BENCHMARK_MIN_DELTA_MS", 2.0))
+MIN_DELTA_MB = float(os.environ.get("BENCHMARK_MIN_DELTA_MB", 1.0))
+
+# Champs de l'environnement qui doivent coïncider pour que la comparaison ait un sens
+COMPARABLE_FIELDS = ["cpus", "backend", "seed", "python", "numpy", "pandas", "xgboost"]
+
+
+def save_results(document, path):
+    """Écrit les résultats dans un fichier JSON (répertoire créé si besoin)."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(document, f, indent=1)
+    logging.info(f"✅ Résultats écrits dans {path} ({len(document['results'])} mesures).")
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, time_threshold=TIME_THRESHOLD, memory_threshold=MEMORY_THRESHOLD,
+                    min_delta_ms=MIN_DELTA_MS, min_delta_mb=MIN_DELTA_MB):
+    """
+    Compare chaque (chemin, taille) mesuré à la référence. Une mesure régresse si son temps
+    médian (ou son pic de mémoire) dépasse celui de la référence à la fois du ratio et de
+    l'écart absolu configurés. Retourne la liste des régressions (vide si aucune).
+    """
+    for field in COMPARABLE_FIELDS:
+        expected, actual = baseline["environment"].get(field), current["environment"].get(field)
+        if expected != actual:
+            logging.warning(f"⚠️ Environnement différent de la référence ({field} : {expected} -> {actual}), comparaison indicative.")
+
+    reference = {(result["path"], result["rows"]): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        key = (result["path"], result["rows"])
+        base = reference.pop(key, None)
+        if base is None:
+            logging.info(f"📊 {result['path']:<20} {result['rows']:>8} lignes : absent de la référence.")
+            continue
+        time_ratio = result["median_ms"] / base["median_ms"]
+        memory_ratio = result["peak_mb"] / base["peak_mb"] if base["peak_mb"] else 1.0
+        slower = time_ratio > 1 + time_threshold and result["median_ms"] - base["median_ms"] >= min_delta_ms
+        heavier = memory_ratio > 1 + memory_threshold and result["peak_mb"] - base["peak_mb"] >= min_delta_mb
+        status = "❌" if slower or heavier else "✅"
+        logging.info(
+            f"{status} {result['path']:<20} {result['rows']:>8} lignes : {base['median_ms']:10.2f} -> {result['median_ms']:10.2f} ms "
+            f"(x{time_ratio:.2f}) | {base['peak_mb']:8.1f} -> {result['peak_mb']:8.1f} Mo (x{memory_ratio:.2f})"
+        )
+        if slower:
+            regressions.append({"path": result["path"], "rows": result["rows"], "metric": "median_ms",
+                                "baseline": base["median_ms"], "current": result["median_ms"], "ratio": time_ratio})
+        if heavier:
+            regressions.append({"path": result["path"], "rows": result["rows"], "metric": "peak_mb",
+                                "baseline": base["peak_mb"], "current": result["peak_mb"], "ratio": memory_ratio})
+    for path, rows in reference:
+        logging.warning(f"⚠️ {path} ({rows} lignes) présent dans la référence mais non mesuré.")
+    return regressions
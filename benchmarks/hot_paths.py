@@ -0,0 +1,357 @@
+import gc
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sqlalchemy import create_engine, text
+
+import fraud_report
+import fraud_rollup
+import fraud_schema
+from categorical_encoder import CategoricalEncoder
+from inference_engine import InferenceEngine, build_feature_matrix
+from training_data import MODEL_COLUMNS
+
+from benchmarks import REPO_DIR
+from benchmarks.synthetic import (
+    DEFAULT_SEED, REPORT_DATE, api_frame, api_payload, generate_transactions, training_frame, with_detection_timestamp,
+)
+
+# Mesure : au moins REPEAT exécutions chronométrées, prolongées jusqu'à MIN_SECONDS cumulées (MAX_RUNS au plus)
+REPEAT = int(os.environ.get("BENCHMARK_REPEAT", 3))
+MIN_SECONDS = float(os.environ.get("BENCHMARK_MIN_SECONDS", 1.0))
+MAX_RUNS = 100
+BENCHMARK_SIZES = [1000, 100000, 1000000]
+
+# Modèle de référence, entraîné sur des données synthétiques à graine fixe (identique d'une exécution à l'autre)
+MODEL_ROWS = 50000
+MODEL_PARAMS = {"n_estimators": 100, "max_depth": 6, "learning_rate": 0.1, "tree_method": "hist", "random_state": 0}
+
+# Chargeur de données (nom de fichier non importable directement)
+LOADER_PATH = os.path.join(REPO_DIR, "data", "insert_data-db.py")
+
+# Chemin chronométré : 'prepare(context, size)' retourne (fonction mesurée, remise à zéro avant chaque appel ou None).
+# 'backends' restreint le chemin à certaines bases (None = aucune base nécessaire).
+BenchmarkCase = namedtuple("BenchmarkCase", ["name", "backends", "prepare"])
+
+
+def load_loader_module():
+    """Module data/insert_data-db.py, chargé depuis son chemin."""
+    spec = importlib.util.spec_from_file_location("insert_data_db", LOADER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(function, reset=None, repeat=REPEAT, min_seconds=MIN_SECONDS, max_runs=MAX_RUNS):
+    """
+    Durées (médiane, minimum) et pic de mémoire d'un chemin.
+    Le premier appel, non chronométré, sert d'échauffement et mesure le pic de mémoire
+    allouée pendant l'appel (tracemalloc : objets Python et tableaux NumPy / pandas).
+    """
+    if reset is not None:
+        reset()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    durations = []
+    while len(durations) < repeat or (sum(durations) < min_seconds and len(durations) < max_runs):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {
+        "median_ms": float(np.median(durations)) * 1000,
+        "min_ms": min(durations) * 1000,
+        "runs": len(durations),
+        "peak_mb": peak / 2**20,
+    }
+
+
+class BenchmarkContext:
+    """
+    Données et ressources partagées par les chemins mesurés : transactions synthétiques
+    de la taille en cours (sous leurs différentes formes), modèle de référence et base.
+    Sans URI PostgreSQL, une base SQLite en mémoire remplace la base métier.
+    """
+
+    def __init__(self, db_uri=None, seed=DEFAULT_SEED):
+        self.seed = seed
+        self.db_engine = create_engine(db_uri or "sqlite://")
+        self.backend = self.db_engine.dialect.name
+        self.loader = load_loader_module()
+        self._frames = {}
+        self._size = None
+        self._model = None
+        self._connection = None
+        self._loaded_rows = None  # Transactions présentes en base, index et rollup compris
+        self.work_dir = tempfile.mkdtemp(prefix="fraud_benchmark_")  # Fichiers de détail du rapport
+
+    def use_size(self, size):
+        """Passe à une nouvelle taille : les données de la taille précédente sont libérées."""
+        if size != self._size:
+            self._frames.clear()
+            gc.collect()
+            self._size = size
+
+    def frame(self, kind):
+        """Transactions de la taille en cours : 'raw' (fraudTest.csv), 'api', 'training', 'payload' ou 'loaded'."""
+        if kind not in self._frames:
+            if kind == "raw":
+                self._frames[kind] = generate_transactions(self._size, self.seed)
+            elif kind == "api":
+                self._frames[kind] = api_frame(self.frame("raw"))
+            elif kind == "training":
+                self._frames[kind] = training_frame(self.frame("raw"), MODEL_COLUMNS)
+            elif kind == "payload":
+                self._frames[kind] = api_payload(self.frame("api"))
+            elif kind == "loaded":
+                self._frames[kind] = with_detection_timestamp(self.frame("raw"))
+            else:
+                raise ValueError(f"Forme de données inconnue : {kind}")
+        return self._frames[kind]
+
+    def chunks(self):
+        """Transactions datées du jour du rapport, découpées comme les lots du chargeur."""
+        loaded = self.frame("loaded")
+        return [loaded.iloc[start:start + self.loader.CHUNK_SIZE] for start in range(0, len(loaded), self.loader.CHUNK_SIZE)]
+
+    @property
+    def model(self):
+        """(encodeur, XGBClassifier, moteur natif) du modèle de référence, entraîné au premier accès."""
+        if self._model is None:
+            from train_model_prod import preprocess_data
+
+            start = time.perf_counter()
+            raw = generate_transactions(MODEL_ROWS, self.seed + 1)
+            encoder = CategoricalEncoder.fit(raw, ['category', 'merchant'])
+            train = preprocess_data(training_frame(raw, MODEL_COLUMNS), encoder)
+            classifier = xgb.XGBClassifier(**MODEL_PARAMS)
+            classifier.fit(train.drop(columns='is_fraud'), train['is_fraud'])
+            self._model = (encoder, classifier, InferenceEngine(classifier.get_booster()))
+            logging.info(f"✅ Modèle de référence entraîné sur {MODEL_ROWS} transactions en {time.perf_counter() - start:.1f} s.")
+        return self._model
+
+    @property
+    def connection(self):
+        """Connexion psycopg2 dédiée aux requêtes du rapport."""
+        if self._connection is None:
+            self._connection = self.db_engine.raw_connection()
+        return self._connection
+
+    def report_call(self, function, *args):
+        """Appel d'une fonction du rapport sur la connexion dédiée, transaction close ensuite (aucun verrou conservé)."""
+        def call():
+            try:
+                return function(self.connection, *args)
+            finally:
+                self.connection.rollback()
+        return call
+
+    def reset_tables(self):
+        """Tables des transactions recréées vides, comme avant un chargement initial."""
+        self._loaded_rows = None
+        if self.backend == "postgresql":
+            self.loader.reset_tables(self.db_engine, datetime.combine(REPORT_DATE, datetime.min.time()))
+        else:
+            with self.db_engine.begin() as connection:
+                for table in fraud_schema.TABLES:
+                    connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+
+    def load_report_day(self):
+        """
+        Transactions de la taille en cours chargées en base (COPY), puis index et rollup
+        de la journée construits comme après un chargement initial : point de départ du rapport.
+        """
+        if self._loaded_rows == self._size:
+            return
+        self.reset_tables()
+        for chunk in self.chunks():
+            self.loader.encode_and_copy_chunk(self.db_engine, chunk)
+        self.loader.run_schema(self.db_engine, fraud_schema.create_indexes)
+        self.loader.run_schema(self.db_engine, fraud_rollup.reconcile_rollup_day, REPORT_DATE)
+        with self.db_engine.begin() as connection:
+            for table in fraud_schema.TABLES + (fraud_rollup.ROLLUP_TABLE,):
+                connection.execute(text(f"ANALYZE {table}"))
+        self._loaded_rows = self._size
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+        self.db_engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def grouping_set_rows(frauds, report_date=REPORT_DATE):
+    """
+    Lignes d'une requête GROUPING SETS ((category), (hour), (merchant), ()) calculées
+    avec pandas : entrée du rendu du rapport, sans dépendre de la base.
+    """
+    hour = frauds["detection_timestamp"].dt.hour
+    rows = []
+    for column, keys in (("category", frauds["category"]), ("hour", hour), ("merchant", frauds["merchant"])):
+        grouped = frauds["amt"].groupby(keys.to_numpy()).agg(["count", "sum"])
+        for key, count, amount in zip(grouped.index, grouped["count"], grouped["sum"]):
+            values = {"category": None, "hour": None, "merchant": None, column: key}
+            rows.append((column != "category", column != "hour", column != "merchant",
+                         values["category"], values["hour"], values["merchant"], count, amount))
+    rows.append((True, True, True, None, None, None, len(frauds), frauds["amt"].sum()))
+    return rows
+
+
+def prepare_decode_payload(context, size):
+    from realtime_prediction_service import parse_transactions
+
+    # Corps HTTP décodé comme dans get_latest_transactions (response.json()), puis par parse_transactions
+    body = context.frame("payload")
+    return lambda: parse_transactions(json.loads(body)), None
+
+
+def prepare_preprocess_service(context, size):
+    from realtime_prediction_service import preprocess_data
+
+    encoder, _, _ = context.model
+    df = context.frame("api")
+    return lambda: preprocess_data(df.copy(), encoder), None
+
+
+def prepare_preprocess_training(context, size):
+    from train_model_prod import preprocess_data
+
+    encoder, _, _ = context.model
+    df = context.frame("training")
+    return lambda: preprocess_data(df.copy(), encoder), None
+
+
+def prepare_feature_matrix(context, size):
+    encoder, _, engine = context.model
+    df = context.frame("api")
+    return lambda: build_feature_matrix(df, encoder, engine.feature_names), None
+
+
+def prepare_predict_native(context, size):
+    encoder, _, engine = context.model
+    X = build_feature_matrix(context.frame("api"), encoder, engine.feature_names)
+    return lambda: engine.predict(X), None
+
+
+def prepare_predict_sklearn(context, size):
+    from realtime_prediction_service import preprocess_data
+
+    encoder, classifier, _ = context.model
+    X = preprocess_data(context.frame("api").copy(), encoder)
+    return lambda: classifier.predict(X), None
+
+
+def prepare_loader_copy(context, size):
+    chunks = context.chunks()
+
+    def load():
+        for chunk in chunks:
+            context.loader.encode_and_copy_chunk(context.db_engine, chunk)
+    return load, context.reset_tables
+
+
+def prepare_loader_to_sql(context, size):
+    chunks = context.chunks()
+
+    def load():
+        for chunk in chunks:
+            context.loader.write_chunk_to_sql(context.db_engine, chunk)
+    return load, context.reset_tables
+
+
+def prepare_report_query(context, size):
+    context.load_report_day()
+    return context.report_call(fraud_report.fetch_report_aggregates, REPORT_DATE), None
+
+
+def prepare_report_rollup(context, size):
+    context.load_report_day()
+    return context.report_call(fraud_report.fetch_rollup_aggregates, REPORT_DATE), None
+
+
+def prepare_report_export(context, size):
+    context.load_report_day()
+    path = os.path.join(context.work_dir, "fraud_details.csv")
+    return context.report_call(fraud_report.export_report_details, REPORT_DATE, path), None
+
+
+def prepare_report_render(context, size):
+    loaded = context.frame("loaded")
+    rows = grouping_set_rows(loaded[loaded["is_fraud"] == 1])
+    return lambda: fraud_report.render_report(fraud_report.summarize_grouping_sets(REPORT_DATE, rows)), None
+
+
+CASES = [
+    BenchmarkCase("decode_payload", None, prepare_decode_payload),
+    BenchmarkCase("preprocess_service", None, prepare_preprocess_service),
+    BenchmarkCase("preprocess_training", None, prepare_preprocess_training),
+    BenchmarkCase("feature_matrix", None, prepare_feature_matrix),
+    BenchmarkCase("predict_native", None, prepare_predict_native),
+    BenchmarkCase("predict_sklearn", None, prepare_predict_sklearn),
+    BenchmarkCase("loader_copy", ("postgresql",), prepare_loader_copy),
+    BenchmarkCase("loader_to_sql", ("sqlite",), prepare_loader_to_sql),
+    BenchmarkCase("report_query", ("postgresql",), prepare_report_query),
+    BenchmarkCase("report_rollup", ("postgresql",), prepare_report_rollup),
+    BenchmarkCase("report_export", ("postgresql",), prepare_report_export),
+    BenchmarkCase("report_render", None, prepare_report_render),
+]
+
+
+def environment(context):
+    """Machine et versions : deux résultats ne sont comparables que dans le même environnement."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "xgboost": xgb.__version__,
+        "backend": context.backend,
+        "seed": context.seed,
+    }
+
+
+def run_suite(sizes=BENCHMARK_SIZES, paths=None, db_uri=None, repeat=REPEAT, min_seconds=MIN_SECONDS, seed=DEFAULT_SEED):
+    """Mesure chaque chemin pour chaque taille. Retourne le document de résultats (sérialisable en JSON)."""
+    cases = [case for case in CASES if not paths or case.name in paths]
+    context = BenchmarkContext(db_uri, seed)
+    for case in cases:
+        if case.backends and context.backend not in case.backends:
+            logging.warning(f"⚠️ Chemin '{case.name}' ignoré : base {' ou '.join(case.backends)} nécessaire (base actuelle : {context.backend}).")
+    cases = [case for case in cases if not case.backends or context.backend in case.backends]
+
+    results = []
+    try:
+        for size in sizes:
+            context.use_size(size)
+            for case in cases:
+                function, reset = case.prepare(context, size)
+                stats = measure(function, reset, repeat, min_seconds)
+                result = {"path": case.name, "rows": size, **stats, "rows_per_s": size / (stats["median_ms"] / 1000)}
+                results.append(result)
+                logging.info(
+                    f"📊 {case.name:<20} {size:>8} lignes : {stats['median_ms']:10.2f} ms (min {stats['min_ms']:.2f}, "
+                    f"{stats['runs']} mesures) | {result['rows_per_s']:>12,.0f} lignes/s | pic {stats['peak_mb']:8.1f} Mo"
+                )
+    finally:
+        context.close()
+    return {"created_at": datetime.now().isoformat(timespec="seconds"), "environment": environment(context), "results": results}
@@ -0,0 +1,116 @@
+import json
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from training_data import CACHE_SCHEMA, compact_chunk
+
+# Colonnes de fraudTest.csv, dans l'ordre du fichier
+CSV_COLUMNS = [
+    "Unnamed: 0", "trans_date_trans_time", "cc_num", "merchant", "category", "amt", "first", "last",
+    "gender", "street", "city", "state", "zip", "lat", "long", "city_pop", "job", "dob", "trans_num",
+    "unix_time", "merch_lat", "merch_long", "is_fraud",
+]
+CATEGORIES = [
+    "entertainment", "food_dining", "gas_transport", "grocery_net", "grocery_pos", "health_fitness", "home",
+    "kids_pets", "misc_net", "misc_pos", "personal_care", "shopping_net", "shopping_pos", "travel",
+]
+RISKY_CATEGORIES = ["grocery_pos", "misc_net", "shopping_net"]  # Catégories où la fraude est plus fréquente
+STATES = ["CA", "FL", "IL", "MI", "NY", "OH", "PA", "SC", "TX", "WA"]
+FIRST_NAMES = ["Ana", "Brian", "Chloe", "David", "Emma", "Frank", "Grace", "Henry", "Iris", "Jeff", "Karen", "Louis"]
+LAST_NAMES = ["Baker", "Clark", "Elliott", "Garcia", "Hall", "Johnson", "Lopez", "Miller", "Nguyen", "Smith"]
+JOBS = ["Accountant", "Chemist", "Designer", "Engineer", "Lawyer", "Nurse", "Pilot", "Teacher", "Writer"]
+
+N_CARDS = 2000       # Cartes distinctes (ordre de grandeur de fraudTest.csv)
+N_MERCHANTS = 700    # Marchands distincts
+FIRST_UNIX_TIME = 1371816000  # 21/06/2013, début de fraudTest.csv
+SPAN_SECONDS = 180 * 86400    # Période couverte par les transactions
+# Journée de détection attribuée aux transactions chargées en base (rapport quotidien)
+REPORT_DATE = date(2013, 6, 22)
+DEFAULT_SEED = 42
+
+
+def generate_transactions(n, seed=DEFAULT_SEED):
+    """
+    Transactions synthétiques au format de fraudTest.csv (mêmes colonnes, mêmes types),
+    reproductibles pour une graine donnée. Les attributs du porteur sont tirés par carte ;
+    la fraude (~0,4 %) dépend du montant, de l'heure et de la catégorie, pour que le
+    modèle entraîné dessus ait un vrai travail de décision.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Porteurs : un profil par carte, partagé par toutes ses transactions
+    cards = pd.DataFrame({
+        "cc_num": 1_000_000_000_000_000 + rng.choice(10**12, N_CARDS, replace=False),
+        "first": rng.choice(FIRST_NAMES, N_CARDS),
+        "last": rng.choice(LAST_NAMES, N_CARDS),
+        "gender": rng.choice(["F", "M"], N_CARDS),
+        "street": [f"{number} Main Street" for number in rng.integers(1, 9999, N_CARDS)],
+        "city": [f"City{index}" for index in rng.integers(0, 500, N_CARDS)],
+        "state": rng.choice(STATES, N_CARDS),
+        "zip": rng.integers(10000, 99999, N_CARDS),
+        "lat": rng.uniform(25.0, 48.0, N_CARDS).round(4),
+        "long": rng.uniform(-122.0, -70.0, N_CARDS).round(4),
+        "city_pop": rng.integers(100, 2_000_000, N_CARDS),
+        "job": rng.choice(JOBS, N_CARDS),
+        "dob": pd.to_datetime(rng.integers(-20 * 365, 30 * 365, N_CARDS), unit="D").strftime("%Y-%m-%d"),
+    })
+    card = rng.integers(0, N_CARDS, n)
+    df = cards.iloc[card].reset_index(drop=True)
+
+    unix_time = np.sort(FIRST_UNIX_TIME + rng.integers(0, SPAN_SECONDS, n))
+    category = rng.choice(CATEGORIES, n)
+    amt = rng.gamma(2.0, 40.0, n).round(2) + 1.0
+    hour = (unix_time % 86400) // 3600
+    logit = -6.5 + 1.5 * (amt > 250) + 1.2 * ((hour >= 22) | (hour < 4)) + 0.8 * np.isin(category, RISKY_CATEGORIES)
+
+    df["Unnamed: 0"] = np.arange(n)
+    df["trans_date_trans_time"] = pd.Series(unix_time.astype("datetime64[s]")).astype(str)
+    df["merchant"] = np.array([f"fraud_Merchant{index}" for index in range(N_MERCHANTS)], dtype=object)[rng.integers(0, N_MERCHANTS, n)]
+    df["category"] = category.astype(object)
+    df["amt"] = amt
+    df["trans_num"] = [value.hex() for value in np.frombuffer(rng.bytes(16 * n), dtype="S16")] if n else []
+    df["unix_time"] = unix_time
+    df["merch_lat"] = (df["lat"] + rng.uniform(-1.0, 1.0, n)).round(6)
+    df["merch_long"] = (df["long"] + rng.uniform(-1.0, 1.0, n)).round(6)
+    df["is_fraud"] = (rng.random(n) < 1.0 / (1.0 + np.exp(-logit))).astype(np.int64)
+    return df[CSV_COLUMNS]
+
+
+def api_frame(raw):
+    """Transactions telles que les rend l'API temps réel : 'current_time' à la place des colonnes d'origine."""
+    df = raw.drop(columns=["Unnamed: 0", "trans_date_trans_time"])
+    df.insert(0, "current_time", raw["trans_date_trans_time"])
+    return df
+
+
+def api_payload(api_df):
+    """Corps HTTP de la réponse de l'API : chaîne JSON {columns, index, data} elle-même encodée en JSON."""
+    return json.dumps(api_df.to_json(orient="split"))
+
+
+def training_frame(raw, columns=None):
+    """
+    Transactions telles que les rend load_training_data : converties au format du cache
+    colonnaire (compact_chunk), colonnes catégorielles en pd.Categorical.
+    """
+    vocabularies = {}
+    arrays = compact_chunk(raw, vocabularies)
+    data = {}
+    for column in columns or arrays:
+        if CACHE_SCHEMA[column] == "category":
+            data[column] = pd.Categorical.from_codes(arrays[column], categories=vocabularies[column])
+        elif CACHE_SCHEMA[column] == "bytes":
+            data[column] = arrays[column].astype(str)
+        else:
+            data[column] = arrays[column]
+    return pd.DataFrame(data, copy=False)
+
+
+def with_detection_timestamp(raw, report_date=REPORT_DATE):
+    """Ajoute la date de détection, répartie sur la journée du rapport selon l'heure de la transaction."""
+    df = raw.copy()
+    seconds = pd.to_timedelta(df["unix_time"] % 86400, unit="s")
+    df["detection_timestamp"] = pd.Timestamp(report_date) + seconds
+    return df
@@ -0,0 +1,46 @@
+from airflow import DAG
+from airflow.operators.bash import BashOperator
+from airflow.utils.dates import days_ago
+from airflow.models.param import Param
+
+# Connexion Airflow de la base métier (même base que le rapport quotidien)
+NEON_CONN_ID = "NEON_DB"
+
+# Script de rescoring, monté depuis ./ml dans les conteneurs Airflow
+BATCH_SCORING_SCRIPT = "/opt/airflow/ml/batch_scoring.py"
+
+default_args = {
+    'owner': 'airflow',
+    'start_date': days_ago(1),
+    'retries': 1,
+}
+
+# DAG déclenché manuellement après la promotion d'un modèle : rescore tout l'historique
+# de all_transactions avec la version choisie. Le script tourne dans un processus dédié
+# (pool de processus hors du worker Celery) et reprend les partitions non terminées
+# lors d'une nouvelle tentative.
+with DAG(
+    'batch_rescoring',
+    default_args=default_args,
+    description="Rescoring parallèle de l'historique des transactions par une version du modèle",
+    schedule_interval=None,
+    catchup=False,
+    params={
+        'model_version': Param('', type='string', description='Version du registre MLflow (vide = version en production)'),
+        'partitions': Param(32, type='integer', minimum=1),
+        'workers': Param(4, type='integer', minimum=1),
+    },
+) as dag:
+    rescore_task = BashOperator(
+        task_id='rescore_all_transactions',
+        bash_command=(
+            f"python {BATCH_SCORING_SCRIPT} "
+            "{% if params.model_version %}--model-version {{ params.model_version }} {% endif %}"
+            "--partitions {{ params.partitions }} --workers {{ params.workers }}"
+        ),
+        env={
+            # SQLAlchemy n'accepte que le schéma 'postgresql://'
+            'PROD_DB_URI': "{{ conn." + NEON_CONN_ID + ".get_uri() | replace('postgres://', 'postgresql://') }}",
+        },
+        append_env=True,
+    )
@@ -3,82 +3,102 @@ from airflow.operators.python import PythonOperator
 from airflow.utils.dates import days_ago
 from airflow.providers.postgres.hooks.postgres import PostgresHook
 from airflow.models import Variable
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from airflow.models.param import Param
 import logging
-import smtplib
-import pandas as pd
+import os
 from datetime import datetime, timedelta
 
+import notification
+from fraud_report import REPORTS_DIR, fetch_rollup_aggregates, export_report_details, render_report
+from fraud_rollup import reconcile_rollup_day
+
 # Configuration de la connexion à la base de données Neon
 NEON_CONN_ID = "NEON_DB"
 
-def send_email(subject: str, body: str):
+# Nombre maximal de journées recalculées en parallèle lors d'un backfill
+BACKFILL_PARALLELISM = 8
+
+def send_email(subject: str, body: str, attachment_path: str = None):
     """
-    Envoie un email via SMTP Gmail
+    Envoie un email (pièce jointe optionnelle) via le module commun plugins/notification.py,
+    avec les identifiants lus dans les Variables Airflow au moment de l'exécution.
+    Lève une exception si l'envoi échoue après toutes les tentatives : la tâche passe en échec
+    (et peut être relancée par Airflow) au lieu d'être marquée réussie sans rapport envoyé.
     """
-    # Récupérer les variables d'Airflow ici, au moment de l'exécution de la fonction
-    sender_email = Variable.get("SENDER_EMAIL")
-    app_password = Variable.get("APP_PASSWORD")
-    receiver_email = Variable.get("RECEIVER_EMAIL")
-
-    msg = MIMEMultipart()
-    msg["From"] = sender_email
-    msg["To"] = receiver_email
-    msg["Subject"] = subject
+    sent = notification.send_email(
+        subject, body, attachment_path,
+        sender=Variable.get("SENDER_EMAIL"),
+        receiver=Variable.get("RECEIVER_EMAIL"),
+        password=Variable.get("APP_PASSWORD"),
+    )
+    if not sent:
+        raise RuntimeError(f"Échec de l'envoi de l'e-mail « {subject} » après toutes les tentatives.")
 
-    msg.attach(MIMEText(body, "plain"))
+def reconcile_fraud_rollup(report_date=None):
+    """
+    Recalcule la table de rollup pour une journée (la veille par défaut) à partir
+    des tables brutes, afin de corriger une éventuelle dérive de la mise à jour incrémentale.
+    """
+    day = datetime.strptime(report_date, "%Y-%m-%d").date() if report_date else (datetime.now() - timedelta(days=1)).date()
 
+    hook = PostgresHook(postgres_conn_id=NEON_CONN_ID)
+    connection = hook.get_conn()
     try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(sender_email, app_password)
-        server.sendmail(sender_email, receiver_email, msg.as_string())
-        logging.info("Email envoyé avec succès.")
-    except Exception as e:
-        logging.error(f"Erreur lors de l'envoi : {e}")
+        with connection.cursor() as cursor:
+            keys = reconcile_rollup_day(cursor, day)
+        connection.commit()
     finally:
-        server.quit()
+        connection.close()
+    logging.info(f"✅ Rollup du {day} recalculé : {keys} clés (jour, heure, catégorie, marchand).")
+
+def list_backfill_days(params):
+    """
+    Liste les journées à recalculer pour le backfill, une tâche par jour.
+    """
+    start = datetime.strptime(params["start_date"], "%Y-%m-%d").date()
+    end = datetime.strptime(params["end_date"], "%Y-%m-%d").date()
+    days = [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+    logging.info(f"⏳ Backfill du rollup sur {len(days)} jours ({start} -> {end}).")
+    return [{"report_date": day} for day in days]
 
 def create_daily_fraud_report():
     """
     Récupère les fraudes détectées la veille et génère un rapport.
+    Les agrégats sont lus dans la table de rollup et le détail des transactions
+    est streamé dans un fichier CSV (intervalle [veille, aujourd'hui)).
+    Seuls le résumé et le chemin du fichier transitent par XCom.
     """
     logging.info("⏳ Génération du rapport de fraude quotidien...")
-    
-    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-    
+
+    yesterday = (datetime.now() - timedelta(days=1)).date()
+
     hook = PostgresHook(postgres_conn_id=NEON_CONN_ID)
+    connection = hook.get_conn()
+    try:
+        summary = fetch_rollup_aggregates(connection, yesterday)
+        if summary["fraud_count"]:
+            details_file = os.path.join(REPORTS_DIR, f"fraud_report_{yesterday:%Y-%m-%d}.csv")
+            rows = export_report_details(connection, yesterday, details_file)
+            summary["details_file"] = details_file
+            logging.info(f"✅ {rows} transactions frauduleuses exportées dans {details_file}.")
+        else:
+            logging.info("✅ Aucune donnée renvoyée par la requête.")
+    finally:
+        connection.close()
 
-    
-    sql_query = f"SELECT * FROM fraud_predictions WHERE DATE(detection_timestamp) = '{yesterday}'"
-    df = hook.get_pandas_df(sql_query)
-    if df is not None and not df.empty:
-        logging.info(f"Colonnes disponibles : {df.columns.tolist()}")
-        logging.info(f"Aperçu des données :\n{df.head()}")
-    else:
-        logging.info("✅ Aucune donnée renvoyée par la requête.")
-
-    if df.empty:
-        report_body = "Aucune fraude n'a été détectée le jour précédent."
-    else:
-        report_body = f"📊 Rapport de fraude pour le {yesterday}:\n\n"
-        report_body += f"Nombre de fraudes détectées : {len(df)}\n\n"
-        report_body += "Détails des transactions :\n"
-        report_body += df[['detection_timestamp', 'amt', 'category']].to_string()
-    
-    return report_body
+    return summary
 
 def send_daily_report_email(ti):
     """
     Envoie le rapport de fraude quotidien par e-mail.
     """
     subject = "Rapport quotidien de détection de fraude"
-    body = ti.xcom_pull(task_ids='create_daily_fraud_report')
-    
+    summary = ti.xcom_pull(task_ids='create_daily_fraud_report')
+    body = render_report(summary)
+
     # Appel à la fonction send_email corrigée
-    send_email(subject=subject, body=body)
-    
+    send_email(subject=subject, body=body, attachment_path=summary.get("details_file"))
+
 # Définition des arguments par défaut du DAG
 default_args = {
     'owner': 'airflow',
@@ -94,6 +114,12 @@ with DAG(
     schedule_interval='@daily',
     catchup=False
 ) as dag:
+    # Tâche 0 : Recalculer le rollup de la veille
+    reconcile_rollup_task = PythonOperator(
+        task_id='reconcile_fraud_rollup',
+        python_callable=reconcile_fraud_rollup
+    )
+
     # Tâche 1 : Générer le rapport en se connectant à la BDD
     create_report_task = PythonOperator(
         task_id='create_daily_fraud_report',
@@ -107,4 +133,27 @@ with DAG(
     )
 
     # Définition de l'ordre d'exécution des tâches
-    create_report_task >> send_report_email_task
\ No newline at end of file
+    reconcile_rollup_task >> create_report_task >> send_report_email_task
+
+# DAG de backfill : recalcule le rollup d'une plage de dates, une tâche par jour en parallèle
+with DAG(
+    'fraud_rollup_backfill',
+    default_args=default_args,
+    description='Recalcul parallèle de la table de rollup des fraudes sur une plage de dates',
+    schedule_interval=None,
+    catchup=False,
+    params={
+        'start_date': Param((datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d'), type='string', format='date'),
+        'end_date': Param((datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d'), type='string', format='date'),
+    },
+) as backfill_dag:
+    list_days_task = PythonOperator(
+        task_id='list_backfill_days',
+        python_callable=list_backfill_days
+    )
+
+    reconcile_days_task = PythonOperator.partial(
+        task_id='reconcile_fraud_rollup_day',
+        python_callable=reconcile_fraud_rollup,
+        max_active_tis_per_dag=BACKFILL_PARALLELISM,
+    ).expand(op_kwargs=list_days_task.output)
@@ -0,0 +1,45 @@
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from airflow.utils.dates import days_ago
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+from airflow.models.param import Param
+
+from fraud_schema import maintain_partitions, RETENTION_DAYS
+
+# Connexion Airflow de la base métier (même base que le rapport quotidien)
+NEON_CONN_ID = "NEON_DB"
+
+# Partitions expirées archivées dans ./data/archive (monté dans les conteneurs Airflow)
+ARCHIVE_DIR = "/opt/airflow/data/archive"
+
+def run_partition_maintenance(params):
+    """
+    Crée à l'avance les partitions des prochains jours de all_transactions et
+    fraud_predictions, puis archive et supprime celles qui dépassent la durée de conservation.
+    """
+    connection = PostgresHook(postgres_conn_id=NEON_CONN_ID).get_conn()
+    try:
+        maintain_partitions(connection, retention_days=int(params["retention_days"]), archive_dir=ARCHIVE_DIR)
+    finally:
+        connection.close()
+
+default_args = {
+    'owner': 'airflow',
+    'start_date': days_ago(1),
+    'retries': 1,
+}
+
+with DAG(
+    'fraud_partition_maintenance',
+    default_args=default_args,
+    description='Création des partitions à venir et rétention des tables de transactions',
+    schedule_interval='@daily',
+    catchup=False,
+    params={
+        'retention_days': Param(RETENTION_DAYS, type='integer', minimum=0, description='Durée de conservation (0 = illimitée)'),
+    },
+) as dag:
+    maintenance_task = PythonOperator(
+        task_id='maintain_partitions',
+        python_callable=run_partition_maintenance
+    )
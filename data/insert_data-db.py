@@ -1,64 +1,387 @@
 import pandas as pd
 from sqlalchemy import create_engine
 import os
+import sys
+import io
+import time
+import hashlib
+import argparse
 import logging
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime,timedelta
 
+# Modules partagés de plugins/ (déjà sur le PYTHONPATH des conteneurs Airflow) : le script
+# se lance aussi depuis l'hôte (data/../plugins) ou depuis /opt/airflow/data (/opt/airflow/plugins)
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugins")
+if PLUGINS_DIR not in sys.path:
+    sys.path.insert(0, PLUGINS_DIR)
+
+import fraud_schema
+from db_utils import dataframe_to_csv_buffer, copy_buffer, copy_merge
+
 
 logging.basicConfig(level=logging.INFO)
 
-def initiate_database_tables():
+CHUNK_SIZE = 50000  # Taille du lot. Ajustez si "Killed" réapparaît.
+COPY_WORKERS = int(os.environ.get("COPY_WORKERS", 4))  # Nombre de lots encodés / copiés en parallèle
+
+# Mode incrémental : clé d'idempotence et table des points de reprise
+UPSERT_KEY = "trans_num"
+CHECKPOINT_TABLE = "ingestion_checkpoints"
+
+def get_detection_timestamp():
+    """
+    Date de détection attribuée aux transactions chargées : la veille à midi,
+    pour permettre un test immédiat du DAG de rapport quotidien.
+    """
+    return (datetime.now() - timedelta(days=1)).replace(hour=12, minute=0, second=0, microsecond=0)
+
+def run_schema(engine, function, *args):
+    """Exécute une fonction de plugins/fraud_schema.py (curseur psycopg2) dans une transaction."""
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            result = function(cursor, *args)
+        connection.commit()
+        return result
+    finally:
+        connection.close()
+
+def reset_tables(engine, detection_timestamp):
+    """
+    Recrée les tables partitionnées vides, avec la partition de la date de détection,
+    sans index pendant le chargement (construits ensuite par create_post_load_indexes).
+    """
+    def reset(cursor):
+        fraud_schema.drop_tables(cursor)
+        fraud_schema.create_tables(cursor, indexes=False)
+        for table in fraud_schema.TABLES:
+            fraud_schema.ensure_partitions(cursor, table, detection_timestamp, detection_timestamp)
+    run_schema(engine, reset)
+
+def create_post_load_indexes(engine):
+    """
+    Construit les index (detection_timestamp, ...) après le chargement des données.
+    Créés sur les tables mères, ils sont propagés à chaque partition.
+    """
+    start = time.perf_counter()
+    run_schema(engine, fraud_schema.create_indexes)
+    logging.info(f"✅ Index créés en {time.perf_counter() - start:.1f} s.")
+
+def log_throughput(stage: str, rows: int, seconds: float):
+    """Affiche le débit (lignes/s) d'une étape du chargement."""
+    rate = rows / seconds if seconds > 0 else float("inf")
+    logging.info(f"📊 {stage:<22} {rows} lignes en {seconds:.2f} s -> {rate:,.0f} lignes/s")
+
+def write_chunk_to_sql(engine, chunk):
+    """
+    Insère un lot via pandas.to_sql : toutes les transactions dans 'all_transactions',
+    les fraudes dans 'fraud_predictions' (tables recréées vides par reset_tables).
+    """
+    chunk = fraud_schema.conform(chunk)
+
+    # Étape 1 : Sauvegarde de TOUTES les transactions
+    chunk.to_sql('all_transactions', engine, if_exists='append', index=False)
+
+    # Étape 2 : Filtrage et sauvegarde des transactions frauduleuses
+    frauds_to_save = chunk[chunk['is_fraud'] == 1].copy()
+    frauds_to_save.rename(columns={'is_fraud': 'is_fraud_predicted'}, inplace=True)
+    frauds_to_save.to_sql('fraud_predictions', engine, if_exists='append', index=False)
+
+def initiate_database_tables(file_path="fraudTest.csv"):
     """
-    Lit le fichier fraudTest.csv par lots (chunks), insère toutes les transactions 
+    Lit le fichier fraudTest.csv par lots (chunks), insère toutes les transactions
     dans 'all_transactions' et filtre les fraudes pour 'fraud_predictions'.
     """
     try:
-        db_uri = os.environ.get("PROD_DB_URI") 
+        db_uri = os.environ.get("PROD_DB_URI")
         if not db_uri:
             logging.error("La variable d'environnement PROD_DB_URI n'est pas définie.")
             return
-        
+
         engine = create_engine(db_uri)
         logging.info("✅ Connexion à la base de données établie.")
 
-        file_path = "fraudTest.csv"
-        
         # --- MODIFICATION CRUCIALE : Lecture par lots ---
-        CHUNK_SIZE = 50000  # Taille du lot. Ajustez si "Killed" réapparaît.
-        first_chunk = True
+        detection_timestamp = get_detection_timestamp()
+        reset_tables(engine, detection_timestamp)
         total_rows = 0
+        start = time.perf_counter()
 
         logging.info("⏳ Démarrage du chargement et de la sauvegarde des données par lots...")
 
         # Utilisation de chunksize pour lire le fichier itérativement
         for chunk in pd.read_csv(file_path, chunksize=CHUNK_SIZE):
-            
+
             # Prétraitement
-            yesterday_date = (datetime.now() - timedelta(days=1)).replace(hour=12, minute=0, second=0, microsecond=0)
-            chunk['detection_timestamp'] = yesterday_date
+            chunk['detection_timestamp'] = detection_timestamp
             # chunk['detection_timestamp'] = datetime.now()
             total_rows += len(chunk)
 
-            # Le mode 'replace' est utilisé uniquement pour le premier lot
-            # Tous les lots suivants utilisent 'append'
-            if_exists_mode = 'replace' if first_chunk else 'append'
-            
-            logging.info(f"⏳ Sauvegarde du lot de {len(chunk)} transactions. Mode: {if_exists_mode}...")
-            
-            # Étape 1 : Sauvegarde de TOUTES les transactions
-            chunk.to_sql('all_transactions', engine, if_exists=if_exists_mode, index=False)
-            
-            # Étape 2 : Filtrage et sauvegarde des transactions frauduleuses
-            frauds_to_save = chunk[chunk['is_fraud'] == 1].copy()
-            frauds_to_save.rename(columns={'is_fraud': 'is_fraud_predicted'}, inplace=True)
-            frauds_to_save.to_sql('fraud_predictions', engine, if_exists=if_exists_mode, index=False)
-            
-            first_chunk = False 
+            logging.info(f"⏳ Sauvegarde du lot de {len(chunk)} transactions...")
+            write_chunk_to_sql(engine, chunk)
+
+        log_throughput("to_sql (total)", total_rows, time.perf_counter() - start)
+        create_post_load_indexes(engine)
+        logging.info(f"✅ Toutes les données ont été chargées ({total_rows} lignes) et les tables initialisées avec succès.")
+
+    except Exception as e:
+        logging.error(f"❌ Erreur lors du chargement des données : {e}")
+
+def encode_and_copy_chunk(engine, chunk):
+    """
+    Encode un lot en CSV puis l'envoie via COPY FROM STDIN dans 'all_transactions'
+    et 'fraud_predictions', sur une connexion dédiée et dans une seule transaction.
+    Retourne les durées des étapes d'encodage et de copie.
+    """
+    start = time.perf_counter()
+    chunk = fraud_schema.conform(chunk)
+    frauds = chunk[chunk['is_fraud'] == 1].rename(columns={'is_fraud': 'is_fraud_predicted'})
+    all_buffer = dataframe_to_csv_buffer(chunk)
+    fraud_buffer = dataframe_to_csv_buffer(frauds)
+    encoded = time.perf_counter()
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            copy_buffer(cursor, 'all_transactions', chunk.columns, all_buffer)
+            copy_buffer(cursor, 'fraud_predictions', frauds.columns, fraud_buffer)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    return {"rows": len(chunk), "encode": encoded - start, "copy": time.perf_counter() - encoded}
+
+def bulk_load_with_copy(file_path="fraudTest.csv", workers=COPY_WORKERS):
+    """
+    Variante du chargement initial basée sur COPY FROM STDIN.
+    Le thread principal lit le CSV par lots pendant qu'un petit pool de workers
+    encode et copie les lots précédents. Les index sont construits à la fin.
+    """
+    try:
+        db_uri = os.environ.get("PROD_DB_URI")
+        if not db_uri:
+            logging.error("La variable d'environnement PROD_DB_URI n'est pas définie.")
+            return
+
+        engine = create_engine(db_uri, pool_size=workers, max_overflow=0)
+        logging.info(f"✅ Connexion à la base de données établie ({workers} workers COPY).")
+
+        detection_timestamp = get_detection_timestamp()
+        stats = {"parse": 0.0, "encode": 0.0, "copy": 0.0}
+        total_rows = 0
+        start = time.perf_counter()
+
+        def collect(futures):
+            nonlocal total_rows
+            for future in futures:
+                result = future.result()
+                total_rows += result["rows"]
+                stats["encode"] += result["encode"]
+                stats["copy"] += result["copy"]
+
+        reader = pd.read_csv(file_path, chunksize=CHUNK_SIZE)
+        parse_start = time.perf_counter()
+        chunk = next(reader, None)
+        stats["parse"] += time.perf_counter() - parse_start
+        if chunk is None:
+            logging.info("✅ Fichier vide, aucune donnée à charger.")
+            return
 
+        # Création des tables partitionnées vides, sans index pendant le chargement
+        chunk['detection_timestamp'] = detection_timestamp
+        reset_tables(engine, detection_timestamp)
+
+        logging.info("⏳ Démarrage du chargement COPY par lots...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            while chunk is not None:
+                pending.add(executor.submit(encode_and_copy_chunk, engine, chunk))
+                # Contre-pression : pas plus de 2 lots en attente par worker
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                parse_start = time.perf_counter()
+                chunk = next(reader, None)
+                if chunk is not None:
+                    chunk['detection_timestamp'] = detection_timestamp
+                stats["parse"] += time.perf_counter() - parse_start
+            collect(pending)
+
+        load_seconds = time.perf_counter() - start
+        create_post_load_indexes(engine)
+
+        log_throughput("lecture CSV", total_rows, stats["parse"])
+        # Les durées d'encodage et de COPY sont cumulées sur l'ensemble des workers
+        log_throughput("encodage (par worker)", total_rows, stats["encode"])
+        log_throughput("COPY (par worker)", total_rows, stats["copy"])
+        log_throughput("COPY (total)", total_rows, load_seconds)
         logging.info(f"✅ Toutes les données ont été chargées ({total_rows} lignes) et les tables initialisées avec succès.")
 
     except Exception as e:
         logging.error(f"❌ Erreur lors du chargement des données : {e}")
 
+def iter_csv_chunks(file_path, start_byte=0, chunk_size=CHUNK_SIZE):
+    """
+    Lit le CSV par lots de lignes brutes à partir d'un offset en octets.
+    Retourne pour chaque lot : le DataFrame, les offsets de début et de fin
+    (en octets) et le hash SHA-256 du contenu brut du lot.
+    Hypothèse : aucune valeur ne contient de retour à la ligne (cas de fraudTest.csv).
+    """
+    with open(file_path, "rb") as f:
+        header = f.readline()
+        if start_byte > len(header):
+            f.seek(start_byte)
+        offset = f.tell()
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
+            raw = b"".join(lines)
+            chunk = pd.read_csv(io.BytesIO(header + raw))
+            yield chunk, offset, offset + len(raw), hashlib.sha256(raw).hexdigest()
+            offset += len(raw)
+
+def ensure_incremental_schema(engine):
+    """
+    Crée si besoin les tables partitionnées (sans les vider) avec leurs index, dont celui
+    commençant par trans_num utilisé par l'upsert, et la table des points de reprise.
+    """
+    run_schema(engine, fraud_schema.create_tables)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"""
+            CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+                source_file TEXT PRIMARY KEY,
+                row_offset BIGINT NOT NULL,
+                byte_offset BIGINT NOT NULL,
+                chunk_start_byte BIGINT NOT NULL,
+                content_hash TEXT NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """)
+
+def read_checkpoint(engine, source_file):
+    """Retourne le dernier point de reprise enregistré pour un fichier source, ou None."""
+    with engine.connect() as connection:
+        row = connection.exec_driver_sql(
+            f"SELECT row_offset, byte_offset, chunk_start_byte, content_hash FROM {CHECKPOINT_TABLE} WHERE source_file = %(source_file)s",
+            {"source_file": source_file},
+        ).mappings().first()
+    return dict(row) if row else None
+
+def checkpoint_matches_file(file_path, checkpoint):
+    """
+    Vérifie que le dernier lot validé est toujours identique dans le fichier
+    (même contenu aux mêmes offsets), auquel cas la reprise est sûre.
+    """
+    if os.path.getsize(file_path) < checkpoint["byte_offset"]:
+        return False
+    with open(file_path, "rb") as f:
+        f.seek(checkpoint["chunk_start_byte"])
+        raw = f.read(checkpoint["byte_offset"] - checkpoint["chunk_start_byte"])
+    return hashlib.sha256(raw).hexdigest() == checkpoint["content_hash"]
+
+def upsert_chunk_with_checkpoint(engine, chunk, source_file, row_offset, chunk_start, chunk_end, content_hash):
+    """
+    Upsert d'un lot sur trans_num dans 'all_transactions' et 'fraud_predictions',
+    puis enregistrement du point de reprise, le tout dans une seule transaction.
+    La date de détection d'origine est conservée pour les lignes déjà présentes.
+    L'idempotence repose sur la table des clés (clé primaire sur trans_num) : elle donne
+    aussi la plus ancienne date de détection des clés du lot, qui borne exactement la
+    recherche des lignes existantes dans les tables partitionnées.
+    """
+    chunk = fraud_schema.conform(chunk)
+    frauds = chunk[chunk['is_fraud'] == 1].rename(columns={'is_fraud': 'is_fraud_predicted'})
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            _, since = fraud_schema.register_keys(cursor, chunk)
+            for table, df in (('all_transactions', chunk), ('fraud_predictions', frauds)):
+                fraud_schema.ensure_partitions_for(cursor, table, df['detection_timestamp'])
+                update_columns = [c for c in df.columns if c not in (UPSERT_KEY, 'detection_timestamp')]
+                # trans_num n'est pas unique à lui seul dans une table partitionnée : fusion sans ON CONFLICT
+                copy_merge(cursor, table, df, [UPSERT_KEY], update_columns, window_column='detection_timestamp', since=since)
+            cursor.execute(
+                f"""
+                INSERT INTO {CHECKPOINT_TABLE} (source_file, row_offset, byte_offset, chunk_start_byte, content_hash, updated_at)
+                VALUES (%s, %s, %s, %s, %s, now())
+                ON CONFLICT (source_file) DO UPDATE SET
+                    row_offset = EXCLUDED.row_offset,
+                    byte_offset = EXCLUDED.byte_offset,
+                    chunk_start_byte = EXCLUDED.chunk_start_byte,
+                    content_hash = EXCLUDED.content_hash,
+                    updated_at = EXCLUDED.updated_at
+                """,
+                (source_file, row_offset, chunk_end, chunk_start, content_hash),
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+def incremental_load(file_path="fraudTest.csv"):
+    """
+    Chargement incrémental et idempotent : reprend au dernier point de reprise
+    validé pour ce fichier et fait un upsert sur trans_num. Une relance après
+    interruption (OOM, "Killed") ne recharge que les lots manquants, et une relance
+    sur un fichier complété en fin ne charge que les nouvelles lignes.
+    """
+    try:
+        db_uri = os.environ.get("PROD_DB_URI")
+        if not db_uri:
+            logging.error("La variable d'environnement PROD_DB_URI n'est pas définie.")
+            return
+
+        engine = create_engine(db_uri)
+        logging.info("✅ Connexion à la base de données établie.")
+
+        source_file = os.path.basename(file_path)
+        ensure_incremental_schema(engine)
+
+        start_byte, row_offset = 0, 0
+        checkpoint = read_checkpoint(engine, source_file)
+        if checkpoint and checkpoint_matches_file(file_path, checkpoint):
+            start_byte, row_offset = checkpoint["byte_offset"], checkpoint["row_offset"]
+            logging.info(f"⏳ Reprise de '{source_file}' à la ligne {row_offset} (octet {start_byte}).")
+        elif checkpoint:
+            logging.warning(f"⚠️ Le fichier '{source_file}' a changé depuis le dernier point de reprise : rechargement complet (upsert).")
+
+        loaded_rows = 0
+        start = time.perf_counter()
+        for chunk, chunk_start, chunk_end, content_hash in iter_csv_chunks(file_path, start_byte):
+            chunk['detection_timestamp'] = get_detection_timestamp()
+            row_offset += len(chunk)
+            upsert_chunk_with_checkpoint(engine, chunk, source_file, row_offset, chunk_start, chunk_end, content_hash)
+            loaded_rows += len(chunk)
+            logging.info(f"✅ Lot validé : {len(chunk)} transactions, point de reprise à la ligne {row_offset}.")
+
+        if loaded_rows:
+            log_throughput("upsert incrémental", loaded_rows, time.perf_counter() - start)
+            create_post_load_indexes(engine)
+        logging.info(f"✅ Chargement incrémental terminé : {loaded_rows} nouvelles lignes traitées ({row_offset} au total).")
+
+    except Exception as e:
+        logging.error(f"❌ Erreur lors du chargement incrémental : {e}")
+
 if __name__ == "__main__":
-    initiate_database_tables()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Chargement initial de fraudTest.csv dans PostgreSQL")
+    parser.add_argument("--mode", choices=["to_sql", "copy", "incremental"], default="to_sql",
+                        help="'to_sql' (INSERT via pandas), 'copy' (COPY FROM STDIN parallélisé) "
+                             "ou 'incremental' (reprise sur point de contrôle + upsert sur trans_num)")
+    parser.add_argument("--file", default="fraudTest.csv", help="Chemin du fichier CSV source")
+    parser.add_argument("--workers", type=int, default=COPY_WORKERS, help="Nombre de workers pour le mode 'copy'")
+    args = parser.parse_args()
+
+    if args.mode == "copy":
+        bulk_load_with_copy(args.file, workers=args.workers)
+    elif args.mode == "incremental":
+        incremental_load(args.file)
+    else:
+        initiate_database_tables(args.file)
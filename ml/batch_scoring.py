@@ -0,0 +1,316 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from mlflow.tracking import MlflowClient
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from db_utils import dataframe_to_csv_buffer, copy_buffer
+from inference_engine import score_frame
+from model_watcher import load_model_version
+
+DB_URI = os.environ.get("PROD_DB_URI")
+MODEL_NAME = os.environ.get("MODEL_NAME", "XGBoost_Fraud_Model_Prod")
+MODEL_STAGE = os.environ.get("MODEL_STAGE", "Production")
+
+SOURCE_TABLE = "all_transactions"
+PARTITION_COLUMN = "unix_time"
+PREDICTIONS_TABLE = "batch_predictions"  # Prédictions de toutes les versions, distinguées par model_version
+PARTITIONS_TABLE = "batch_scoring_partitions"  # Plan de découpage et avancement, pour la reprise
+
+BATCH_SCORING_PARTITIONS = int(os.environ.get("BATCH_SCORING_PARTITIONS", 32))
+BATCH_SCORING_WORKERS = int(os.environ.get("BATCH_SCORING_WORKERS", os.cpu_count() or 1))
+FETCH_SIZE = 50000  # Lignes rapatriées à chaque aller-retour du curseur serveur
+# Un seul thread XGBoost par processus : le parallélisme vient du pool de processus
+THREADS_PER_WORKER = 1
+
+# Colonnes lues dans all_transactions (l'horodatage vient de current_time ou, pour les données
+# chargées depuis le CSV, de trans_date_trans_time)
+SOURCE_COLUMNS = ["trans_num", "unix_time", "category", "merchant", "amt", "gender", "city_pop"]
+TIME_COLUMNS = ["current_time", "trans_date_trans_time"]
+RESULT_COLUMNS = ["model_version", "trans_num", "unix_time", "fraud_proba", "is_fraud_predicted", "scored_at"]
+
+SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS {PREDICTIONS_TABLE} (
+    model_version INTEGER NOT NULL,
+    trans_num TEXT,
+    unix_time BIGINT,
+    fraud_proba REAL,
+    is_fraud_predicted SMALLINT,
+    scored_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_{PREDICTIONS_TABLE}_version ON {PREDICTIONS_TABLE} (model_version, unix_time);
+CREATE TABLE IF NOT EXISTS {PARTITIONS_TABLE} (
+    model_version INTEGER NOT NULL,
+    partition_id INTEGER NOT NULL,
+    range_start BIGINT,
+    range_end BIGINT,
+    null_keys BOOLEAN NOT NULL DEFAULT false,
+    rows BIGINT,
+    seconds REAL,
+    completed_at TIMESTAMP,
+    PRIMARY KEY (model_version, partition_id)
+);
+-- Plans enregistrés avant l'ajout des bornes ouvertes et de la partition des valeurs NULL
+ALTER TABLE {PARTITIONS_TABLE} ALTER COLUMN range_start DROP NOT NULL;
+ALTER TABLE {PARTITIONS_TABLE} ALTER COLUMN range_end DROP NOT NULL;
+ALTER TABLE {PARTITIONS_TABLE} ADD COLUMN IF NOT EXISTS null_keys BOOLEAN NOT NULL DEFAULT false;
+CREATE INDEX IF NOT EXISTS idx_{SOURCE_TABLE}_{PARTITION_COLUMN} ON {SOURCE_TABLE} ({PARTITION_COLUMN});
+"""
+
+# Lignes d'une partition : [début, fin) sur unix_time, borne absente (NULL) = ouverte ;
+# la partition 'null_keys' regroupe les lignes sans unix_time. Paramètres passés en littéraux
+# par psycopg2 : le planificateur simplifie la condition et utilise l'index de découpage.
+PARTITION_CONDITION = (
+    f"CASE WHEN %(null_keys)s THEN {PARTITION_COLUMN} IS NULL "
+    f"ELSE (%(start)s::bigint IS NULL OR {PARTITION_COLUMN} >= %(start)s) "
+    f"AND (%(end)s::bigint IS NULL OR {PARTITION_COLUMN} < %(end)s) END"
+)
+
+# État de chaque processus du pool : modèle et connexion créés une seule fois par l'initialiseur
+_worker = {}
+
+
+def ensure_batch_schema(connection):
+    """Crée les tables de résultats et d'avancement (et l'index de découpage) si besoin."""
+    with connection.cursor() as cursor:
+        cursor.execute(SCHEMA_SQL)
+    connection.commit()
+
+
+def resolve_model_version(model_version=None):
+    """Version à rescorer : celle demandée, ou la version actuellement en production."""
+    if model_version is not None:
+        return int(model_version)
+    versions = MlflowClient().get_latest_versions(MODEL_NAME, stages=[MODEL_STAGE])
+    if not versions:
+        raise ValueError(f"Aucune version du modèle '{MODEL_NAME}' dans le stage '{MODEL_STAGE}'.")
+    return int(versions[0].version)
+
+
+def plan_partitions(connection, model_version, partitions, restart=False):
+    """
+    Retourne les partitions restant à scorer pour la version : [(id, début, fin, null_keys)].
+    Le plan est enregistré au premier lancement (quantiles de unix_time, partitions
+    de taille comparable) puis réutilisé tel quel : une relance ne reprend que les
+    partitions non terminées. La première et la dernière plage sont ouvertes (lignes
+    insérées après le plan hors des bornes d'origine) et une dernière partition reçoit
+    les lignes sans unix_time. 'restart' efface les résultats et le plan existants.
+    """
+    with connection.cursor() as cursor:
+        if restart:
+            cursor.execute(f"DELETE FROM {PREDICTIONS_TABLE} WHERE model_version = %s", (model_version,))
+            cursor.execute(f"DELETE FROM {PARTITIONS_TABLE} WHERE model_version = %s", (model_version,))
+
+        cursor.execute(f"SELECT count(*) FROM {PARTITIONS_TABLE} WHERE model_version = %s", (model_version,))
+        if cursor.fetchone()[0] == 0:
+            fractions = [i / partitions for i in range(partitions)]
+            cursor.execute(
+                f"SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY {PARTITION_COLUMN}), count(*) "
+                f"FROM {SOURCE_TABLE}",
+                (fractions,),
+            )
+            bounds, total = cursor.fetchone()
+            if total == 0:
+                connection.commit()
+                return []
+            # Intervalles semi-ouverts [début, fin), le premier et le dernier sans borne
+            bounds = sorted(set(bound for bound in bounds or [] if bound is not None))[1:]
+            ranges = list(zip([None] + bounds, bounds + [None]))
+            plan = [(start, end, False) for start, end in ranges] + [(None, None, True)]
+            cursor.executemany(
+                f"INSERT INTO {PARTITIONS_TABLE} (model_version, partition_id, range_start, range_end, null_keys) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [(model_version, i, start, end, null_keys) for i, (start, end, null_keys) in enumerate(plan)],
+            )
+
+        cursor.execute(
+            f"SELECT partition_id, range_start, range_end, null_keys FROM {PARTITIONS_TABLE} "
+            "WHERE model_version = %s AND completed_at IS NULL ORDER BY partition_id",
+            (model_version,),
+        )
+        pending = cursor.fetchall()
+    connection.commit()
+    return pending
+
+
+def build_select_sql(connection):
+    """Requête de lecture d'une partition, selon les colonnes présentes dans all_transactions."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema()",
+            (SOURCE_TABLE,),
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+    time_columns = [f'"{column}"::text' for column in TIME_COLUMNS if column in existing]
+    columns = [f'"{column}"' if column in existing else f'NULL AS "{column}"' for column in SOURCE_COLUMNS]
+    return (
+        f"SELECT {', '.join(columns)}, COALESCE({', '.join(time_columns)}) AS current_time FROM {SOURCE_TABLE} "
+        f"WHERE {PARTITION_CONDITION}"
+    )
+
+
+def audit_plan(connection, model_version):
+    """
+    Compare le plan enregistré au contenu actuel de la table source : lignes hors de
+    toute partition (plan créé avant les bornes ouvertes, ou sans partition NULL) et
+    lignes ajoutées depuis dans des partitions déjà terminées. Retourne (hors plan, ajoutées).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT range_start, range_end, null_keys, rows, completed_at IS NOT NULL FROM {PARTITIONS_TABLE} "
+            "WHERE model_version = %s",
+            (model_version,),
+        )
+        partitions = cursor.fetchall()
+        cursor.execute(f"SELECT count(*) FROM {SOURCE_TABLE}")
+        total = cursor.fetchone()[0]
+        planned = added = 0
+        for range_start, range_end, null_keys, rows, completed in partitions:
+            cursor.execute(
+                f"SELECT count(*) FROM {SOURCE_TABLE} WHERE {PARTITION_CONDITION}",
+                {"start": range_start, "end": range_end, "null_keys": null_keys},
+            )
+            count = cursor.fetchone()[0]
+            planned += count
+            if completed:
+                added += max(count - (rows or 0), 0)
+    connection.commit()
+    return total - planned, added
+
+
+def init_worker(model_version, db_uri):
+    """Initialiseur du pool : charge le modèle et ouvre le moteur SQL une seule fois par processus."""
+    logging.basicConfig(level=logging.INFO)
+    model_version = MlflowClient().get_model_version(MODEL_NAME, str(model_version))
+    loaded = load_model_version(model_version)
+    if loaded.engine is not None:
+        loaded.engine.booster.set_param({"nthread": THREADS_PER_WORKER})
+    _worker["loaded"] = loaded
+    _worker["engine"] = create_engine(db_uri, poolclass=NullPool)
+
+
+def score_partition(partition, select_sql):
+    """
+    Score une partition dans une seule transaction : lecture par curseur serveur,
+    prédiction par morceaux, COPY des résultats puis marquage de la partition terminée.
+    Une partition interrompue ne laisse donc aucune ligne et sera rejouée en entier.
+    """
+    partition_id, range_start, range_end, null_keys = partition
+    loaded = _worker["loaded"]
+    start = time.perf_counter()
+    rows = 0
+    connection = _worker["engine"].raw_connection()
+    try:
+        with connection.cursor(name=f"batch_scoring_{partition_id}") as reader, connection.cursor() as writer:
+            reader.itersize = FETCH_SIZE
+            reader.execute(select_sql, {"start": range_start, "end": range_end, "null_keys": null_keys})
+            while True:
+                chunk = reader.fetchmany(FETCH_SIZE)
+                if not chunk:
+                    break
+                # La description d'un curseur serveur n'est connue qu'après le premier fetch
+                df = pd.DataFrame(chunk, columns=[description[0] for description in reader.description])
+                predictions, proba = score_frame(loaded, df)
+                results = pd.DataFrame({
+                    "model_version": int(loaded.version),
+                    "trans_num": df["trans_num"],
+                    "unix_time": df["unix_time"],
+                    "fraud_proba": proba,
+                    "is_fraud_predicted": predictions,
+                    "scored_at": pd.Timestamp.now(),
+                })
+                copy_buffer(writer, PREDICTIONS_TABLE, RESULT_COLUMNS, dataframe_to_csv_buffer(results, RESULT_COLUMNS))
+                rows += len(df)
+            seconds = time.perf_counter() - start
+            writer.execute(
+                f"UPDATE {PARTITIONS_TABLE} SET rows = %s, seconds = %s, completed_at = now() "
+                "WHERE model_version = %s AND partition_id = %s",
+                (rows, seconds, int(loaded.version), partition_id),
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return partition_id, rows, seconds
+
+
+def log_plan_audit(engine, model_version):
+    """Signale les lignes de la table source que le plan de la version n'a pas scorées."""
+    connection = engine.raw_connection()
+    try:
+        outside, added = audit_plan(connection, model_version)
+    finally:
+        connection.close()
+    if outside or added:
+        logging.warning(
+            f"⚠️ Version {model_version} : {outside} ligne(s) hors du plan de découpage et {added} ligne(s) ajoutée(s) "
+            "dans des partitions déjà terminées ne sont pas scorées ; relancer avec --restart pour les inclure."
+        )
+
+
+def run_batch_scoring(model_version=None, partitions=BATCH_SCORING_PARTITIONS, workers=BATCH_SCORING_WORKERS,
+                      restart=False, db_uri=DB_URI):
+    """
+    Rescore tout l'historique de all_transactions avec une version du modèle.
+    Les partitions sont réparties sur un pool de processus ; retourne le nombre de lignes scorées.
+    """
+    start = time.perf_counter()
+    model_version = resolve_model_version(model_version)
+    engine = create_engine(db_uri, poolclass=NullPool)
+    connection = engine.raw_connection()
+    try:
+        ensure_batch_schema(connection)
+        pending = plan_partitions(connection, model_version, partitions, restart)
+        select_sql = build_select_sql(connection)
+    finally:
+        connection.close()
+
+    if not pending:
+        logging.info(f"✅ Rescoring de la version {model_version} déjà terminé, rien à faire.")
+        log_plan_audit(engine, model_version)
+        return 0
+
+    logging.info(f"⏳ Rescoring de la version {model_version} : {len(pending)} partitions sur {workers} processus...")
+    total_rows = 0
+    failures = 0
+    with ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=init_worker,
+                             initargs=(model_version, db_uri)) as pool:
+        futures = {pool.submit(score_partition, partition, select_sql): partition for partition in pending}
+        for future in as_completed(futures):
+            try:
+                partition_id, rows, seconds = future.result()
+            except Exception as e:
+                failures += 1
+                logging.error(f"❌ Partition {futures[future][0]} en échec (reprise au prochain lancement) : {e}")
+                continue
+            total_rows += rows
+            logging.info(f"✅ Partition {partition_id} : {rows} lignes en {seconds:.2f} s.")
+
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"📊 Rescoring de la version {model_version} : {total_rows} lignes en {elapsed:.1f} s "
+        f"({total_rows / elapsed:,.0f} lignes/s), {failures} partition(s) en échec."
+    )
+    log_plan_audit(engine, model_version)
+    if failures:
+        raise RuntimeError(f"{failures} partition(s) en échec, relancer pour reprendre.")
+    return total_rows
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Rescoring parallèle de l'historique all_transactions par une version du modèle")
+    parser.add_argument("--model-version", type=int, default=None, help="Version du registre (défaut : version en production)")
+    parser.add_argument("--partitions", type=int, default=BATCH_SCORING_PARTITIONS)
+    parser.add_argument("--workers", type=int, default=BATCH_SCORING_WORKERS)
+    parser.add_argument("--restart", action="store_true", help="Efface les résultats existants de la version et recommence")
+    args = parser.parse_args()
+
+    run_batch_scoring(args.model_version, args.partitions, args.workers, args.restart)
@@ -0,0 +1,67 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+# Code réservé aux valeurs absentes du vocabulaire d'entraînement (ou manquantes)
+UNKNOWN_CODE = 0
+# Emplacement de l'encodeur parmi les artefacts du run MLflow, à côté du modèle
+ENCODER_ARTIFACT_PATH = "preprocessing/categorical_encoder.json"
+
+
+class CategoricalEncoder:
+    """
+    Encodeur catégoriel figé, construit une seule fois à l'entraînement.
+
+    Chaque colonne possède un vocabulaire trié ; la valeur de rang i reçoit le code i + 1
+    et toute valeur inconnue reçoit UNKNOWN_CODE. Les codes sont donc identiques entre
+    l'entraînement et chaque micro-lot servi en production, quelle que soit sa composition.
+    La recherche passe par la table de hachage d'un pd.Index construite au chargement,
+    et l'encodage d'une colonne se fait en un seul appel vectorisé.
+    """
+
+    def __init__(self, vocabularies):
+        self.vocabularies = {column: list(values) for column, values in vocabularies.items()}
+        self._indexes = {column: pd.Index(values) for column, values in self.vocabularies.items()}
+
+    @classmethod
+    def fit(cls, df, columns):
+        """Construit le vocabulaire de chaque colonne à partir des données d'entraînement."""
+        vocabularies = {column: sorted(df[column].dropna().astype(str).unique()) for column in columns}
+        return cls(vocabularies)
+
+    def encode(self, values, column):
+        """
+        Encode une série de valeurs brutes en codes entiers (int32).
+        Une série catégorielle (pandas) n'est recherchée qu'une fois par modalité,
+        puis ses codes sont traduits par simple indexation.
+        """
+        values = pd.Series(values)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            lookup = self._indexes[column].get_indexer(values.cat.categories.astype(str)) + 1
+            # Dernière case : valeurs manquantes (code -1 de pandas)
+            lookup = np.append(lookup, UNKNOWN_CODE).astype(np.int32)
+            return lookup[values.cat.codes.to_numpy()]
+        codes = self._indexes[column].get_indexer(values.astype(str))
+        codes += 1  # -1 (valeur inconnue) devient UNKNOWN_CODE
+        return codes.astype(np.int32, copy=False)
+
+    def cardinality(self, column):
+        """Nombre de codes possibles pour une colonne, code inconnu compris."""
+        return len(self.vocabularies[column]) + 1
+
+    def to_dict(self):
+        return {"unknown_code": UNKNOWN_CODE, "vocabularies": self.vocabularies}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["vocabularies"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
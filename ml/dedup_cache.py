@@ -0,0 +1,167 @@
+import math
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# Clés de hachage (16 caractères) des deux fonctions combinées par double hachage
+HASH_KEY_1 = "fraud-dedup-key1"
+HASH_KEY_2 = "fraud-dedup-key2"
+
+
+def bloom_parameters(capacity, error_rate):
+    """Taille (bits) et nombre de fonctions de hachage d'un filtre de Bloom pour 'capacity' éléments."""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    """Filtre de Bloom à taille fixe sur un tableau de bits numpy, requêtes vectorisées par lot."""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = np.zeros((bits + 7) // 8, dtype=np.uint8)
+        self.count = 0  # Éléments insérés (estimation du taux de faux positifs)
+
+    def positions(self, h1, h2):
+        """Positions des bits de chaque élément : h1 + i * h2 (double hachage), forme (hashes, n)."""
+        steps = np.arange(self.hashes, dtype=np.uint64)[:, None]
+        return (h1[None, :] + steps * h2[None, :]) % np.uint64(self.bits)
+
+    def contains(self, positions):
+        masks = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        return ((self.array[positions >> np.uint64(3)] & masks) != 0).all(axis=0)
+
+    def add(self, positions):
+        masks = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        np.bitwise_or.at(self.array, (positions >> np.uint64(3)).ravel(), masks.ravel())
+        self.count += positions.shape[1]
+
+    def clear(self):
+        self.array[:] = 0
+        self.count = 0
+
+    def false_positive_rate(self):
+        """Taux de faux positifs estimé compte tenu du remplissage actuel."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+
+class TransactionDedupCache:
+    """
+    Cache anti-doublons sur trans_num, à mémoire fixe et fenêtre glissante.
+
+    Deux générations de filtres de Bloom : les nouveaux identifiants vont dans la
+    génération courante, la recherche interroge les deux. Toutes les 'window' secondes,
+    la plus ancienne est vidée et devient la génération courante : un identifiant est
+    donc reconnu pendant au moins 'window' secondes (au plus 2 x 'window').
+    Chaque génération est dimensionnée pour 'capacity' identifiants avec un taux de faux
+    positifs de 'error_rate' / 2 (soit 'error_rate' au total). Un faux positif écarte à
+    tort une transaction nouvelle ; un doublon hors fenêtre (ou après un redémarrage)
+    n'est pas vu ici mais par la contrainte d'unicité de la base.
+
+    Un identifiant retenu par 'filter_new' est d'abord réservé (en cours de traitement :
+    écarté des polls suivants), puis enregistré dans le filtre par 'confirm' une fois son
+    lot confié à l'écriture, ou libéré par 'release' si le lot échoue : un filtre de Bloom
+    ne sait pas retirer un élément, les transactions d'un lot en échec ne doivent donc pas
+    y entrer avant d'être sauvegardées.
+    """
+
+    def __init__(self, window=3600.0, capacity=1_000_000, error_rate=1e-6):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        bits, hashes = bloom_parameters(capacity, error_rate / 2)
+        self._generations = [BloomFilter(bits, hashes), BloomFilter(bits, hashes)]
+        self._rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._pending = set()  # Identifiants réservés, en cours de traitement
+        self.hits = 0
+        self.misses = 0
+
+    def _rotate(self):
+        if time.monotonic() - self._rotated_at < self.window:
+            return
+        oldest = self._generations.pop()
+        oldest.clear()
+        self._generations.insert(0, oldest)
+        self._rotated_at = time.monotonic()
+
+    @staticmethod
+    def _hash(keys):
+        h1 = pd.util.hash_array(keys, hash_key=HASH_KEY_1)
+        h2 = pd.util.hash_array(keys, hash_key=HASH_KEY_2) | np.uint64(1)  # Pas impair : positions distinctes
+        return h1, h2
+
+    def check_and_reserve(self, keys):
+        """
+        Retourne le masque (numpy bool) des identifiants déjà vus : dans la fenêtre, en cours
+        de traitement, ou plus haut dans le même lot. Les autres sont réservés.
+        """
+        keys = np.asarray(keys, dtype=object)
+        if len(keys) == 0:
+            return np.zeros(0, dtype=bool)
+        h1, h2 = self._hash(keys)
+        with self._lock:
+            self._rotate()
+            positions = self._generations[0].positions(h1, h2)
+            seen = np.zeros(len(keys), dtype=bool)
+            for generation in self._generations:
+                seen |= generation.contains(positions)
+            series = pd.Series(keys)
+            seen |= series.duplicated().to_numpy() | series.isin(self._pending).to_numpy()
+            self._pending.update(keys[~seen].tolist())
+            hits = int(seen.sum())
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return seen
+
+    def filter_new(self, df, key="trans_num"):
+        """
+        Retire du lot les transactions déjà vues et réserve les autres, à confirmer ('confirm')
+        ou libérer ('release') selon l'issue du traitement. Un lot sans colonne 'key' est rendu tel quel.
+        """
+        if key not in df.columns or df.empty:
+            return df
+        seen = self.check_and_reserve(df[key].to_numpy())
+        return df[~seen] if seen.any() else df
+
+    def confirm(self, df, key="trans_num"):
+        """Enregistre dans la génération courante les transactions réservées d'un lot sauvegardé."""
+        if key not in df.columns or df.empty:
+            return
+        keys = np.asarray(df[key].to_numpy(), dtype=object)
+        h1, h2 = self._hash(keys)
+        with self._lock:
+            self._rotate()
+            current = self._generations[0]
+            current.add(current.positions(h1, h2))
+            self._pending.difference_update(keys.tolist())
+
+    def release(self, df, key="trans_num"):
+        """Libère les transactions réservées d'un lot en échec : un prochain poll pourra les traiter."""
+        if key not in df.columns or df.empty:
+            return
+        with self._lock:
+            self._pending.difference_update(df[key].tolist())
+
+    def false_positive_rate(self):
+        """Taux de faux positifs estimé avec le remplissage actuel des deux générations."""
+        rates = [generation.false_positive_rate() for generation in self._generations]
+        return 1 - math.prod(1 - rate for rate in rates)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "tracked": sum(generation.count for generation in self._generations),
+            "pending": len(self._pending),
+            "memory_bytes": sum(generation.nbytes for generation in self._generations),
+            "estimated_fpr": self.false_positive_rate(),
+        }
@@ -1,8 +1,20 @@
+import argparse
+import os
+import sys
+import time
+
 import mlflow
+import numpy as np
 from mlflow.tracking import MlflowClient
+from sklearn.metrics import f1_score
+
+from feature_store import VelocityFeatureStore, VELOCITY_FEATURES
+from inference_engine import FEATURE_COLUMNS, score_frame
+from model_watcher import load_model_version
+from training_data import load_training_data, load_holdout, HOLDOUT_ARTIFACT_PATH, MODEL_COLUMNS, peak_rss_mb
 
 # The URI is configured in your docker-compose.yaml
-MLFLOW_TRACKING_URI = "http://mlflow-server:5000"
+MLFLOW_TRACKING_URI = os.environ.get("MLFLOW_TRACKING_URI", "http://mlflow-server:5000")
 MODEL_NAME = "XGBoost_Fraud_Model_Prod"
 # Note: MLflow a déprécié les "stages".
 # Les nouveaux projets devraient utiliser des alias.
@@ -10,10 +22,191 @@ MODEL_NAME = "XGBoost_Fraud_Model_Prod"
 # pour que le service de prédiction fonctionne.
 MODEL_STAGE = "Production"
 
-def deploy_model():
+# Porte de performance avant promotion : le candidat est comparé au modèle en production
+# sur un lot de référence (les BENCHMARK_ROWS transactions les plus récentes du jeu de test
+# enregistré par le run d'entraînement du candidat), à plusieurs tailles de lot.
+GATE_EXPERIMENT = "Model Promotion Gate"
+BENCHMARK_ROWS = int(os.environ.get("PERF_GATE_BENCHMARK_ROWS", 20000))
+BENCHMARK_BATCH_SIZES = [1, 100, 1000, 10000]
+BENCHMARK_REPEAT = int(os.environ.get("PERF_GATE_REPEAT", 200))  # Mesures par taille de lot (p99 stable)
+# Budget du candidat, relatif au modèle en production (0 = contrôle désactivé)
+MAX_LATENCY_RATIO = float(os.environ.get("PERF_GATE_MAX_LATENCY_RATIO", 1.5))  # p99 candidat / p99 production, à chaque taille
+MIN_THROUGHPUT_RATIO = float(os.environ.get("PERF_GATE_MIN_THROUGHPUT_RATIO", 0.67))  # lignes/s au plus gros lot
+MAX_MEMORY_RATIO = float(os.environ.get("PERF_GATE_MAX_MEMORY_RATIO", 2.0))  # taille du modèle sérialisé
+MAX_F1_DROP = float(os.environ.get("PERF_GATE_MAX_F1_DROP", 0.01))  # baisse de F1 tolérée (points)
+# Budget absolu, appliqué même sans modèle en production (0 = contrôle désactivé)
+MAX_P99_MS = float(os.environ.get("PERF_GATE_MAX_P99_MS", 0))  # p99 à la taille PERF_GATE_BUDGET_BATCH_SIZE
+BUDGET_BATCH_SIZE = int(os.environ.get("PERF_GATE_BUDGET_BATCH_SIZE", 1000))  # Taille typique d'un micro-lot du service
+MIN_F1 = float(os.environ.get("PERF_GATE_MIN_F1", 0))
+
+def current_rss_mb():
+    """Mémoire résidente actuelle du processus (Mo), ou à défaut son pic."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def load_benchmark_batch(run_id, rows=BENCHMARK_ROWS, velocity=False):
+    """
+    Lot de référence : les 'rows' transactions les plus récentes du jeu de test du run
+    d'entraînement 'run_id' (lignes écartées par train_test_split, jamais vues par le
+    candidat), mises au format de l'API (colonnes texte), avec leur étiquette is_fraud.
+    Les variables de vélocité sont rejouées dans l'ordre chronologique, sur toutes les
+    transactions depuis la première du lot, si un modèle les utilise.
+    """
+    extra = ['cc_num', 'unix_time', 'merch_lat', 'merch_long'] if velocity else []
+    df = load_training_data(MODEL_COLUMNS + extra)
+    positions = load_holdout(mlflow.artifacts.download_artifacts(run_id=run_id, artifact_path=HOLDOUT_ARTIFACT_PATH), df)
+    positions = positions[-rows:]
+    df = df.iloc[positions[0]:].reset_index(drop=True)
+    if velocity:
+        df[VELOCITY_FEATURES] = VelocityFeatureStore(max_cards=df['cc_num'].nunique()).update(df)
+    df = df.iloc[positions - positions[0]].reset_index(drop=True)
+    for column in ['category', 'merchant', 'gender']:
+        df[column] = df[column].astype(str).astype(object)
+    df['current_time'] = df['current_time'].dt.strftime("%Y-%m-%d %H:%M:%S")
+    return df
+
+def model_footprint(loaded):
+    """Taille du modèle sérialisé (Mo) et nombre de tours de boosting, pour un modèle XGBoost natif."""
+    if loaded.engine is None:
+        return {}
+    booster = loaded.engine.booster
+    return {"model_mb": len(booster.save_raw("ubj")) / 2**20, "rounds": booster.num_boosted_rounds()}
+
+def measure_latency(models, df, batch_sizes, repeat):
+    """
+    Latence de scoring de chaque modèle, lot par lot : les modèles sont mesurés en
+    alternance sur les mêmes tranches du lot de référence, ce qui répartit entre eux
+    les variations de charge de la machine. Retourne {nom: {taille: [secondes]}}.
+    """
+    durations = {name: {size: [] for size in batch_sizes} for name in models}
+    for size in batch_sizes:
+        for i in range(repeat):
+            start_row = (i * size) % max(len(df) - size, 1)
+            batch = df.iloc[start_row:start_row + size]
+            for name, loaded in models.items():
+                start = time.perf_counter()
+                score_frame(loaded, batch)
+                durations[name][size].append(time.perf_counter() - start)
+    return durations
+
+def summarize(durations, batch_sizes):
+    """p50 / p99 (ms) et débit (lignes/s, à la médiane) pour chaque taille de lot."""
+    summary = {}
+    for size in batch_sizes:
+        values = np.asarray(durations[size])
+        summary[size] = {
+            "p50_ms": float(np.percentile(values, 50) * 1000),
+            "p99_ms": float(np.percentile(values, 99) * 1000),
+            "rows_per_s": float(size / np.median(values)),
+        }
+    return summary
+
+def run_benchmark(candidate_version, champion_version=None, batch_sizes=BENCHMARK_BATCH_SIZES, repeat=BENCHMARK_REPEAT):
     """
-    Passe la dernière version du modèle dans le stage "Production".
+    Charge le candidat (et le modèle en production), puis mesure pour chacun latence,
+    débit, empreinte mémoire et F1 sur le lot de référence (jeu de test du candidat : le
+    modèle en production a pu s'entraîner sur ces lignes, la comparaison reste prudente).
+    Retourne {rôle: résultats}.
     """
+    versions = {"candidate": candidate_version}
+    if champion_version is not None:
+        versions["champion"] = champion_version
+
+    models, results = {}, {}
+    for role, model_version in versions.items():
+        rss_before = current_rss_mb()
+        models[role] = load_model_version(model_version)
+        results[role] = {"version": str(model_version.version), "rss_load_mb": current_rss_mb() - rss_before}
+        results[role].update(model_footprint(models[role]))
+
+    velocity = any(loaded.engine is not None and len(loaded.engine.feature_names) > len(FEATURE_COLUMNS) for loaded in models.values())
+    df = load_benchmark_batch(candidate_version.run_id, velocity=velocity)
+    batch_sizes = [size for size in batch_sizes if size <= len(df)]
+
+    for role, loaded in models.items():
+        predictions, _ = score_frame(loaded, df)  # Préchauffage, puis qualité sur tout le lot
+        results[role]["f1"] = float(f1_score(df['is_fraud'], predictions, zero_division=0))
+
+    durations = measure_latency(models, df, batch_sizes, repeat)
+    for role in models:
+        results[role]["latency"] = summarize(durations[role], batch_sizes)
+        print(f"📊 {role} (version {results[role]['version']}) : F1 {results[role]['f1']:.4f}, "
+              f"modèle {results[role].get('model_mb', float('nan')):.2f} Mo, {results[role].get('rounds', '?')} tours de boosting")
+        for size, stats in results[role]["latency"].items():
+            print(f"📊   lot {size:>6} : p50 {stats['p50_ms']:8.2f} ms | p99 {stats['p99_ms']:8.2f} ms | {stats['rows_per_s']:>12,.0f} lignes/s")
+    return results
+
+def check_budget(results):
+    """Liste des dépassements du budget par le candidat (vide si la promotion est autorisée)."""
+    candidate, champion = results["candidate"], results.get("champion")
+    violations = []
+    latency = candidate["latency"]
+    if MAX_P99_MS and BUDGET_BATCH_SIZE in latency and latency[BUDGET_BATCH_SIZE]["p99_ms"] > MAX_P99_MS:
+        violations.append(f"p99 {latency[BUDGET_BATCH_SIZE]['p99_ms']:.1f} ms au lot de {BUDGET_BATCH_SIZE} > budget {MAX_P99_MS:.1f} ms")
+    if MIN_F1 and candidate["f1"] < MIN_F1:
+        violations.append(f"F1 {candidate['f1']:.4f} < minimum {MIN_F1:.4f}")
+    if champion is None:
+        return violations
+
+    for size, stats in latency.items():
+        reference = champion["latency"][size]["p99_ms"]
+        if MAX_LATENCY_RATIO and stats["p99_ms"] > MAX_LATENCY_RATIO * reference:
+            violations.append(f"p99 au lot de {size} : {stats['p99_ms']:.2f} ms > {MAX_LATENCY_RATIO} x {reference:.2f} ms (production)")
+    largest = max(latency)
+    reference = champion["latency"][largest]["rows_per_s"]
+    if MIN_THROUGHPUT_RATIO and latency[largest]["rows_per_s"] < MIN_THROUGHPUT_RATIO * reference:
+        violations.append(f"débit au lot de {largest} : {latency[largest]['rows_per_s']:,.0f} lignes/s < {MIN_THROUGHPUT_RATIO} x {reference:,.0f} (production)")
+    if MAX_MEMORY_RATIO and "model_mb" in candidate and "model_mb" in champion \
+            and candidate["model_mb"] > MAX_MEMORY_RATIO * champion["model_mb"]:
+        violations.append(f"modèle de {candidate['model_mb']:.2f} Mo > {MAX_MEMORY_RATIO} x {champion['model_mb']:.2f} Mo (production)")
+    if MAX_F1_DROP and candidate["f1"] < champion["f1"] - MAX_F1_DROP:
+        violations.append(f"F1 {candidate['f1']:.4f} < {champion['f1']:.4f} (production) - {MAX_F1_DROP}")
+    return violations
+
+def log_gate_run(results, violations):
+    """Enregistre les mesures et la décision dans un run MLflow de l'expérience GATE_EXPERIMENT."""
+    mlflow.set_experiment(GATE_EXPERIMENT)
+    with mlflow.start_run(run_name=f"gate_v{results['candidate']['version']}") as run:
+        mlflow.log_params({f"{role}_version": result["version"] for role, result in results.items()})
+        mlflow.log_params({
+            "benchmark_rows": BENCHMARK_ROWS, "repeat": BENCHMARK_REPEAT,
+            "max_latency_ratio": MAX_LATENCY_RATIO, "min_throughput_ratio": MIN_THROUGHPUT_RATIO,
+            "max_memory_ratio": MAX_MEMORY_RATIO, "max_f1_drop": MAX_F1_DROP,
+            "max_p99_ms": MAX_P99_MS, "min_f1": MIN_F1,
+        })
+        for role, result in results.items():
+            metrics = {f"{role}_{key}": value for key, value in result.items() if isinstance(value, (int, float))}
+            for size, stats in result["latency"].items():
+                metrics.update({f"{role}_{key}_b{size}": value for key, value in stats.items()})
+            mlflow.log_metrics(metrics)
+        mlflow.log_metric("gate_passed", int(not violations))
+        mlflow.set_tag("gate_violations", "; ".join(violations) or "aucun")
+        mlflow.log_dict({"results": results, "violations": violations}, "performance_gate.json")
+        return run.info.run_id
+
+def run_performance_gate(client, candidate, champion=None):
+    """Mesure le candidat contre le modèle en production. Retourne True si la promotion est autorisée."""
+    print(f"⏳ Porte de performance : candidat version '{candidate.version}', "
+          f"production : {f'version {champion.version}' if champion else 'aucune'}...")
+    results = run_benchmark(candidate, champion)
+    violations = check_budget(results)
+    run_id = log_gate_run(results, violations)
+    client.set_model_version_tag(MODEL_NAME, candidate.version, "performance_gate", "passed" if not violations else "blocked")
+    client.set_model_version_tag(MODEL_NAME, candidate.version, "performance_gate_run", run_id)
+    for violation in violations:
+        print(f"❌ Budget dépassé : {violation}")
+    return not violations
+
+def deploy_model(skip_gate=False):
+    """
+    Passe la dernière version du modèle dans le stage "Production", après la porte de
+    performance (latence, débit, mémoire, F1 contre la version en production).
+    Retourne True si la version a été promue.
+    """
+    mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
     client = MlflowClient(tracking_uri=MLFLOW_TRACKING_URI)
 
     # Récupère la dernière version du modèle
@@ -21,12 +214,36 @@ def deploy_model():
         versions = client.get_latest_versions(MODEL_NAME)
         if not versions:
             print(f"Erreur : Aucune version trouvée pour le modèle '{MODEL_NAME}'. Avez-vous exécuté le script d'entraînement ?")
-            return
-        latest_version = versions[0].version
+            return False
+        # Version la plus récente hors archives (une version archivée n'est pas candidate)
+        candidates = [version for version in versions if version.current_stage != "Archived"]
+        if not candidates:
+            print(f"Erreur : Aucune version candidate (non archivée) pour le modèle '{MODEL_NAME}'.")
+            return False
+        candidate = max(candidates, key=lambda version: int(version.version))
+        latest_version = candidate.version
         print(f"✅ Dernière version trouvée pour le modèle '{MODEL_NAME}': version '{latest_version}'.")
+        champions = client.get_latest_versions(MODEL_NAME, stages=[MODEL_STAGE])
+        champion = champions[0] if champions else None
     except Exception as e:
         print(f"Erreur lors de la récupération de la dernière version du modèle : {e}")
-        return
+        return False
+
+    if champion is not None and str(champion.version) == str(latest_version):
+        print(f"✅ La version '{latest_version}' est déjà dans le stage '{MODEL_STAGE}'.")
+        return True
+
+    if skip_gate:
+        print("⚠️ Porte de performance ignorée (--skip-gate).")
+    else:
+        try:
+            if not run_performance_gate(client, candidate, champion):
+                print(f"❌ Promotion de la version '{latest_version}' bloquée par la porte de performance.")
+                return False
+        except Exception as e:
+            print(f"Erreur lors de la porte de performance, promotion annulée : {e}")
+            return False
+        print("✅ Porte de performance franchie.")
 
     # Passe la version du modèle au stage "Production"
     print(f"⏳ Tentative de passage de la version '{latest_version}' au stage '{MODEL_STAGE}'...")
@@ -37,8 +254,13 @@ def deploy_model():
             stage=MODEL_STAGE,
         )
         print(f"✅ Modèle '{MODEL_NAME}' version '{latest_version}' est maintenant dans le stage '{MODEL_STAGE}' avec succès.")
+        return True
     except Exception as e:
         print(f"Erreur lors du changement de stage du modèle : {e}")
+        return False
 
 if __name__ == "__main__":
-    deploy_model()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Promotion de la dernière version du modèle en production, après porte de performance")
+    parser.add_argument("--skip-gate", action="store_true", help="Promeut sans mesurer le candidat")
+    args = parser.parse_args()
+    sys.exit(0 if deploy_model(skip_gate=args.skip_gate) else 1)
@@ -0,0 +1,269 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Variables de vélocité calculées pour chaque transaction (fenêtres incluant la transaction courante)
+VELOCITY_FEATURES = ['tx_count_1h', 'amt_sum_1h', 'tx_count_24h', 'amt_sum_24h', 'seconds_since_last', 'km_from_last']
+
+HOUR = 3600
+DAY = 24 * HOUR
+EARTH_RADIUS_KM = 6371.0
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    """Distance orthodromique (km) entre deux points (degrés), sur des scalaires ou des tableaux NumPy."""
+    lat1, long1, lat2, long2 = map(np.radians, (lat1, long1, lat2, long2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class VelocityFeatureStore:
+    """
+    Magasin de variables en ligne, par carte (cc_num), à mémoire bornée.
+
+    Chaque carte occupe un emplacement dans des tableaux NumPy préalloués : un tampon
+    circulaire des 'history' derniers montants et horodatages, plus la dernière position
+    (merch_lat / merch_long) et le dernier horodatage. Le calcul des variables d'une
+    transaction parcourt au plus 'history' valeurs : coût O(1) par transaction, vectorisé
+    sur l'ensemble du lot (seul l'ordre des transactions d'une même carte compte).
+    Au-delà de 'max_cards' cartes, l'emplacement de la carte la moins récemment vue est
+    réutilisé (éviction LRU). L'état peut être sauvegardé sur disque et restauré au démarrage.
+    """
+
+    def __init__(self, max_cards=1_000_000, history=32):
+        self.max_cards = max_cards
+        self.history = history
+        # np.zeros s'appuie sur calloc : la mémoire n'est réellement occupée qu'à l'usage
+        self._times = np.zeros((max_cards, history), dtype=np.float64)
+        self._amounts = np.zeros((max_cards, history), dtype=np.float32)
+        self._head = np.zeros(max_cards, dtype=np.int16)
+        self._filled = np.zeros(max_cards, dtype=np.int16)
+        self._last_time = np.zeros(max_cards, dtype=np.float64)
+        self._last_location = np.zeros((max_cards, 2), dtype=np.float32)
+        self._slots = OrderedDict()  # cc_num -> emplacement, de la moins à la plus récemment vue
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _assign_slots(self, cards):
+        """
+        Emplacements des cartes distinctes d'un lot, toutes marquées comme les plus récemment vues
+        (dans l'ordre donné). Les cartes déjà suivies sont traitées d'abord : les nouvelles ne
+        recyclent que des emplacements de cartes absentes du lot.
+        """
+        slots = np.empty(len(cards), dtype=np.int64)
+        new = []
+        for j, card in enumerate(cards.tolist()):
+            slot = self._slots.get(card)
+            if slot is None:
+                new.append(j)
+            else:
+                self._slots.move_to_end(card)
+                slots[j] = slot
+        for j in new:
+            if len(self._slots) < self.max_cards:
+                slot = len(self._slots)
+            else:
+                _, slot = self._slots.popitem(last=False)
+                self.evictions += 1
+            self._slots[cards[j].item()] = slot
+            slots[j] = slot
+        self._filled[slots[new]] = 0
+        self._head[slots[new]] = 0
+        return slots
+
+    def update(self, df):
+        """
+        Intègre un lot de transactions (dans l'ordre de unix_time) et retourne, pour chaque
+        transaction, les variables de vélocité calculées au moment où elle survient.
+        Une transaction antérieure à la dernière vue pour sa carte (flux qui renvoie d'anciennes
+        transactions) reçoit ses variables mais ne modifie pas l'état de la carte. Une transaction
+        déjà intégrée (même carte, même horodatage, même montant : lot relivré après un échec)
+        ne la modifie pas non plus et retrouve les fenêtres calculées à sa première réception.
+        """
+        n = len(df)
+        features = np.full((n, len(VELOCITY_FEATURES)), np.nan, dtype=np.float64)
+        if n == 0:
+            return pd.DataFrame(features, index=df.index, columns=VELOCITY_FEATURES)
+
+        order = np.argsort(df['unix_time'].to_numpy(dtype=np.float64), kind='stable')
+        if len(np.unique(df['cc_num'].to_numpy())) > self.max_cards:
+            # Plus de cartes distinctes que d'emplacements : lot intégré en morceaux successifs
+            for start in range(0, n, self.max_cards):
+                rows = order[start:start + self.max_cards]
+                features[rows] = self.update(df.iloc[rows]).to_numpy()
+        else:
+            features[order] = self._update_sorted(
+                df['cc_num'].to_numpy()[order],
+                df['unix_time'].to_numpy(dtype=np.float64)[order],
+                df['amt'].to_numpy(dtype=np.float64)[order],
+                df['merch_lat'].to_numpy(dtype=np.float64)[order],
+                df['merch_long'].to_numpy(dtype=np.float64)[order],
+            )
+        return pd.DataFrame(features, index=df.index, columns=VELOCITY_FEATURES)
+
+    def _update_sorted(self, cards, t, amounts, lats, longs):
+        """
+        Calcul vectorisé sur toutes les cartes d'un lot trié par date. Pour chaque carte, ses
+        événements (historique en mémoire puis transactions acceptées du lot) sont rangés
+        chronologiquement dans un tableau plat ; les fenêtres de chaque transaction portent
+        sur les 'history' événements qui la précèdent, parcourus par décalage (au plus
+        'history' opérations vectorielles). Seule la mise à jour de l'ordre LRU reste une
+        boucle Python, par carte distincte et non par transaction.
+        """
+        n, H = len(t), self.history
+        features = np.full((n, len(VELOCITY_FEATURES)), np.nan, dtype=np.float64)
+
+        # Cartes distinctes ('group' : indice de la carte de chaque transaction), touchées
+        # dans l'ordre de leur dernière transaction, comme une mise à jour ligne à ligne
+        unique, group = np.unique(cards, return_inverse=True)
+        last_seen = n - 1 - np.unique(cards[::-1], return_index=True)[1]
+        touch = np.argsort(last_seen, kind='stable')
+        slots = np.empty(len(unique), dtype=np.int64)
+        slots[touch] = self._assign_slots(unique[touch])
+
+        filled = self._filled[slots].astype(np.int64)
+        head = self._head[slots].astype(np.int64)
+        last_time = self._last_time[slots]
+        columns = np.arange(H)
+        stored = columns < filled[:, None]
+        ring = (head[:, None] - filled[:, None] + columns) % H
+        stored_times = self._times[slots[:, None], ring]
+        stored_amounts = self._amounts[slots[:, None], ring]
+
+        # Transactions déjà intégrées : un événement en mémoire a le même horodatage et le même
+        # montant (seules celles qui ne sont pas postérieures à l'état de leur carte sont comparées)
+        candidates = np.flatnonzero((filled[group] > 0) & (t <= last_time[group]))
+        match = (stored[group[candidates]]
+                 & (stored_times[group[candidates]] == t[candidates, None])
+                 & (stored_amounts[group[candidates]] == amounts[candidates, None].astype(np.float32)))
+        seen = np.zeros(n, dtype=bool)
+        seen[candidates] = match.any(axis=1)
+        seen_column = match.argmax(axis=1)[seen[candidates]]
+
+        # Transactions en retard sur l'état de leur carte ou déjà intégrées : calculées, sans mise à jour de l'état
+        accepted = ((filled[group] == 0) | (t >= last_time[group])) & ~seen
+        accepted_count = np.bincount(group[accepted], minlength=len(unique))
+        total = filled + accepted_count
+        starts = np.concatenate(([0], np.cumsum(total)[:-1]))
+
+        # Événements de chaque carte : historique (ordre chronologique du tampon circulaire)...
+        event_times = np.zeros(max(int(total.sum()), 1), dtype=np.float64)
+        event_amounts = np.zeros_like(event_times, dtype=np.float32)
+        event_locations = np.zeros((len(event_times), 2), dtype=np.float32)
+        positions = (starts[:, None] + columns)[stored]
+        event_times[positions] = stored_times[stored]
+        event_amounts[positions] = stored_amounts[stored]
+
+        # ... puis transactions acceptées du lot, dans l'ordre (rang au sein de la carte)
+        accepted_rows = np.flatnonzero(accepted)
+        accepted_group = group[accepted_rows]
+        by_group = np.argsort(accepted_group, kind='stable')
+        rank = np.empty(len(accepted_rows), dtype=np.int64)
+        rank[by_group] = np.arange(len(accepted_rows)) - np.concatenate(([0], np.cumsum(accepted_count)[:-1]))[accepted_group[by_group]]
+        accepted_positions = starts[accepted_group] + filled[accepted_group] + rank
+        event_times[accepted_positions] = t[accepted_rows]
+        event_amounts[accepted_positions] = amounts[accepted_rows]
+        event_locations[accepted_positions, 0] = lats[accepted_rows]
+        event_locations[accepted_positions, 1] = longs[accepted_rows]
+
+        # Fenêtres 1 h / 24 h : transaction courante + événements antérieurs (âge >= 0) des 'history' précédents
+        end = starts[group] + filled[group]
+        end[accepted_rows] = accepted_positions
+        # Transaction déjà intégrée : fenêtres arrêtées à son propre événement, comme à sa première réception
+        seen_rows = np.flatnonzero(seen)
+        end[seen_rows] = starts[group[seen_rows]] + seen_column
+        first = starts[group]
+        count_hour, count_day = np.ones(n), np.ones(n)
+        sum_hour, sum_day = amounts.copy(), amounts.copy()
+        for lag in range(1, H + 1):
+            index = end - lag
+            valid = index >= first
+            if not valid.any():
+                break
+            index[~valid] = 0
+            age = t - event_times[index]
+            in_day = valid & (age >= 0) & (age < DAY)
+            in_hour = in_day & (age < HOUR)
+            recent = event_amounts[index]
+            count_day += in_day
+            count_hour += in_hour
+            sum_day += np.where(in_day, recent, 0.0)
+            sum_hour += np.where(in_hour, recent, 0.0)
+        features[:, 0], features[:, 1], features[:, 2], features[:, 3] = count_hour, sum_hour, count_day, sum_day
+
+        # Délai et distance depuis la transaction précédente de la carte (lot ou état en mémoire)
+        previous_time = np.full(len(accepted_rows), np.nan)
+        previous_location = np.full((len(accepted_rows), 2), np.nan)
+        in_batch = rank > 0
+        previous_time[in_batch] = event_times[accepted_positions[in_batch] - 1]
+        previous_location[in_batch] = event_locations[accepted_positions[in_batch] - 1]
+        from_state = (rank == 0) & (filled[accepted_group] > 0)
+        previous_time[from_state] = last_time[accepted_group[from_state]]
+        previous_location[from_state] = self._last_location[slots[accepted_group[from_state]]]
+        features[accepted_rows, 4] = t[accepted_rows] - previous_time
+        features[accepted_rows, 5] = haversine_km(previous_location[:, 0], previous_location[:, 1],
+                                                  lats[accepted_rows], longs[accepted_rows])
+        # Délai depuis l'événement qui précède une transaction déjà intégrée (position non conservée)
+        has_previous = seen_column > 0
+        features[seen_rows[has_previous], 4] = t[seen_rows[has_previous]] - event_times[end[seen_rows[has_previous]] - 1]
+
+        # Nouvel état des cartes ayant des transactions acceptées : 'history' derniers événements
+        updated = np.flatnonzero(accepted_count)
+        kept = np.minimum(total[updated], H)
+        source = starts[updated, None] + (total[updated] - kept)[:, None] + columns
+        in_ring = columns < kept[:, None]
+        source[~in_ring] = 0
+        rows = slots[updated]
+        self._times[rows] = np.where(in_ring, event_times[source], 0.0)
+        self._amounts[rows] = np.where(in_ring, event_amounts[source], 0.0)
+        self._head[rows] = kept % H
+        self._filled[rows] = kept
+        latest = starts[updated] + total[updated] - 1
+        self._last_time[rows] = event_times[latest]
+        self._last_location[rows] = event_locations[latest]
+        return features
+
+    def save(self, path):
+        """Sauvegarde l'état des cartes suivies (écriture atomique via un fichier temporaire)."""
+        start = time.perf_counter()
+        cards = np.array(list(self._slots.keys()), dtype=np.int64)
+        slots = np.array(list(self._slots.values()), dtype=np.int64)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            history=self.history,
+            cards=cards,
+            times=self._times[slots],
+            amounts=self._amounts[slots],
+            head=self._head[slots],
+            filled=self._filled[slots],
+            last_time=self._last_time[slots],
+            last_location=self._last_location[slots],
+        )
+        os.replace(tmp_path, path)
+        logging.info(f"✅ Magasin de variables sauvegardé : {len(cards)} cartes en {time.perf_counter() - start:.2f} s.")
+
+    @classmethod
+    def load(cls, path, max_cards=1_000_000):
+        """Restaure un magasin sauvegardé par save() (ordre LRU conservé)."""
+        start = time.perf_counter()
+        with np.load(path) as snapshot:
+            cards = snapshot['cards'][-max_cards:]
+            store = cls(max_cards=max_cards, history=int(snapshot['history']))
+            n = len(cards)
+            store._times[:n] = snapshot['times'][-n:]
+            store._amounts[:n] = snapshot['amounts'][-n:]
+            store._head[:n] = snapshot['head'][-n:]
+            store._filled[:n] = snapshot['filled'][-n:]
+            store._last_time[:n] = snapshot['last_time'][-n:]
+            store._last_location[:n] = snapshot['last_location'][-n:]
+        store._slots = OrderedDict((int(card), slot) for slot, card in enumerate(cards))
+        logging.info(f"✅ Magasin de variables restauré : {n} cartes en {time.perf_counter() - start:.2f} s.")
+        return store
@@ -0,0 +1,195 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from feature_store import VELOCITY_FEATURES
+
+# Colonnes attendues par le modèle, dans l'ordre d'entraînement
+FEATURE_COLUMNS = ['category', 'amt', 'gender', 'city_pop', 'merchant_encoded', 'hour', 'dayofweek']
+# Seuil de décision appliqué aux probabilités de fraude
+FRAUD_THRESHOLD = float(os.environ.get("FRAUD_THRESHOLD", 0.5))
+# Nombre de threads XGBoost pour l'inférence (0 = tous les cœurs)
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", 0))
+
+BENCHMARK_BATCH_SIZES = [1, 10, 100, 1000, 10000, 100000]
+
+
+def build_feature_matrix(df, encoder, feature_names=FEATURE_COLUMNS):
+    """
+    Construit directement la matrice float32 contiguë (n, 7) attendue par le booster,
+    sans DataFrame intermédiaire. Mêmes transformations que preprocess_data du service.
+    Les variables de vélocité éventuellement attendues en plus ('feature_names') sont
+    reprises telles quelles du DataFrame (NaN si absentes).
+    """
+    n = len(df)
+    X = np.empty((n, len(feature_names)), dtype=np.float32)
+    timestamps = pd.to_datetime(df['current_time'])
+    if encoder is not None:
+        X[:, 0] = encoder.encode(df['category'], 'category')
+        X[:, 4] = encoder.encode(df['merchant'], 'merchant')
+    else:
+        X[:, 0] = df['category'].astype('category').cat.codes
+        X[:, 4] = df['merchant'].astype('category').cat.codes
+    X[:, 1] = df['amt'].to_numpy(dtype=np.float32)
+    if 'gender' in df.columns:
+        X[:, 2] = df['gender'].map({'F': 0, 'M': 1}).fillna(-1).to_numpy(dtype=np.float32)
+    else:
+        X[:, 2] = -1
+    X[:, 3] = df['city_pop'].to_numpy(dtype=np.float32)
+    X[:, 5] = timestamps.dt.hour.to_numpy(dtype=np.float32)
+    X[:, 6] = timestamps.dt.dayofweek.to_numpy(dtype=np.float32)
+    for j, column in enumerate(feature_names[len(FEATURE_COLUMNS):], start=len(FEATURE_COLUMNS)):
+        X[:, j] = df[column].to_numpy(dtype=np.float32) if column in df.columns else np.nan
+    return X
+
+
+def extract_booster(model):
+    """
+    Extrait le Booster XGBoost d'un modèle pyfunc MLflow (saveur sklearn ou xgboost),
+    d'un XGBClassifier ou d'un Booster. Retourne None si le modèle n'est pas un modèle XGBoost.
+    """
+    raw = model
+    impl = getattr(model, "_model_impl", None)
+    if impl is not None:
+        raw = impl.get_raw_model() if hasattr(impl, "get_raw_model") else getattr(impl, "sklearn_model", impl)
+    if isinstance(raw, xgb.Booster):
+        return raw
+    if hasattr(raw, "get_booster"):
+        return raw.get_booster()
+    return None
+
+
+class InferenceEngine:
+    """
+    Inférence native XGBoost : prédiction en place (inplace_predict) sur une matrice
+    float32 contiguë, sans passer par mlflow.pyfunc, le wrapper sklearn ni pandas.
+    Le modèle peut attendre, après les 7 colonnes de base, des variables de vélocité
+    (VELOCITY_FEATURES) : elles sont listées dans 'feature_names'.
+    """
+
+    def __init__(self, booster, threshold=FRAUD_THRESHOLD, nthread=INFERENCE_THREADS):
+        feature_names = list(booster.feature_names or FEATURE_COLUMNS)
+        extra = feature_names[len(FEATURE_COLUMNS):]
+        if feature_names[:len(FEATURE_COLUMNS)] != FEATURE_COLUMNS or not set(extra) <= set(VELOCITY_FEATURES):
+            raise ValueError(f"Colonnes du modèle inattendues : {booster.feature_names}")
+        self.feature_names = feature_names
+        self.booster = booster
+        self.threshold = threshold
+        if nthread:
+            self.booster.set_param({"nthread": nthread})
+
+    @classmethod
+    def from_model(cls, model, **kwargs):
+        """Construit le moteur à partir d'un modèle chargé, ou retourne None si impossible."""
+        booster = extract_booster(model)
+        return cls(booster, **kwargs) if booster is not None else None
+
+    def predict_proba(self, X):
+        """Probabilités de fraude pour une matrice float32 (n, len(feature_names))."""
+        if len(X) == 0:
+            return np.empty(0, dtype=np.float32)
+        return self.booster.inplace_predict(X, validate_features=False)
+
+    def predict(self, X):
+        """Retourne (décisions 0/1, probabilités) selon le seuil configuré."""
+        proba = self.predict_proba(X)
+        return (proba >= self.threshold).astype(np.int8), proba
+
+
+def score_frame(loaded, df):
+    """
+    Décisions et probabilités d'un lot pour un modèle chargé (LoadedModel de model_watcher) :
+    chemin natif si possible, sinon preprocess_data du service et modèle pyfunc
+    (probabilités absentes, NaN). Partagé par le rescoring et la porte de performance.
+    """
+    if loaded.engine is not None:
+        return loaded.engine.predict(build_feature_matrix(df, loaded.encoder, loaded.engine.feature_names))
+    from realtime_prediction_service import preprocess_data
+
+    predictions = np.asarray(loaded.model.predict(preprocess_data(df.copy(), loaded.encoder)))
+    return predictions.astype(np.int8), np.full(len(df), np.nan, dtype=np.float32)
+
+
+def synthetic_transactions(n, encoder, seed=42):
+    """Transactions brutes aléatoires au format de l'API, construites à partir du vocabulaire de l'encodeur."""
+    rng = np.random.default_rng(seed)
+    categories = encoder.vocabularies['category'] if encoder else ['misc_net', 'grocery_pos']
+    merchants = encoder.vocabularies['merchant'] if encoder else ['fraud_Kirlin and Sons']
+    start = pd.Timestamp("2024-01-01").value // 10**9
+    return pd.DataFrame({
+        'current_time': pd.to_datetime(rng.integers(start, start + 30 * 86400, n), unit='s'),
+        'category': rng.choice(categories, n),
+        'merchant': rng.choice(merchants, n),
+        'amt': rng.gamma(2.0, 40.0, n).round(2),
+        'gender': rng.choice(['F', 'M'], n),
+        'city_pop': rng.integers(100, 3_000_000, n),
+    })
+
+
+def time_call(function, repeat):
+    """Durée médiane (secondes) de 'repeat' appels."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations))
+
+
+def run_benchmark(loaded, batch_sizes=BENCHMARK_BATCH_SIZES, repeat=5):
+    """
+    Compare le chemin actuel (preprocess_data + model.predict) et le chemin natif
+    (build_feature_matrix + InferenceEngine.predict) pour chaque taille de lot,
+    en vérifiant que les décisions sont identiques. Retourne la liste des résultats.
+    """
+    from realtime_prediction_service import preprocess_data
+
+    engine = InferenceEngine.from_model(loaded.model)
+    if engine is None:
+        raise ValueError("Le modèle n'est pas un modèle XGBoost : pas de chemin natif possible.")
+
+    results = []
+    for size in batch_sizes:
+        df = synthetic_transactions(size, loaded.encoder)
+        pyfunc_predictions = loaded.model.predict(preprocess_data(df.copy(), loaded.encoder, engine.feature_names[len(FEATURE_COLUMNS):]))
+        native_predictions, _ = engine.predict(build_feature_matrix(df, loaded.encoder, engine.feature_names))
+        mismatches = int((np.asarray(pyfunc_predictions).astype(int) != native_predictions).sum())
+
+        pyfunc_seconds = time_call(lambda: loaded.model.predict(preprocess_data(df.copy(), loaded.encoder, engine.feature_names[len(FEATURE_COLUMNS):])), repeat)
+        native_seconds = time_call(lambda: engine.predict(build_feature_matrix(df, loaded.encoder, engine.feature_names)), repeat)
+        results.append({
+            "batch_size": size,
+            "pyfunc_ms": pyfunc_seconds * 1000,
+            "native_ms": native_seconds * 1000,
+            "speedup": pyfunc_seconds / native_seconds,
+            "native_rows_per_s": size / native_seconds,
+            "mismatches": mismatches,
+        })
+        logging.info(
+            f"📊 lot {size:>6} : pyfunc {pyfunc_seconds * 1000:9.2f} ms | natif {native_seconds * 1000:9.2f} ms "
+            f"| x{pyfunc_seconds / native_seconds:5.1f} | {size / native_seconds:,.0f} lignes/s | écarts {mismatches}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    from model_watcher import ModelWatcher
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark du chemin d'inférence natif XGBoost contre mlflow.pyfunc")
+    parser.add_argument("--model-name", default="XGBoost_Fraud_Model_Prod")
+    parser.add_argument("--stage", default="Production")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BENCHMARK_BATCH_SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    loaded = ModelWatcher(args.model_name, args.stage).load_initial()
+    if loaded is None:
+        logging.error("Aucun modèle chargé, benchmark impossible.")
+    else:
+        run_benchmark(loaded, args.batch_sizes, args.repeat)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Index du cache : versions connues de chaque modèle et dernière version vue dans chaque stage
+INDEX_FILE = "index.json"
+OBJECTS_DIR = "objects"  # Un répertoire par contenu, nommé par son empreinte SHA-256
+READ_BLOCK = 1 << 20
+
+
+def directory_checksum(path):
+    """Empreinte SHA-256 d'un répertoire : chemins relatifs triés et contenu de chaque fichier."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            digest.update(os.path.relpath(full_path, path).encode() + b"\0")
+            with open(full_path, "rb") as f:
+                for block in iter(lambda: f.read(READ_BLOCK), b""):
+                    digest.update(block)
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ModelArtifactCache:
+    """
+    Cache local des artefacts de modèles, adressé par contenu.
+
+    Chaque version téléchargée est rangée dans objects/<sha256>/, l'empreinte étant
+    calculée sur tout son contenu ; l'index (index.json) associe à chaque (modèle, version)
+    son empreinte, et à chaque (modèle, stage) la dernière version vue dans le registre.
+    Une version du registre étant immuable, le couple (version, empreinte) suffit : une
+    entrée n'est jamais retéléchargée. L'empreinte de l'index fait foi à la recherche ; le
+    contenu n'est relu qu'à la demande (verify, ex: quand le chargement de l'entrée échoue)
+    et une entrée corrompue (disque abîmé, copie interrompue) est alors supprimée.
+    Les écritures passent par un répertoire temporaire puis un renommage atomique.
+    """
+
+    def __init__(self, cache_dir, keep_versions=3):
+        self.cache_dir = cache_dir
+        self.keep_versions = keep_versions
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, OBJECTS_DIR), exist_ok=True)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"models": {}, "stages": {}}
+
+    def _write_index(self, index):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def staging_dir(self):
+        """Répertoire temporaire sur le même disque que le cache (renommage atomique ensuite)."""
+        return tempfile.mkdtemp(prefix=".staging-", dir=self.cache_dir)
+
+    def lookup(self, model_name, version):
+        """
+        Chemin de l'entrée d'une version, ou None si absente. Le contenu n'est pas relu
+        (voir verify) ; l'index n'est réécrit que si la version n'était pas déjà la plus
+        récemment utilisée du modèle (ordre d'éviction inchangé sinon).
+        """
+        with self._lock:
+            index = self._read_index()
+            versions = index["models"].get(model_name, {})
+            entry = versions.get(str(version))
+            if entry is None:
+                return None
+            path = os.path.join(self.cache_dir, OBJECTS_DIR, entry["checksum"])
+            if not os.path.isdir(path):
+                self._forget(index, model_name, version, path)
+                return None
+            if any(other["used_at"] > entry["used_at"] for other in versions.values()):
+                entry["used_at"] = time.time()
+                self._write_index(index)
+            return path
+
+    def verify(self, model_name, version):
+        """
+        Relit le contenu de l'entrée d'une version et le compare à son empreinte.
+        Une entrée corrompue est supprimée. Retourne True si l'entrée est intacte.
+        """
+        with self._lock:
+            index = self._read_index()
+            entry = index["models"].get(model_name, {}).get(str(version))
+            if entry is None:
+                return False
+            path = os.path.join(self.cache_dir, OBJECTS_DIR, entry["checksum"])
+            if os.path.isdir(path) and directory_checksum(path) == entry["checksum"]:
+                return True
+            self._forget(index, model_name, version, path)
+            return False
+
+    def _forget(self, index, model_name, version, path):
+        """Supprime une entrée absente ou corrompue (contenu et index)."""
+        logging.warning(f"⚠️ Entrée du cache corrompue pour {model_name} version {version}, elle sera retéléchargée.")
+        shutil.rmtree(path, ignore_errors=True)
+        del index["models"][model_name][str(version)]
+        self._write_index(index)
+
+    def put(self, model_name, version, staging):
+        """Range le contenu de 'staging' sous son empreinte et l'enregistre pour la version."""
+        checksum = directory_checksum(staging)
+        path = os.path.join(self.cache_dir, OBJECTS_DIR, checksum)
+        with self._lock:
+            if os.path.isdir(path):
+                shutil.rmtree(staging)  # Contenu identique déjà présent
+            else:
+                os.rename(staging, path)
+            index = self._read_index()
+            index["models"].setdefault(model_name, {})[str(version)] = {"checksum": checksum, "used_at": time.time()}
+            self._prune(index, model_name)
+            self._write_index(index)
+        logging.info(f"✅ Modèle {model_name} version {version} mis en cache ({checksum[:12]}).")
+        return path
+
+    def _prune(self, index, model_name):
+        """Ne garde que les 'keep_versions' versions les plus récemment utilisées du modèle."""
+        versions = index["models"][model_name]
+        ordered = sorted(versions, key=lambda version: versions[version]["used_at"], reverse=True)
+        pinned = {version for key, version in index["stages"].items() if key.startswith(f"{model_name}/")}
+        for version in ordered[self.keep_versions:]:
+            if version in pinned:
+                continue
+            checksum = versions.pop(version)["checksum"]
+            if not any(entry["checksum"] == checksum for entries in index["models"].values() for entry in entries.values()):
+                shutil.rmtree(os.path.join(self.cache_dir, OBJECTS_DIR, checksum), ignore_errors=True)
+
+    def stage_version(self, model_name, stage):
+        """Dernière version vue dans le stage du registre, si elle est en cache."""
+        with self._lock:
+            index = self._read_index()
+        version = index["stages"].get(f"{model_name}/{stage}")
+        if version is None or version not in index["models"].get(model_name, {}):
+            return None
+        return version
+
+    def set_stage_version(self, model_name, stage, version):
+        """Mémorise la version actuellement dans le stage (point de départ du prochain démarrage)."""
+        with self._lock:
+            index = self._read_index()
+            key = f"{model_name}/{stage}"
+            if index["stages"].get(key) != str(version):
+                index["stages"][key] = str(version)
+                self._write_index(index)
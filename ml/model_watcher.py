@@ -0,0 +1,267 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import xgboost as xgb
+
+from categorical_encoder import CategoricalEncoder, ENCODER_ARTIFACT_PATH
+from inference_engine import InferenceEngine
+
+# mlflow n'est importé qu'au premier accès au registre ou au format pyfunc :
+# un démarrage depuis le cache local, en inférence native, s'en passe entièrement.
+
+# Modèle prêt à scorer : numéro de version, modèle pyfunc, encodeur catégoriel
+# et moteur d'inférence natif XGBoost (None si le modèle n'en permet pas).
+# Chargé depuis le cache en inférence native, le modèle pyfunc est absent (None).
+LoadedModel = namedtuple("LoadedModel", ["version", "model", "encoder", "engine"])
+# Version connue du seul cache local (démarrage sans registre) : ni source ni run
+CachedVersion = namedtuple("CachedVersion", ["name", "version"])
+
+# Contenu d'une entrée du cache : modèle MLflow complet, encodeur et Booster natif extrait
+MODEL_ARTIFACT_DIR = "model"
+BOOSTER_FILE = "booster.ubj"
+
+
+def load_encoder(run_id):
+    """
+    Charge l'encodeur catégoriel journalisé avec le modèle dans le run MLflow.
+    Retourne None pour les anciennes versions du modèle qui n'en ont pas.
+    """
+    import mlflow
+
+    try:
+        encoder_path = mlflow.artifacts.download_artifacts(run_id=run_id, artifact_path=ENCODER_ARTIFACT_PATH)
+        return CategoricalEncoder.load(encoder_path)
+    except Exception as e:
+        logging.warning(f"⚠️ Encodeur catégoriel introuvable pour le run {run_id}, encodage par lot utilisé : {e}")
+        return None
+
+
+def native_engine(model, version):
+    """Moteur d'inférence natif d'un modèle pyfunc ou d'un Booster, ou None si impossible."""
+    try:
+        if isinstance(model, xgb.Booster):
+            return InferenceEngine(model)
+        return InferenceEngine.from_model(model)
+    except Exception as e:
+        logging.warning(f"⚠️ Inférence native indisponible pour la version {version} : {e}")
+        return None
+
+
+def download_to_cache(model_version, cache):
+    """
+    Télécharge une version du registre (modèle, encodeur) et en extrait le Booster natif
+    dans une entrée du cache local. Retourne le chemin de l'entrée.
+    """
+    import mlflow
+    import mlflow.pyfunc
+    from inference_engine import extract_booster
+
+    logging.info(f"⏳ Téléchargement du modèle version {model_version.version} depuis : {model_version.source}")
+    staging = cache.staging_dir()
+    try:
+        model_path = mlflow.artifacts.download_artifacts(artifact_uri=model_version.source, dst_path=staging)
+        if os.path.abspath(model_path) != os.path.join(os.path.abspath(staging), MODEL_ARTIFACT_DIR):
+            os.rename(model_path, os.path.join(staging, MODEL_ARTIFACT_DIR))
+        try:
+            mlflow.artifacts.download_artifacts(run_id=model_version.run_id, artifact_path=ENCODER_ARTIFACT_PATH, dst_path=staging)
+        except Exception as e:
+            logging.warning(f"⚠️ Encodeur catégoriel introuvable pour le run {model_version.run_id} : {e}")
+        booster = extract_booster(mlflow.pyfunc.load_model(os.path.join(staging, MODEL_ARTIFACT_DIR)))
+        if booster is not None:
+            booster.save_model(os.path.join(staging, BOOSTER_FILE))
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return cache.put(model_version.name, model_version.version, staging)
+
+
+def load_cached_model(version, path, native_only=False):
+    """
+    Charge une version depuis son entrée du cache, sans réseau. En inférence native
+    ('native_only'), seul le Booster est désérialisé : ni mlflow ni le modèle pyfunc.
+    """
+    encoder_path = os.path.join(path, ENCODER_ARTIFACT_PATH)
+    encoder = CategoricalEncoder.load(encoder_path) if os.path.exists(encoder_path) else None
+    if encoder is None:
+        logging.warning(f"⚠️ Pas d'encodeur catégoriel pour la version {version}, encodage par lot utilisé.")
+    booster_path = os.path.join(path, BOOSTER_FILE)
+    if native_only and os.path.exists(booster_path):
+        engine = native_engine(xgb.Booster(model_file=booster_path), version)
+        if engine is not None:
+            return LoadedModel(version, None, encoder, engine)
+
+    import mlflow.pyfunc
+
+    model = mlflow.pyfunc.load_model(os.path.join(path, MODEL_ARTIFACT_DIR))
+    return LoadedModel(version, model, encoder, native_engine(model, version))
+
+
+def load_model_version(model_version, cache=None, native_only=False):
+    """
+    Désérialise une version du registre (modèle et encodeur). Avec un cache local
+    (ModelArtifactCache), la version n'est téléchargée qu'une fois puis chargée depuis le disque.
+    Si le chargement depuis le cache échoue, l'entrée est vérifiée : corrompue, elle est
+    supprimée et la version retéléchargée depuis le registre.
+    """
+    if cache is not None:
+        path = cache.lookup(model_version.name, model_version.version)
+        if path is None:
+            if isinstance(model_version, CachedVersion):
+                raise LookupError(f"Version {model_version.version} absente du cache local.")
+            path = download_to_cache(model_version, cache)
+        logging.info(f"⏳ Chargement du modèle version {model_version.version} depuis le cache local : {path}")
+        try:
+            return load_cached_model(model_version.version, path, native_only)
+        except Exception:
+            if cache.verify(model_version.name, model_version.version) or isinstance(model_version, CachedVersion):
+                raise
+        path = download_to_cache(model_version, cache)
+        return load_cached_model(model_version.version, path, native_only)
+
+    import mlflow.pyfunc
+
+    logging.info(f"⏳ Chargement du modèle version {model_version.version} depuis : {model_version.source}")
+    model = mlflow.pyfunc.load_model(model_version.source)
+    return LoadedModel(model_version.version, model, load_encoder(model_version.run_id), native_engine(model, model_version.version))
+
+
+class ModelWatcher:
+    """
+    Surveille le registre MLflow et recharge le modèle à chaud.
+
+    Un thread interroge périodiquement la version courante du stage surveillé. Une
+    nouvelle version est téléchargée, désérialisée et préchauffée (fonction 'warmup')
+    hors du chemin critique, puis publiée d'un seul coup : le service lit current()
+    au début de chaque lot, si bien qu'un lot en cours termine avec l'ancien modèle.
+    Les dernières versions chargées restent dans un cache LRU, ce qui rend un retour
+    arrière (rollback) instantané.
+
+    Avec un cache d'artefacts sur disque ('artifact_cache'), le démarrage reprend la
+    dernière version vue dans le stage sans interroger le registre ; la vérification
+    du registre est alors faite tout de suite, en arrière-plan, au lieu d'attendre
+    'poll_interval'. Une nouvelle version publiée entre-temps remplace donc la version
+    du cache en quelques secondes.
+    """
+
+    def __init__(self, model_name, stage, warmup=None, poll_interval=30.0, cache_size=3, client=None,
+                 artifact_cache=None, native_only=False):
+        self.model_name = model_name
+        self.stage = stage
+        self.warmup = warmup
+        self.poll_interval = poll_interval
+        self.cache_size = cache_size
+        self.artifact_cache = artifact_cache
+        self.native_only = native_only
+        self._client = client
+        self._check_now = False  # Modèle repris du cache : registre à vérifier dès le démarrage
+
+        self._cache = OrderedDict()  # version -> LoadedModel, du moins au plus récemment utilisé
+        self._current = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def current(self):
+        """Modèle à utiliser pour le prochain lot (None tant qu'aucun modèle n'est chargé)."""
+        return self._current
+
+    @property
+    def client(self):
+        """Client du registre MLflow, créé (et mlflow importé) au premier accès."""
+        if self._client is None:
+            from mlflow.tracking import MlflowClient
+
+            self._client = MlflowClient()
+        return self._client
+
+    def production_version(self):
+        """Version actuellement dans le stage surveillé du registre, ou None."""
+        versions = self.client.get_latest_versions(self.model_name, stages=[self.stage])
+        return versions[0] if versions else None
+
+    def _get_or_load(self, model_version):
+        """Retourne la version depuis le cache LRU, ou la charge et la préchauffe."""
+        # Numéro comparé sous forme de texte : entier ou chaîne selon le registre, chaîne dans le cache local
+        key = str(model_version.version)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            logging.info(f"✅ Modèle version {key} trouvé dans le cache.")
+            return self._cache[key]
+
+        start = time.perf_counter()
+        loaded = load_model_version(model_version, self.artifact_cache, self.native_only)
+        if self.warmup is not None:
+            self.warmup(loaded)
+        logging.info(f"✅ Modèle version {loaded.version} chargé et préchauffé en {time.perf_counter() - start:.1f} s.")
+
+        self._cache[key] = loaded
+        while len(self._cache) > self.cache_size:
+            evicted, _ = self._cache.popitem(last=False)
+            logging.info(f"Modèle version {evicted} retiré du cache.")
+        return loaded
+
+    def activate(self, model_version):
+        """Charge (ou reprend du cache) une version et la publie comme modèle courant."""
+        loaded = self._get_or_load(model_version)
+        previous = self._current
+        self._current = loaded
+        if previous is None or str(previous.version) != str(loaded.version):
+            logging.info(f"🔄 Modèle courant : version {loaded.version} (précédente : {previous.version if previous else 'aucune'}).")
+        return loaded
+
+    def check_for_update(self):
+        """Active la version du registre si elle diffère du modèle courant."""
+        model_version = self.production_version()
+        if model_version is None:
+            logging.warning(f"⚠️ Aucune version du modèle '{self.model_name}' dans le stage '{self.stage}'.")
+            return
+        if self._current is None or str(model_version.version) != str(self._current.version):
+            self.activate(model_version)
+        if self.artifact_cache is not None:
+            self.artifact_cache.set_stage_version(self.model_name, self.stage, model_version.version)
+
+    def load_cached(self):
+        """Active la dernière version vue dans le stage si elle est en cache, sans registre."""
+        version = self.artifact_cache.stage_version(self.model_name, self.stage)
+        if version is None:
+            return None
+        try:
+            loaded = self.activate(CachedVersion(self.model_name, version))
+        except Exception as e:
+            logging.warning(f"⚠️ Version {version} du cache local inutilisable, chargement depuis le registre : {e}")
+            return None
+        self._check_now = True
+        return loaded
+
+    def load_initial(self):
+        """
+        Chargement synchrone au démarrage, depuis le cache local si possible, sinon
+        depuis le registre. Retourne le modèle courant ou None.
+        """
+        if self.artifact_cache is not None and self.load_cached() is not None:
+            return self._current
+        try:
+            self.check_for_update()
+        except Exception as e:
+            logging.error(f"Erreur lors du chargement du modèle depuis MLflow : {e}")
+        return self._current
+
+    def _run(self):
+        while not self._stop.wait(0 if self._check_now else self.poll_interval):
+            self._check_now = False
+            try:
+                self.check_for_update()
+            except Exception as e:
+                # Un modèle qui échoue au chargement ou au préchauffage n'est jamais publié
+                logging.error(f"❌ Erreur lors de la vérification du registre MLflow : {e}")
+
+    def start(self):
+        """Démarre la surveillance du registre en arrière-plan."""
+        self._thread = threading.Thread(target=self._run, name="model-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -1,84 +1,243 @@
-import pandas as pd
-import requests
 import time
+STARTED_AT = time.perf_counter()  # Lancement du processus, avant les imports : délai avant la première prédiction
+
 import os
-import mlflow.pyfunc
-from sqlalchemy import create_engine
+import asyncio
+import signal
+import sys
+from contextlib import contextmanager
 from datetime import datetime
+from types import SimpleNamespace
 import logging
 import json
 
+# Modules légers uniquement : pandas, requests, sqlalchemy et xgboost (via model_watcher,
+# inference_engine, sharded_scoring...) sont importés par les fonctions qui s'en servent.
+# Le module se charge ainsi vite, y compris dans chaque processus du pool de scoring
+# (démarrés par 'spawn', ils réimportent le module principal).
+from service_metrics import MetricsRegistry, MetricsServer
+from notification import FraudAlertDispatcher
+from model_cache import ModelArtifactCache
+
 logging.basicConfig(level=logging.INFO)
 
 # Configuration des services
 DB_URI = os.environ.get("PROD_DB_URI")
-API_URL = "https://charlestng-real-time-fraud-detection.hf.space/current-transactions"
+# API de paiement (ou serveur de rejeu local ml/replay_server.py pour les tests de charge)
+API_URL = os.environ.get("API_URL", "https://charlestng-real-time-fraud-detection.hf.space/current-transactions")
 
 # Nom du modèle dans le registre MLflow
 MODEL_NAME = "XGBoost_Fraud_Model_Prod"
 MODEL_STAGE = "Production" 
 
-# Configuration des notifications
-SENDER_EMAIL = os.environ.get("SENDER_EMAIL")
-APP_PASSWORD = os.environ.get("APP_PASSWORD") # Mot de passe d'application pour les services de messagerie (ex: Gmail)
-RECEIVER_EMAIL = os.environ.get("RECEIVER_EMAIL")
+# Rechargement à chaud : intervalle de vérification du registre et taille du cache de versions
+MODEL_POLL_INTERVAL = float(os.environ.get("MODEL_POLL_INTERVAL", 30))
+MODEL_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_SIZE", 3))
+# Cache local des artefacts du modèle (vide = désactivé) : démarrage sans registre ni téléchargement
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "")
+
+# Moteur d'inférence : "native" (Booster XGBoost en place) ou "pyfunc" (mlflow.pyfunc + pandas)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "native")
+# Scoring multi-cœur des gros lots (chemin natif) : nombre de processus (0 = tout dans le processus principal,
+# vide = un par cœur, moins celui de la boucle principale)
+SCORING_WORKERS = int(os.environ.get("SCORING_WORKERS") or max((os.cpu_count() or 1) - 1, 0))
+SCORING_MIN_ROWS = int(os.environ.get("SCORING_MIN_ROWS", 20000))  # En dessous, le lot reste dans le processus principal
+SCORING_SHARD_ROWS = int(os.environ.get("SCORING_SHARD_ROWS", 5000))  # Taille minimale d'un morceau confié à un worker
+
+# Transaction fictive scorée pour préchauffer un nouveau modèle avant de le publier
+WARMUP_TRANSACTION = {
+    'current_time': '2024-01-01 12:00:00', 'category': 'misc_net', 'merchant': 'warmup',
+    'amt': 1.0, 'gender': 'F', 'city_pop': 1000, 'trans_num': 'warmup',
+}
+
+# Magasin de variables de vélocité par carte : nombre maximal de cartes suivies (éviction LRU au-delà),
+# fichier de sauvegarde (vide = pas de sauvegarde) et intervalle entre deux sauvegardes (secondes)
+FEATURE_STORE_MAX_CARDS = int(os.environ.get("FEATURE_STORE_MAX_CARDS", 1_000_000))
+FEATURE_STORE_SNAPSHOT = os.environ.get("FEATURE_STORE_SNAPSHOT", "")
+FEATURE_STORE_SNAPSHOT_INTERVAL = float(os.environ.get("FEATURE_STORE_SNAPSHOT_INTERVAL", 300))
+
+# Mode d'exécution : "sync" (boucle séquentielle historique) ou "async" (pipeline asyncio)
+SERVICE_MODE = os.environ.get("SERVICE_MODE", "sync")
+
+# Configuration du pipeline asynchrone
+HTTP_TIMEOUT = 10  # secondes
+POLL_INTERVAL_MIN = float(os.environ.get("POLL_INTERVAL_MIN", 2))  # Intervalle de polling quand de nouvelles transactions arrivent (secondes)
+POLL_INTERVAL_MAX = float(os.environ.get("POLL_INTERVAL_MAX", 60))  # Intervalle de polling quand le flux est inactif (secondes)
+STAGE_QUEUE_SIZE = 8  # Nombre de lots en attente entre deux étapes (contre-pression au-delà)
+
+# Écriture différée : flush dès N lignes en attente ou après N secondes
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get("WRITE_BEHIND_MAX_ROWS", 5000))
+WRITE_BEHIND_MAX_DELAY = float(os.environ.get("WRITE_BEHIND_MAX_DELAY", 5.0))
+# Fichier de secours des lignes non écrites à l'arrêt (base injoignable), rechargées au démarrage (vide = aucun)
+WRITE_BEHIND_SPILL_PATH = os.environ.get("WRITE_BEHIND_SPILL_PATH", "")
 
-def send_email(subject: str, body: str):
+# Anti-doublons sur trans_num (polls qui se recouvrent) : fenêtre de mémoire (secondes), identifiants
+# attendus par fenêtre et taux de faux positifs du filtre de Bloom. Au-delà de la fenêtre (ou après un
+# redémarrage), la table des clés en base (clé primaire sur trans_num) écarte les doublons à l'écriture
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_WINDOW = float(os.environ.get("DEDUP_WINDOW", 3600))
+DEDUP_CAPACITY = int(os.environ.get("DEDUP_CAPACITY", 1_000_000))
+DEDUP_ERROR_RATE = float(os.environ.get("DEDUP_ERROR_RATE", 1e-6))
+
+# Métriques au format Prometheus servies par le processus (0 = désactivées)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+# Profileur par échantillonnage à la demande (/debug/profile?seconds=N), désactivé par défaut
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "false").lower() == "true"
+
+METRICS = MetricsRegistry()
+STAGE_SECONDS = METRICS.histogram(
+    "fraud_service_stage_seconds", "Durée de chaque étape du traitement d'un lot (secondes)", ["stage"])
+ROWS_IN = METRICS.counter("fraud_service_rows_in_total", "Transactions reçues de l'API")
+ROWS_SCORED = METRICS.counter("fraud_service_rows_scored_total", "Transactions scorées")
+FRAUDS = METRICS.counter("fraud_service_frauds_total", "Transactions prédites frauduleuses")
+DB_ROWS_WRITTEN = METRICS.counter("fraud_service_db_rows_written_total", "Transactions écrites en base")
+QUEUE_DEPTH = METRICS.gauge("fraud_service_queue_depth", "Éléments en attente dans chaque file", ["queue"])
+MODEL_VERSION = METRICS.gauge("fraud_service_model_version", "Version du modèle utilisée pour le prochain lot")
+TRACKED_CARDS = METRICS.gauge("fraud_service_tracked_cards", "Cartes suivies par le magasin de variables de vélocité")
+DEDUP_LOOKUPS = METRICS.counter(
+    "fraud_service_dedup_lookups_total", "Transactions reçues vérifiées par le cache anti-doublons", ["result"])
+DEDUP_FPR = METRICS.gauge("fraud_service_dedup_estimated_fpr", "Taux de faux positifs estimé du cache anti-doublons")
+DB_DUPLICATES = METRICS.counter("fraud_service_db_duplicates_total", "Transactions déjà présentes en base, écartées à l'écriture")
+ALERTS_SENT = METRICS.counter("fraud_service_alerts_sent_total", "E-mails d'alerte envoyés (digests)")
+STARTUP_SECONDS = METRICS.gauge(
+    "fraud_service_startup_seconds", "Délai entre le lancement du processus et chaque étape du démarrage (secondes)", ["phase"])
+ROWS_SHARDED = METRICS.counter("fraud_service_rows_sharded_total", "Transactions scorées par le pool multi-cœur")
+
+# Étapes du démarrage déjà atteintes (imports, model_ready, first_prediction) -> secondes
+startup_phases = {}
+
+def record_startup(phase):
+    """Mesure, une seule fois, le délai entre le lancement du processus et une étape du démarrage."""
+    if phase in startup_phases:
+        return
+    startup_phases[phase] = seconds = time.perf_counter() - STARTED_AT
+    STARTUP_SECONDS.set(round(seconds, 3), (phase,))
+    logging.info(f"⏱️ Démarrage : étape '{phase}' atteinte en {seconds:.2f} s.")
+
+def warmup_model(loaded):
     """
-    Envoie un email via SMTP Gmail
+    Score une transaction fictive pour préchauffer le modèle (et valider son chargement).
+    Appelle directement le moteur, hors histogrammes des étapes : seuls les vrais lots y sont mesurés.
     """
-    # Ce bloc de code doit être indenté sous la fonction send_email
-    if not SENDER_EMAIL or not APP_PASSWORD or not RECEIVER_EMAIL:
-        logging.error("Les variables d'environnement pour l'envoi d'e-mail ne sont pas configurées. Notification non envoyée.")
-        return
+    import pandas as pd
+    from inference_engine import build_feature_matrix, FEATURE_COLUMNS
 
-    msg = MIMEMultipart()
-    msg["From"] = SENDER_EMAIL
-    msg["To"] = RECEIVER_EMAIL
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain"))
+    df = pd.DataFrame([WARMUP_TRANSACTION])
+    if INFERENCE_BACKEND == "native" and loaded.engine is not None:
+        loaded.engine.predict(build_feature_matrix(df, loaded.encoder, loaded.engine.feature_names))
+    else:
+        extra_columns = loaded.engine.feature_names[len(FEATURE_COLUMNS):] if loaded.engine is not None else ()
+        loaded.model.predict(preprocess_data(df, loaded.encoder, extra_columns))
+
+def create_model_watcher():
+    """
+    Charge le modèle en production (depuis le cache local s'il est configuré) et démarre la surveillance du registre MLflow.
+    Retourne le watcher, ou None si aucun modèle n'a pu être chargé.
+    """
+    from model_watcher import ModelWatcher
+
+    artifact_cache = ModelArtifactCache(MODEL_CACHE_DIR, keep_versions=MODEL_CACHE_SIZE) if MODEL_CACHE_DIR else None
+    watcher = ModelWatcher(MODEL_NAME, MODEL_STAGE, warmup=warmup_model,
+                           poll_interval=MODEL_POLL_INTERVAL, cache_size=MODEL_CACHE_SIZE,
+                           artifact_cache=artifact_cache, native_only=INFERENCE_BACKEND == "native")
+    if watcher.load_initial() is None:
+        return None
+    record_startup("model_ready")
+    watcher.start()
+    return watcher
+
+def create_sharded_scorer():
+    """
+    Démarre le pool de scoring multi-cœur (None si désactivé ou hors chemin natif) :
+    les lots d'au moins SCORING_MIN_ROWS transactions y sont répartis entre les processus.
+    """
+    if SCORING_WORKERS < 1 or INFERENCE_BACKEND != "native":
+        return None
+    from sharded_scoring import ShardedScorer
 
     try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(SENDER_EMAIL, APP_PASSWORD)
-        server.sendmail(SENDER_EMAIL, RECEIVER_EMAIL, msg.as_string())
-        logging.info("✅ Email envoyé avec succès.")
+        scorer = ShardedScorer(SCORING_WORKERS, min_rows=SCORING_MIN_ROWS, min_shard_rows=SCORING_SHARD_ROWS).start()
     except Exception as e:
-        logging.error(f"❌ Erreur lors de l'envoi de l'e-mail : {e}")
+        logging.error(f"❌ Pool de scoring indisponible, scoring dans le processus principal : {e}")
+        return None
+    ROWS_SHARDED.set_function(lambda: scorer.rows)
+    return scorer
 
+def create_alert_dispatcher():
+    """
+    Démarre l'envoi des alertes de fraude en arrière-plan (plugins/notification.py) :
+    les fraudes d'une fenêtre sont regroupées en un seul e-mail, sans jamais bloquer le scoring.
+    """
+    return FraudAlertDispatcher(on_sent=record_alert)
 
-def load_model():
-    """Charge la dernière version du modèle depuis le registre MLflow."""
+def start_metrics_server(watcher, buffer, feature_store, alerts, queues=None):
+    """
+    Branche les jauges sur l'état du service et démarre le serveur de métriques.
+    Retourne le serveur, ou None si les métriques sont désactivées.
+    """
+    MODEL_VERSION.set_function(lambda: int(watcher.current().version) if watcher.current() else None)
+    TRACKED_CARDS.set_function(lambda: len(feature_store))
+    QUEUE_DEPTH.set_function(lambda: buffer.pending_rows, labels=("write_behind_rows",))
+    QUEUE_DEPTH.set_function(lambda: alerts.pending_rows, labels=("alert_rows",))
+    for name, queue in (queues or {}).items():
+        QUEUE_DEPTH.set_function(queue.qsize, labels=(name,))
+    if not METRICS_PORT:
+        return None
     try:
-        client = mlflow.tracking.MlflowClient()
-        latest_version = client.get_latest_versions(MODEL_NAME, stages=[MODEL_STAGE])
-        if not latest_version:
-            logging.error("Aucune version du modèle en production n'a été trouvée dans le registre MLflow.")
-            return None
-        model_uri = latest_version[0].source
-        logging.info(f"Modèle chargé depuis : {model_uri}")
-        return mlflow.pyfunc.load_model(model_uri)
-    except Exception as e:
-        logging.error(f"Erreur lors du chargement du modèle depuis MLflow : {e}")
+        return MetricsServer(METRICS, METRICS_PORT, profiler_enabled=PROFILER_ENABLED).start()
+    except OSError as e:
+        logging.error(f"❌ Serveur de métriques indisponible sur le port {METRICS_PORT} : {e}")
         return None
 
-def get_latest_transactions(api_url):
+def record_flush(rows, frauds, seconds):
+    """Rappel du tampon d'écriture différée après chaque flush."""
+    STAGE_SECONDS.observe(seconds, ("db_write",))
+    DB_ROWS_WRITTEN.inc(rows)
+
+def record_alert(frauds, seconds):
+    """Rappel de l'envoi des alertes après chaque e-mail envoyé."""
+    STAGE_SECONDS.observe(seconds, ("notify",))
+    ALERTS_SENT.inc()
+
+def record_scored(df):
+    """Compteurs d'un lot scoré."""
+    ROWS_SCORED.inc(len(df))
+    FRAUDS.inc(int((df['is_fraud_predicted'] == 1).sum()))
+    record_startup("first_prediction")
+
+def create_http_session():
+    """Session HTTP réutilisant ses connexions (keep-alive) d'une requête à l'autre."""
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_latest_transactions(api_url, session=None):
     """Étape 1 : Récupère les données brutes de l'API sous forme de chaîne de caractères."""
+    import requests
+
     try:
-        response = requests.get(api_url)
-        response.raise_for_status()
+        with STAGE_SECONDS.time(("fetch",)):
+            response = (session or requests).get(api_url, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            text = response.json()
         logging.info("Connexion à l'API de paiement")
-        return response.json()
+        return text
     except requests.exceptions.RequestException as e:
         logging.error(f"Erreur lors de la connexion à l'API de paiement : {e}")
         return None
 
-def preprocess_data(df):
+def preprocess_data(df, encoder=None, extra_columns=()):
     """
     Prétraite les données pour le modèle en créant les colonnes manquantes et en ajustant le schéma.
+    'category' et 'merchant' sont encodés avec l'encodeur figé de l'entraînement lorsqu'il est disponible.
+    'extra_columns' liste les variables de vélocité attendues en plus par le modèle (NaN si absentes).
     """
-    
+    import pandas as pd
+
     # Créer les colonnes 'hour' et 'dayofweek'
     df['current_time'] = pd.to_datetime(df['current_time'])
     df['hour'] = df['current_time'].dt.hour
@@ -88,85 +247,392 @@ def preprocess_data(df):
     if 'gender' not in df.columns:
         df['gender'] = 0
     df['gender'] = df['gender'].map({'F': 0, 'M': 1}).fillna(-1).astype(int)
-    # Encodage de la colonne 'category' en valeurs numériques (au lieu de one-hot encoding)
-    df['category'] = df['category'].astype('category').cat.codes
-
-    # Encodage de la colonne 'merchant'
-    df['merchant_encoded'] = df['merchant'].astype('category').cat.codes
+    # Encodage des colonnes 'category' et 'merchant' en valeurs numériques (au lieu de one-hot encoding)
+    if encoder is not None:
+        df['category'] = encoder.encode(df['category'], 'category')
+        df['merchant_encoded'] = encoder.encode(df['merchant'], 'merchant')
+    else:
+        # Ancien comportement (modèles sans encodeur) : codes recalculés pour chaque lot
+        df['category'] = df['category'].astype('category').cat.codes
+        df['merchant_encoded'] = df['merchant'].astype('category').cat.codes
     
     # Sélectionner uniquement les colonnes requises par le modèle
     required_columns = ['category', 'amt', 'gender', 'city_pop', 'merchant_encoded', 'hour', 'dayofweek']
     df_processed = df[required_columns].copy()
+    for column in extra_columns:
+        df_processed[column] = df[column] if column in df.columns else float('nan')
     
     return df_processed
 
-def main_loop():
-    """Boucle principale de la détection de fraude en temps réel."""
+def parse_transactions(transactions_data):
+    """
+    Décode la réponse de l'API (chaîne JSON au format {columns, index, data})
+    et reconstruit le DataFrame des transactions.
+    """
+    import pandas as pd
+
+    with STAGE_SECONDS.time(("decode",)):
+        transactions_data = json.loads(transactions_data)
+        df = pd.DataFrame(transactions_data['data'], columns=transactions_data['columns'], index=transactions_data['index'])
+    ROWS_IN.inc(len(df))
+    return df
+
+def create_feature_store():
+    """Restaure le magasin de variables de vélocité depuis sa sauvegarde, ou en crée un vide."""
+    from feature_store import VelocityFeatureStore
+
+    if FEATURE_STORE_SNAPSHOT and os.path.exists(FEATURE_STORE_SNAPSHOT):
+        try:
+            return VelocityFeatureStore.load(FEATURE_STORE_SNAPSHOT, max_cards=FEATURE_STORE_MAX_CARDS)
+        except Exception as e:
+            logging.warning(f"⚠️ Sauvegarde du magasin de variables illisible, démarrage à vide : {e}")
+    return VelocityFeatureStore(max_cards=FEATURE_STORE_MAX_CARDS)
+
+def save_feature_store(feature_store):
+    """Sauvegarde le magasin de variables si un fichier est configuré."""
+    if not FEATURE_STORE_SNAPSHOT:
+        return
+    try:
+        feature_store.save(FEATURE_STORE_SNAPSHOT)
+    except Exception as e:
+        logging.error(f"❌ Erreur lors de la sauvegarde du magasin de variables : {e}")
+
+def uses_velocity_features(loaded):
+    """Le modèle servi a-t-il été entraîné avec les variables de vélocité ?"""
+    from feature_store import VELOCITY_FEATURES
+
+    return loaded.engine is not None and set(VELOCITY_FEATURES) <= set(loaded.engine.feature_names)
+
+def add_velocity_features(feature_store, df):
+    """
+    Met à jour l'état des cartes avec le lot et y ajoute les variables de vélocité.
+    Sans 'unix_time' dans le flux, l'horodatage est déduit de 'current_time'.
+    """
+    import pandas as pd
+    from feature_store import VELOCITY_FEATURES
+
+    with STAGE_SECONDS.time(("features",)):
+        if 'unix_time' not in df.columns:
+            df['unix_time'] = pd.to_datetime(df['current_time']).astype('int64') // 10**9
+        df[VELOCITY_FEATURES] = feature_store.update(df)
+    return df
+
+def score_sharded(scorer, loaded, df):
+    """Score un gros lot avec le pool ; retourne None en cas d'échec (le lot est alors scoré sur place)."""
+    try:
+        with STAGE_SECONDS.time(("sharded",)):
+            predictions, _ = scorer.predict(loaded, df)
+        return predictions
+    except Exception as e:
+        logging.error(f"❌ Erreur du pool de scoring, lot de {len(df)} transactions scoré sur place : {e}")
+        return None
+
+def score_transactions(loaded, df, scorer=None):
+    """
+    Prédit la fraude pour chaque transaction du lot et horodate la détection.
+    Avec un pool de scoring ('scorer'), les gros lots sont prétraités et prédits en parallèle.
+    """
+    from inference_engine import build_feature_matrix, FEATURE_COLUMNS
+
+    predictions = None
+    if scorer is not None and scorer.accepts(loaded, len(df)):
+        predictions = score_sharded(scorer, loaded, df)
+    if predictions is not None:
+        df['is_fraud_predicted'] = predictions
+    elif INFERENCE_BACKEND == "native" and loaded.engine is not None:
+        # Chemin rapide : matrice float32 contiguë et prédiction en place sur le Booster
+        with STAGE_SECONDS.time(("preprocess",)):
+            X = build_feature_matrix(df, loaded.encoder, loaded.engine.feature_names)
+        with STAGE_SECONDS.time(("predict",)):
+            predictions, _ = loaded.engine.predict(X)
+        df['is_fraud_predicted'] = predictions
+    else:
+        # Prétraitement sur une copie : les transactions sont sauvegardées avec leurs valeurs brutes
+        extra_columns = loaded.engine.feature_names[len(FEATURE_COLUMNS):] if loaded.engine is not None else ()
+        with STAGE_SECONDS.time(("preprocess",)):
+            df_processed = preprocess_data(df.copy(), loaded.encoder, extra_columns)
+        with STAGE_SECONDS.time(("predict",)):
+            df['is_fraud_predicted'] = loaded.model.predict(df_processed)
+    df['detection_timestamp'] = datetime.now()
+    return df
+
+def create_write_behind_buffer(engine, alerts):
+    """
+    Crée le tampon d'écriture différée des transactions scorées.
+    Un SIGTERM (arrêt du conteneur) lève SystemExit pour que le tampon soit vidé avant l'arrêt.
+    Avec l'anti-doublons, les trans_num déjà présents en base sont écartés à l'écriture ;
+    les alertes ne portent que sur les fraudes effectivement écrites.
+    """
+    from write_behind import WriteBehindBuffer
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    buffer = WriteBehindBuffer(engine, max_rows=WRITE_BEHIND_MAX_ROWS, max_delay=WRITE_BEHIND_MAX_DELAY,
+                               on_flush=record_flush, on_frauds=alerts.submit,
+                               unique_key='trans_num' if DEDUP_ENABLED else None,
+                               spill_path=WRITE_BEHIND_SPILL_PATH or None)
+    DB_DUPLICATES.set_function(lambda: buffer.duplicates_rejected)
+    return buffer
+
+def create_dedup_cache():
+    """Cache anti-doublons sur trans_num (None si désactivé), branché sur les métriques."""
+    if not DEDUP_ENABLED:
+        return None
+    from dedup_cache import TransactionDedupCache
+
+    dedup = TransactionDedupCache(window=DEDUP_WINDOW, capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR_RATE)
+    DEDUP_LOOKUPS.set_function(lambda: dedup.hits, labels=("hit",))
+    DEDUP_LOOKUPS.set_function(lambda: dedup.misses, labels=("miss",))
+    DEDUP_FPR.set_function(dedup.false_positive_rate)
+    logging.info(f"✅ Cache anti-doublons : fenêtre {DEDUP_WINDOW:.0f} s, {dedup.stats()['memory_bytes'] / 1e6:.1f} Mo.")
+    return dedup
+
+def remove_duplicates(dedup, df):
+    """
+    Écarte, avant tout traitement, les transactions déjà reçues lors d'un poll précédent.
+    Les autres sont réservées jusqu'à 'confirm_processed' ou 'release_unprocessed'.
+    """
+    if dedup is None:
+        return df
+    with STAGE_SECONDS.time(("dedup",)):
+        new = dedup.filter_new(df)
+    if len(new) < len(df):
+        logging.info(f"🔄 {len(df) - len(new)} transaction(s) déjà traitée(s) ignorée(s).")
+    return new
+
+def confirm_processed(dedup, df):
+    """Enregistre dans le cache anti-doublons les transactions d'un lot confié au tampon d'écriture."""
+    if dedup is not None:
+        dedup.confirm(df)
+
+def release_unprocessed(dedup, df):
+    """Libère les transactions d'un lot en échec : elles seront retraitées si l'API les renvoie."""
+    if dedup is not None:
+        dedup.release(df)
+
+async def fetch_stage(session, score_queue, dedup):
+    """
+    Étape de récupération : interroge l'API à intervalle adaptatif.
+    L'intervalle revient au minimum dès que de nouvelles transactions apparaissent
+    et double (jusqu'au maximum) lorsque le flux ne renvoie rien de nouveau.
+    """
+    interval = POLL_INTERVAL_MIN
+    previous_ids = set()
+    while True:
+        fetched_at = time.perf_counter()
+        transactions_data = await asyncio.to_thread(get_latest_transactions, API_URL, session)
+        df = None
+        current_ids = set()
+        if transactions_data:
+            try:
+                df = parse_transactions(transactions_data)
+                current_ids = set(df['trans_num']) if 'trans_num' in df.columns else set()
+                df = remove_duplicates(dedup, df)
+            except Exception as e:
+                logging.error(f"Erreur lors de la reconstruction du DataFrame: {e}")
+                df = None
+
+        # Avec l'anti-doublons, un lot non vide ne contient que des transactions réservées à traiter
+        # (y compris celles d'un lot en échec renvoyées par l'API) : il part au scoring même sans nouvel identifiant
+        has_new = dedup is not None or not current_ids or not current_ids <= previous_ids
+        if df is not None and not df.empty and has_new:
+            interval = POLL_INTERVAL_MIN
+            # Bloque si l'étape de scoring est en retard (file pleine) : contre-pression
+            await score_queue.put((fetched_at, df))
+        else:
+            interval = min(POLL_INTERVAL_MAX, interval * 2)
+        previous_ids = current_ids
+        await asyncio.sleep(interval)
+
+async def score_stage(watcher, feature_store, score_queue, persist_queue, scorer, dedup):
+    """
+    Étape de scoring : enrichit chaque lot des variables de vélocité, le prédit puis le
+    transmet à l'étape de sauvegarde. Seule cette étape touche au magasin de variables.
+    """
+    snapshot_at = time.monotonic()
+    while True:
+        fetched_at, df = await score_queue.get()
+        handed_off = False
+        try:
+            # Modèle lu une fois par lot : un rechargement à chaud s'applique au lot suivant
+            loaded = watcher.current()
+            # Magasin de variables utilisé seulement si le modèle en a besoin (USE_VELOCITY_FEATURES)
+            if uses_velocity_features(loaded):
+                df = await asyncio.to_thread(add_velocity_features, feature_store, df)
+            df = await asyncio.to_thread(score_transactions, loaded, df, scorer)
+            record_scored(df)
+            if time.monotonic() - snapshot_at >= FEATURE_STORE_SNAPSHOT_INTERVAL:
+                await asyncio.to_thread(save_feature_store, feature_store)
+                snapshot_at = time.monotonic()
+            latency_ms = (time.perf_counter() - fetched_at) * 1000
+            frauds = df[df['is_fraud_predicted'] == 1]
+            logging.info(f"✅ Lot de {len(df)} transactions scoré ({len(frauds)} fraudes). Latence récupération -> décision : {latency_ms:.0f} ms")
+            await persist_queue.put((fetched_at, df))
+            handed_off = True
+        except Exception as e:
+            logging.error(f"❌ Erreur lors de la prédiction : {e}")
+            if not handed_off:
+                release_unprocessed(dedup, df)
+        finally:
+            score_queue.task_done()
+
+async def persist_stage(buffer, persist_queue, dedup):
+    """Étape de sauvegarde : confie les lots scorés au tampon d'écriture différée."""
+    while True:
+        fetched_at, df = await persist_queue.get()
+        try:
+            # Peut bloquer si la base est en retard : la contre-pression remonte jusqu'à la récupération
+            with STAGE_SECONDS.time(("enqueue",)):
+                await asyncio.to_thread(buffer.add, df)
+            confirm_processed(dedup, df)
+            latency_ms = (time.perf_counter() - fetched_at) * 1000
+            logging.info(f"✅ {len(df)} transactions mises en file d'écriture ({buffer.pending_rows} en attente). Latence récupération -> file : {latency_ms:.0f} ms")
+        except Exception as e:
+            logging.error(f"❌ Erreur lors de la sauvegarde des données : {e}")
+            release_unprocessed(dedup, df)
+        finally:
+            persist_queue.task_done()
+
+@contextmanager
+def service_components(queues=None):
+    """
+    Crée les composants du service (base, modèle, variables de vélocité, tampon d'écriture,
+    anti-doublons, alertes, scoring réparti, métriques) et les arrête dans l'ordre à la sortie :
+    le tampon est vidé avant la fermeture des alertes, la mémoire des cartes sauvegardée en dernier.
+    Produit None si la base ou le modèle sont indisponibles.
+    """
+    record_startup("imports")
     try:
+        from sqlalchemy import create_engine
+
         engine = create_engine(DB_URI)
         logging.info("Connexion à la base de données établie.")
     except Exception as e:
         logging.error(f"Erreur de connexion à la base de données : {e}")
+        yield None
         return
 
-    model = load_model()
-    if not model:
+    watcher = create_model_watcher()
+    if not watcher:
         logging.error("Le service ne peut pas démarrer sans modèle ML.")
+        yield None
         return
 
+    feature_store = create_feature_store()
+    # Alertes envoyées par le tampon, pour les seules fraudes écrites (doublons écartés en base)
+    alerts = create_alert_dispatcher()
+    buffer = create_write_behind_buffer(engine, alerts)
+    dedup = create_dedup_cache()
+    scorer = create_sharded_scorer()
+    metrics_server = start_metrics_server(watcher, buffer, feature_store, alerts, queues)
+    try:
+        yield SimpleNamespace(
+            watcher=watcher, feature_store=feature_store, buffer=buffer,
+            dedup=dedup, alerts=alerts, scorer=scorer,
+        )
+    finally:
+        watcher.stop()
+        buffer.close()
+        alerts.close()
+        if scorer:
+            scorer.close()
+        save_feature_store(feature_store)
+        if metrics_server:
+            metrics_server.stop()
+
+async def async_main_loop():
+    """
+    Variante asynchrone de la boucle principale : récupération, scoring, sauvegarde
+    tournent en parallèle, reliées par des files bornées ; les alertes partent en arrière-plan.
+    """
+    score_queue = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+    persist_queue = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+    with service_components({"score": score_queue, "persist": persist_queue}) as c:
+        if c is None:
+            return
+        with create_http_session() as session:
+            await asyncio.gather(
+                fetch_stage(session, score_queue, c.dedup),
+                score_stage(c.watcher, c.feature_store, score_queue, persist_queue, c.scorer, c.dedup),
+                persist_stage(c.buffer, persist_queue, c.dedup),
+            )
+
+def main_loop():
+    """Boucle principale de la détection de fraude en temps réel."""
+    with service_components() as c:
+        if c is None:
+            return
+        with create_http_session() as session:
+            run_sync_loop(c.watcher, session, c.buffer, c.feature_store, c.dedup, c.scorer)
+
+def run_sync_loop(watcher, session, buffer, feature_store, dedup, scorer):
+    """
+    Boucle séquentielle : récupération, anti-doublons, variables de vélocité, scoring, mise en
+    file d'écriture (les alertes partent après l'écriture), pause.
+    """
+    snapshot_at = time.monotonic()
     while True:
         try:
-            transactions_data = get_latest_transactions(API_URL)
+            transactions_data = get_latest_transactions(API_URL, session)
             logging.info("1.Récupérer les données brutes de l'API")
             if not transactions_data:
                 time.sleep(60)
                 continue
-            
-            # Étape 2 : Décoder la chaîne JSON en un dictionnaire Python 
-           
-            transactions_data = json.loads(transactions_data)
-            
-            
-            # Étape 3 : Accéder manuellement aux clés du dictionnaire pour créer le DataFrame 
-            df = pd.DataFrame(transactions_data['data'], columns=transactions_data['columns'], index=transactions_data['index'])
-            
+
+            # Étapes 2 et 3 : Décoder la chaîne JSON et reconstruire le DataFrame
+            df = parse_transactions(transactions_data)
+
             logging.info("DataFrame créé avec succès.")
 
+            # Transactions déjà vues lors d'un poll précédent : ni rescorées, ni réinsérées, ni notifiées
+            df = remove_duplicates(dedup, df)
+            if df.empty:
+                logging.info("✅ Aucune nouvelle transaction depuis le dernier appel.")
+                time.sleep(60)
+                continue
+
         except Exception as e:
             logging.error(f"Erreur lors de la reconstruction du DataFrame: {e}")
             time.sleep(60)
             continue
-        
-        try:
-            df_processed = preprocess_data(df)
-            predictions = model.predict(df_processed)
-            df['is_fraud_predicted'] = predictions
-            df['detection_timestamp'] = datetime.now()
 
-            frauds_to_save = df[df['is_fraud_predicted'] == 1].copy()
-            frauds_to_save['detection_timestamp'] = datetime.now()
+        saved = False
+        try:
+            loaded = watcher.current()
+            if uses_velocity_features(loaded):
+                df = add_velocity_features(feature_store, df)
+            df = score_transactions(loaded, df, scorer)
+            record_scored(df)
+            frauds_to_save = df[df['is_fraud_predicted'] == 1]
 
             if not frauds_to_save.empty:
-                logging.info(f"Fraudes détectées : {len(frauds_to_save)}. Sauvegarde dans la base de données...")
-                frauds_to_save.to_sql('fraud_predictions', engine, if_exists='append', index=False)
-                logging.info("✅ Données sauvegardées avec succès.")
-                send_fraud_notification(frauds_to_save) # Appel de la fonction de notification
+                logging.info(f"Fraudes détectées : {len(frauds_to_save)}.")
             else:
                 logging.info("✅ Aucune fraude détectée cette fois-ci.")
 
-            # Sauvegarde de TOUTES les transactions
-            logging.info("Sauvegarde de toutes les transactions dans la base de données...")
-            df.to_sql('all_transactions', engine, if_exists='append', index=False)
-            logging.info("✅ Toutes les transactions ont été sauvegardées avec succès.")
+            # Sauvegarde des fraudes, de TOUTES les transactions, mise à jour du rollup et alerte (écriture différée)
+            with STAGE_SECONDS.time(("enqueue",)):
+                buffer.add(df)
+            confirm_processed(dedup, df)
+            saved = True
+            logging.info(f"✅ Transactions mises en file d'écriture ({buffer.pending_rows} en attente).")
 
         except Exception as e:
             logging.error(f"❌ Erreur lors de la prédiction ou de la sauvegarde des données : {e}")
+            if not saved:
+                release_unprocessed(dedup, df)
+
+        if time.monotonic() - snapshot_at >= FEATURE_STORE_SNAPSHOT_INTERVAL:
+            save_feature_store(feature_store)
+            snapshot_at = time.monotonic()
 
         logging.info("Pause de 60 secondes avant la prochaine requête...")
         time.sleep(60)
 
 if __name__ == "__main__":
-    main_loop()
+    if SERVICE_MODE == "async":
+        asyncio.run(async_main_loop())
+    else:
+        main_loop()
 
 
 
@@ -0,0 +1,278 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+# Fichier rejoué et adresse d'écoute par défaut
+REPLAY_CSV = os.environ.get("REPLAY_CSV", "data/fraudTest.csv")
+REPLAY_HOST = os.environ.get("REPLAY_HOST", "0.0.0.0")
+REPLAY_PORT = int(os.environ.get("REPLAY_PORT", 8000))
+ENDPOINT = "/current-transactions"
+
+DB_URI = os.environ.get("PROD_DB_URI")
+REPORT_INTERVAL = 10.0  # Secondes entre deux rapports de débit et de latence
+LATENCY_POLL_INTERVAL = 0.5  # Résolution de la mesure de latence (secondes)
+LATENCY_SAMPLE_EVERY = 100  # Une transaction servie sur N est suivie jusqu'à son écriture en base
+LOOKBACK = timedelta(seconds=60)  # Marge sur detection_timestamp (écriture différée, horloges)
+
+
+def percentile(values, q):
+    """Percentile q (0-100) d'une liste de valeurs, NaN si elle est vide."""
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+class ReplayFeed:
+    """
+    Rejoue un fichier de transactions au format de l'API de paiement.
+
+    Les transactions sont libérées à débit constant ('rate' lignes/s) ou, si 'time_warp'
+    est fourni, au rythme de leurs horodatages d'origine (unix_time) accéléré d'autant.
+    Chaque appel renvoie les transactions libérées et non encore servies, dans la limite
+    de 'burst' lignes : le reste forme un retard (backlog) qui mesure le retard du consommateur.
+    Avec 'loop', le fichier est rejoué en boucle (trans_num suffixé pour rester unique).
+    """
+
+    def __init__(self, df, rate=100.0, burst=1000, time_warp=None, loop=False, sample_every=LATENCY_SAMPLE_EVERY):
+        df = df.sort_values("unix_time", kind="stable").reset_index(drop=True)
+        self.df = df.drop(columns=["Unnamed: 0", "trans_date_trans_time", "current_time"], errors="ignore")
+        self.rate = rate
+        self.burst = burst
+        self.time_warp = time_warp
+        self.loop = loop
+        self.sample_every = sample_every
+
+        unix_time = df["unix_time"].to_numpy(dtype=np.float64)
+        # Instant de libération (secondes depuis le démarrage) de chaque ligne en mode 'time_warp'
+        self._offsets = (unix_time - unix_time[0]) / time_warp if time_warp else None
+        self._cycle = self._offsets[-1] + 1.0 if time_warp else len(df) / rate
+
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.started_wall = datetime.now()
+        self.served = 0
+        self.outstanding = {}  # trans_num échantillonné -> instant où il a été servi
+
+    def released(self, now):
+        """Nombre total de lignes libérées depuis le démarrage."""
+        n = len(self.df)
+        elapsed = now - self.started_at
+        if self._offsets is None:
+            total = int(elapsed * self.rate)
+        else:
+            cycles, position = divmod(elapsed, self._cycle)
+            total = int(cycles) * n + int(np.searchsorted(self._offsets, position, side="right"))
+        return total if self.loop else min(total, n)
+
+    def backlog(self):
+        """Lignes libérées mais pas encore servies."""
+        return self.released(time.monotonic()) - self.served
+
+    def next_batch(self):
+        """Transactions à renvoyer pour un appel de l'API (DataFrame, éventuellement vide)."""
+        with self._lock:
+            now = time.monotonic()
+            count = min(self.released(now) - self.served, self.burst)
+            positions = np.arange(self.served, self.served + count)
+            self.served += count
+
+        n = len(self.df)
+        batch = self.df.iloc[positions % n].copy()
+        batch.index = positions
+        laps = positions // n
+        if laps.any():
+            batch["trans_num"] = [f"{t}-{lap}" if lap else t for t, lap in zip(batch["trans_num"], laps)]
+        # Comme l'API réelle : la transaction est datée de l'instant où elle est servie
+        batch.insert(0, "current_time", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+        sampled = batch["trans_num"].to_numpy()[positions % self.sample_every == 0]
+        with self._lock:
+            for trans_num in sampled:
+                self.outstanding[trans_num] = now
+        return batch
+
+    def payload(self):
+        """Corps de la réponse : chaîne JSON {columns, index, data} encodée en JSON, comme l'API réelle."""
+        return json.dumps(self.next_batch().to_json(orient="split")).encode()
+
+
+class LatencyMonitor:
+    """
+    Mesure, en interrogeant la base, le débit soutenu du service (transactions écrites
+    dans all_transactions depuis le démarrage) et la latence service -> base des
+    transactions échantillonnées (de l'instant où elles sont servies à celui où elles
+    deviennent visibles en base).
+    """
+
+    def __init__(self, feed, engine, report_interval=REPORT_INTERVAL, poll_interval=LATENCY_POLL_INTERVAL):
+        self.feed = feed
+        self.engine = engine
+        self.report_interval = report_interval
+        self.poll_interval = poll_interval
+        self.latencies = []  # Toutes les latences mesurées (secondes)
+        self.window = []  # Latences mesurées depuis le dernier rapport
+        self.persisted = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="latency-monitor", daemon=True)
+
+    def poll(self, connection):
+        """Relève les transactions échantillonnées désormais présentes en base."""
+        with self.feed._lock:
+            pending = dict(self.feed.outstanding)
+        if not pending:
+            return
+        since = self.feed.started_wall - LOOKBACK
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT trans_num FROM all_transactions WHERE detection_timestamp >= %s AND trans_num = ANY(%s)",
+                (since, list(pending)),
+            )
+            found = [row[0] for row in cursor.fetchall()]
+        connection.commit()
+        now = time.monotonic()
+        with self.feed._lock:
+            for trans_num in found:
+                served_at = self.feed.outstanding.pop(trans_num, None)
+                if served_at is not None:
+                    self.window.append(now - served_at)
+
+    def count_persisted(self, connection):
+        """Nombre de transactions écrites en base depuis le démarrage du rejeu."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM all_transactions WHERE detection_timestamp >= %s",
+                (self.feed.started_wall - LOOKBACK,),
+            )
+            count = cursor.fetchone()[0]
+        connection.commit()
+        return count
+
+    def report(self, persisted, served, seconds):
+        """Journalise le débit et les percentiles de latence de la dernière période."""
+        self.latencies += self.window
+        logging.info(
+            f"📊 servies {served / seconds:,.0f} tx/s | écrites {persisted / seconds:,.0f} tx/s "
+            f"| retard du flux {self.feed.backlog()} | latence p50 {percentile(self.window, 50) * 1000:.0f} ms "
+            f"p95 {percentile(self.window, 95) * 1000:.0f} ms p99 {percentile(self.window, 99) * 1000:.0f} ms "
+            f"({len(self.window)} échantillons)"
+        )
+        self.window = []
+
+    def stats(self):
+        """Indicateurs cumulés depuis le démarrage."""
+        elapsed = time.monotonic() - self.feed.started_at
+        return {
+            "elapsed_s": elapsed,
+            "served": self.feed.served,
+            "persisted": self.persisted,
+            "served_per_s": self.feed.served / elapsed,
+            "persisted_per_s": self.persisted / elapsed,
+            "backlog": self.feed.backlog(),
+            "latency_samples": len(self.latencies),
+            "latency_p50_ms": percentile(self.latencies, 50) * 1000,
+            "latency_p95_ms": percentile(self.latencies, 95) * 1000,
+            "latency_p99_ms": percentile(self.latencies, 99) * 1000,
+        }
+
+    def _run(self):
+        connection = self.engine.raw_connection()
+        try:
+            baseline = self.count_persisted(connection)
+            last_report, last_persisted, last_served = time.monotonic(), 0, 0
+            while not self._stop.wait(self.poll_interval):
+                try:
+                    self.poll(connection)
+                    if time.monotonic() - last_report >= self.report_interval:
+                        self.persisted = self.count_persisted(connection) - baseline
+                        now = time.monotonic()
+                        self.report(self.persisted - last_persisted, self.feed.served - last_served, now - last_report)
+                        last_report, last_persisted, last_served = now, self.persisted, self.feed.served
+                except Exception as e:
+                    connection.rollback()
+                    logging.error(f"❌ Erreur lors de la mesure en base : {e}")
+        finally:
+            connection.close()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def create_handler(feed, monitor=None):
+    """Gestionnaire HTTP : l'endpoint de l'API de paiement et /stats (indicateurs du rejeu)."""
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith(ENDPOINT):
+                body = feed.payload()
+            elif self.path.startswith("/stats"):
+                stats = monitor.stats() if monitor else {"served": feed.served, "backlog": feed.backlog()}
+                body = json.dumps(stats).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Une ligne de journal par requête fausserait les mesures à fort débit
+
+    return ReplayHandler
+
+
+def serve(csv_path=REPLAY_CSV, host=REPLAY_HOST, port=REPLAY_PORT, rate=100.0, burst=1000, time_warp=None,
+          loop=False, db_uri=DB_URI, report_interval=REPORT_INTERVAL):
+    """Démarre le serveur de rejeu (et la mesure en base si une base est configurée) jusqu'à Ctrl+C."""
+    start = time.perf_counter()
+    feed = ReplayFeed(pd.read_csv(csv_path), rate=rate, burst=burst, time_warp=time_warp, loop=loop)
+    logging.info(f"✅ {len(feed.df)} transactions chargées depuis {csv_path} en {time.perf_counter() - start:.1f} s.")
+
+    monitor = None
+    if db_uri:
+        monitor = LatencyMonitor(feed, create_engine(db_uri), report_interval=report_interval)
+        monitor.start()
+    else:
+        logging.warning("⚠️ PROD_DB_URI non défini : débit écrit et latence non mesurés.")
+
+    server = ThreadingHTTPServer((host, port), create_handler(feed, monitor))
+    pace = f"x{time_warp} (horodatages d'origine)" if time_warp else f"{rate:,.0f} tx/s"
+    logging.info(f"⏳ Rejeu sur http://{host}:{port}{ENDPOINT} : {pace}, {burst} tx max par appel.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if monitor:
+            monitor.stop()
+            logging.info(f"📊 Bilan du rejeu : {json.dumps(monitor.stats())}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serveur local rejouant fraudTest.csv au format de l'API de paiement")
+    parser.add_argument("--csv", default=REPLAY_CSV)
+    parser.add_argument("--host", default=REPLAY_HOST)
+    parser.add_argument("--port", type=int, default=REPLAY_PORT)
+    parser.add_argument("--rate", type=float, default=100.0, help="Transactions libérées par seconde")
+    parser.add_argument("--burst", type=int, default=1000, help="Transactions renvoyées au maximum par appel")
+    parser.add_argument("--time-warp", type=float, default=None,
+                        help="Rejoue au rythme des unix_time d'origine accéléré N fois (remplace --rate)")
+    parser.add_argument("--loop", action="store_true", help="Rejoue le fichier en boucle")
+    parser.add_argument("--report-interval", type=float, default=REPORT_INTERVAL)
+    args = parser.parse_args()
+
+    serve(args.csv, args.host, args.port, args.rate, args.burst, args.time_warp, args.loop,
+          report_interval=args.report_interval)
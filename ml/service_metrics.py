@@ -0,0 +1,245 @@
+import bisect
+import logging
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Bornes (secondes) des histogrammes de latence, de la milliseconde à la minute
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROFILE_DEFAULT_SECONDS = 10.0
+PROFILE_MAX_SECONDS = 120.0
+PROFILE_SAMPLE_INTERVAL = 0.005  # Période d'échantillonnage des piles d'appels (secondes)
+
+
+def format_labels(names, values, extra=()):
+    """Étiquettes au format d'exposition Prometheus : {a="x",b="y"}."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Metric:
+    """Base commune : une série par combinaison de valeurs d'étiquettes."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._functions = {}
+
+    def set_function(self, function, labels=()):
+        """La valeur de la série est lue par 'function' au moment de l'exposition."""
+        self._functions[tuple(labels)] = function
+
+    def samples(self):
+        """Lignes (suffixe, étiquettes, valeur) à exposer."""
+        with self._lock:
+            values = dict(self._values)
+        for labels, function in self._functions.items():
+            try:
+                values[labels] = function()
+            except Exception as e:
+                logging.warning(f"⚠️ Métrique {self.name} illisible : {e}")
+        return [("", labels, value) for labels, value in sorted(values.items()) if value is not None]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value, *extra in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, labels, *extra)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Compteur croissant (lignes reçues, fraudes, lignes écrites...)."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[tuple(labels)] = self._values.get(tuple(labels), 0) + amount
+
+
+class Gauge(Metric):
+    """Valeur instantanée (profondeur de file, version du modèle...)."""
+
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[tuple(labels)] = value
+
+
+class Histogram(Metric):
+    """Distribution de durées, par intervalles cumulés (compatible histogram_quantile)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, labels=()):
+        """Mesure la durée du bloc encadré."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def samples(self):
+        with self._lock:
+            values = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._values.items()}
+        samples = []
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", labels, cumulative, [("le", format_value(bound))]))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+class MetricsRegistry:
+    """Ensemble des métriques exposées par le processus."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Toutes les métriques au format texte d'exposition Prometheus."""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def sample_stacks(seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """
+    Profileur par échantillonnage : relève périodiquement la pile d'appels de chaque
+    thread du processus (sys._current_frames) pendant 'seconds' secondes, sans
+    instrumenter le code. Retourne les piles agrégées au format « replié »
+    (fonction;fonction;... nombre), lisible par flamegraph.pl ou speedscope.
+    """
+    stacks = StackCounter()
+    names = {}
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names.update((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            calls = []
+            while frame is not None:
+                code = frame.f_code
+                calls.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]})")
+                frame = frame.f_back
+            stacks[";".join([names.get(ident, str(ident))] + calls[::-1])] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+class MetricsServer:
+    """
+    Serveur HTTP du processus : /metrics (format Prometheus) et, si le profileur est
+    activé, /debug/profile?seconds=N qui renvoie un profil des chemins chauds.
+    Un seul profil à la fois : l'échantillonnage a un coût qu'il ne faut pas cumuler.
+    """
+
+    def __init__(self, registry, port, host="0.0.0.0", profiler_enabled=False):
+        self.registry = registry
+        self.profiler_enabled = profiler_enabled
+        self._profile_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    def _handler(self):
+        server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/metrics":
+                    self._reply(200, server.registry.render(), "text/plain; version=0.0.4")
+                elif url.path == "/debug/profile":
+                    self._profile(parse_qs(url.query))
+                else:
+                    self._reply(404, "Not found\n")
+
+            def _profile(self, query):
+                if not server.profiler_enabled:
+                    self._reply(403, "Profileur désactivé (PROFILER_ENABLED=true pour l'activer)\n")
+                    return
+                if not server._profile_lock.acquire(blocking=False):
+                    self._reply(409, "Un profil est déjà en cours\n")
+                    return
+                try:
+                    seconds = min(float(query.get("seconds", [PROFILE_DEFAULT_SECONDS])[0]), PROFILE_MAX_SECONDS)
+                    logging.info(f"⏳ Profil des chemins chauds sur {seconds:.0f} s...")
+                    self._reply(200, sample_stacks(seconds))
+                finally:
+                    server._profile_lock.release()
+
+            def _reply(self, status, text, content_type="text/plain; charset=utf-8"):
+                body = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Les scrapes réguliers ne doivent pas remplir le journal
+
+        return MetricsHandler
+
+    def start(self):
+        self._thread.start()
+        logging.info(f"✅ Métriques exposées sur le port {self._server.server_address[1]} (/metrics).")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
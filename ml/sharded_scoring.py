@@ -0,0 +1,228 @@
+import logging
+import multiprocessing
+import pickle
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from categorical_encoder import CategoricalEncoder
+from inference_engine import FEATURE_COLUMNS, InferenceEngine, build_feature_matrix
+
+# Colonnes texte transmises aux workers (octets UTF-8 concaténés, un séparateur entre deux valeurs)
+STRING_COLUMNS = ['current_time', 'category', 'merchant', 'gender']
+# Colonnes numériques transmises dans la matrice float32, suivies des variables de vélocité du modèle
+NUMERIC_COLUMNS = ['amt', 'city_pop']
+SEPARATOR = "\x1f"  # Séparateur d'unités ASCII, absent des données de transaction
+# Un seul thread XGBoost par processus : le parallélisme vient du pool de processus
+THREADS_PER_WORKER = 1
+# Versions du modèle gardées en mémoire partagée (et dans chaque worker)
+MODEL_CACHE_SIZE = 2
+
+# Morceau (shard) d'un lot confié à un worker : lignes [start, end) du bloc partagé 'block'.
+# 'strings' donne, pour chaque colonne texte présente, (offset, taille) de ses octets dans le bloc.
+ShardTask = namedtuple("ShardTask", ["version", "model_block", "block", "rows", "numeric_columns", "start", "end", "strings"])
+
+# État de chaque processus du pool : modèles déjà désérialisés et bloc de données attaché
+_worker = {"models": OrderedDict(), "block": None}
+
+
+def init_worker():
+    """Initialiseur du pool (processus lancé par 'spawn', sans l'état du service)."""
+    logging.basicConfig(level=logging.INFO)
+
+
+def _worker_model(version, model_block):
+    """Moteur d'inférence et encodeur d'une version, désérialisés une seule fois par worker."""
+    models = _worker["models"]
+    if version not in models:
+        block = shared_memory.SharedMemory(name=model_block)
+        try:
+            payload = pickle.loads(block.buf)
+        finally:
+            block.close()
+        booster = xgb.Booster()
+        booster.load_model(bytearray(payload["booster"]))
+        booster.feature_names = payload["feature_names"]
+        encoder = CategoricalEncoder.from_dict(payload["encoder"]) if payload["encoder"] else None
+        models[version] = (InferenceEngine(booster, nthread=THREADS_PER_WORKER), encoder)
+        while len(models) > MODEL_CACHE_SIZE:
+            models.popitem(last=False)
+    return models[version]
+
+
+def _attach(name):
+    """Bloc de données du service, attaché une fois puis réutilisé tant qu'il ne change pas."""
+    block = _worker["block"]
+    if block is None or block.name != name:
+        if block is not None:
+            block.close()
+        block = _worker["block"] = shared_memory.SharedMemory(name=name)
+    return block
+
+
+def score_shard(task):
+    """
+    Prétraite et score un morceau du lot directement depuis la mémoire partagée.
+    Les probabilités sont écrites en place dans le bloc ; seul le nombre de lignes est renvoyé.
+    """
+    engine, encoder = _worker_model(task.version, task.model_block)
+    block = _attach(task.block)
+    numeric_size = task.rows * len(task.numeric_columns) * 4
+    numeric = np.ndarray((task.rows, len(task.numeric_columns)), dtype=np.float32, buffer=block.buf)
+    proba = np.ndarray(task.rows, dtype=np.float32, buffer=block.buf, offset=numeric_size)
+
+    rows = task.end - task.start
+    data = {column: numeric[task.start:task.end, j] for j, column in enumerate(task.numeric_columns)}
+    for column, (offset, size) in task.strings.items():
+        values = bytes(block.buf[offset:offset + size]).decode().split(SEPARATOR)
+        if len(values) != rows:
+            raise ValueError(f"Colonne '{column}' illisible : {len(values)} valeurs pour {rows} lignes.")
+        # Tableau objet construit directement : bien plus rapide que la conversion d'une liste par pandas
+        data[column] = np.fromiter(values, dtype=object, count=rows)
+    X = build_feature_matrix(pd.DataFrame(data, copy=False), encoder, engine.feature_names)
+    proba[task.start:task.end] = engine.predict_proba(X)
+    return rows
+
+
+def pack_strings(series):
+    """Octets UTF-8 d'une colonne texte, valeurs séparées par SEPARATOR (en un seul appel C)."""
+    values = series.tolist()
+    try:
+        return SEPARATOR.join(values).encode()
+    except TypeError:
+        # Valeurs non textuelles (manquantes, horodatages) : même rendu que astype(str) côté encodeur
+        return SEPARATOR.join(map(str, values)).encode()
+
+
+class ShardedScorer:
+    """
+    Scoring multi-cœur des gros micro-lots.
+
+    Un pool de processus persistant (lancé par 'spawn', sûr malgré les threads du service)
+    se partage chaque lot en morceaux contigus. Les données ne sont pas picklées : les
+    colonnes numériques sont copiées dans une matrice float32 et les colonnes texte en
+    octets UTF-8, dans un bloc de mémoire partagée réutilisé d'un lot à l'autre ; chaque
+    worker écrit ses probabilités en place dans le même bloc. Le modèle (Booster sérialisé
+    et encodeur) est publié une fois par version dans un autre bloc, désérialisé une seule
+    fois par worker. Les lots de moins de 'min_rows' lignes restent dans le processus
+    principal, où l'aller-retour vers le pool coûterait plus qu'il ne rapporte.
+    """
+
+    def __init__(self, workers, min_rows=20000, min_shard_rows=5000):
+        self.workers = workers
+        self.min_rows = min_rows
+        self.min_shard_rows = min_shard_rows
+        self._executor = None
+        self._ready = []  # Tâches de démarrage des workers
+        self._block = None
+        self._models = OrderedDict()  # version -> bloc partagé du modèle sérialisé
+        self.batches = 0
+        self.rows = 0
+
+    def start(self):
+        """
+        Lance les workers sans attendre leur initialisation (imports de pandas et xgboost) :
+        le démarrage du service n'est pas retardé, les lots restent sur place d'ici là.
+        """
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker,
+        )
+        self._ready = [self._executor.submit(int, i) for i in range(self.workers)]
+        logging.info(f"⏳ Pool de scoring : {self.workers} processus en démarrage, lots de plus de {self.min_rows} lignes répartis.")
+        return self
+
+    def accepts(self, loaded, rows):
+        """Vrai si le lot doit passer par le pool (workers prêts, modèle natif XGBoost et lot assez gros)."""
+        return (self._executor is not None and loaded.engine is not None and rows >= self.min_rows
+                and all(future.done() for future in self._ready))
+
+    def _publish_model(self, loaded):
+        """Bloc partagé du modèle sérialisé pour cette version (créé au premier lot qui l'utilise)."""
+        if loaded.version in self._models:
+            self._models.move_to_end(loaded.version)
+            return self._models[loaded.version].name
+        payload = pickle.dumps({
+            "booster": bytes(loaded.engine.booster.save_raw("ubj")),
+            "feature_names": loaded.engine.feature_names,
+            "encoder": loaded.encoder.to_dict() if loaded.encoder is not None else None,
+        })
+        block = shared_memory.SharedMemory(create=True, size=len(payload))
+        block.buf[:len(payload)] = payload
+        self._models[loaded.version] = block
+        while len(self._models) > MODEL_CACHE_SIZE:
+            _, evicted = self._models.popitem(last=False)
+            evicted.close()
+            evicted.unlink()
+        return block.name
+
+    def _reserve(self, size):
+        """Bloc de données d'au moins 'size' octets, agrandi (par doublement) seulement si besoin."""
+        if self._block is None or self._block.size < size:
+            previous = self._block.size if self._block is not None else 0
+            self._release_block()
+            self._block = shared_memory.SharedMemory(create=True, size=max(size, 2 * previous))
+        return self._block
+
+    def _release_block(self):
+        if self._block is not None:
+            self._block.close()
+            self._block.unlink()
+            self._block = None
+
+    def predict(self, loaded, df):
+        """Retourne (décisions 0/1, probabilités) pour le lot, calculées par le pool."""
+        rows = len(df)
+        feature_names = loaded.engine.feature_names
+        # Variables de vélocité absentes du lot : laissées à build_feature_matrix (NaN)
+        numeric_columns = NUMERIC_COLUMNS + [column for column in feature_names[len(FEATURE_COLUMNS):] if column in df.columns]
+        shards = max(1, min(self.workers, rows // self.min_shard_rows))
+        bounds = np.linspace(0, rows, shards + 1).astype(int)
+
+        packed = [{column: pack_strings(df[column].iloc[start:end]) for column in STRING_COLUMNS if column in df.columns}
+                  for start, end in zip(bounds[:-1], bounds[1:])]
+        numeric_size = rows * len(numeric_columns) * 4
+        strings_offset = numeric_size + rows * 4
+        block = self._reserve(strings_offset + sum(len(data) for shard in packed for data in shard.values()))
+
+        numeric = np.ndarray((rows, len(numeric_columns)), dtype=np.float32, buffer=block.buf)
+        for j, column in enumerate(numeric_columns):
+            numeric[:, j] = df[column].to_numpy(dtype=np.float32)
+        tasks = []
+        offset = strings_offset
+        model_block = self._publish_model(loaded)
+        for (start, end), shard in zip(zip(bounds[:-1], bounds[1:]), packed):
+            strings = {}
+            for column, data in shard.items():
+                block.buf[offset:offset + len(data)] = data
+                strings[column] = (offset, len(data))
+                offset += len(data)
+            tasks.append(ShardTask(loaded.version, model_block, block.name, rows, numeric_columns, int(start), int(end), strings))
+
+        try:
+            scored = sum(self._executor.map(score_shard, tasks))
+        except BrokenProcessPool:
+            # Worker tué (mémoire, signal) : le pool est reconstruit pour les lots suivants
+            logging.error("❌ Pool de scoring interrompu, redémarrage des workers.")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self.start()
+            raise
+        proba = np.ndarray(rows, dtype=np.float32, buffer=block.buf, offset=numeric_size).copy()
+        self.batches += 1
+        self.rows += scored
+        return (proba >= loaded.engine.threshold).astype(np.int8), proba
+
+    def close(self):
+        """Arrête les workers et libère les blocs de mémoire partagée."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self._release_block()
+        for block in self._models.values():
+            block.close()
+            block.unlink()
+        self._models.clear()
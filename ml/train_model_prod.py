@@ -1,36 +1,67 @@
 import pandas as pd
+import numpy as np
+import time
 import matplotlib.pyplot as plt
 from datetime import datetime
+from itertools import product
 
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.preprocessing import LabelEncoder
-from sklearn.metrics import classification_report, confusion_matrix, ConfusionMatrixDisplay
+from sklearn.metrics import classification_report, confusion_matrix, ConfusionMatrixDisplay, f1_score
 import xgboost as xgb
 
 import os
+import logging
+import tempfile
 from sqlalchemy import create_engine
 import mlflow
 import mlflow.sklearn
 from mlflow.models import infer_signature
 import joblib
 
+from categorical_encoder import CategoricalEncoder, ENCODER_ARTIFACT_PATH
+from feature_store import VelocityFeatureStore, VELOCITY_FEATURES
+from training_data import load_training_data, save_holdout, HOLDOUT_ARTIFACT_PATH, MODEL_COLUMNS
+
+# Ajoute au modèle les variables de vélocité par carte calculées en ligne par le service
+USE_VELOCITY_FEATURES = os.environ.get("USE_VELOCITY_FEATURES", "false").lower() == "true"
+
+# Recherche d'hyperparamètres : "grid" (GridSearchCV historique) ou "halving" (divisions successives)
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "grid")
+
+# Grille de la recherche par divisions successives : le nombre d'arbres n'en fait pas partie,
+# c'est la ressource allouée aux candidats (avec arrêt précoce sur le jeu de validation)
+HALVING_PARAM_GRID = {
+    "max_depth": [3, 5, 7],
+    "learning_rate": [0.01, 0.1, 0.2],
+    "scale_pos_weight": [1, 10],
+}
+HALVING_MIN_ROUNDS = 25  # Arbres alloués à chaque candidat au premier tour
+HALVING_MAX_ROUNDS = 400  # Arbres maximum pour un candidat
+HALVING_FACTOR = 3  # À chaque tour, 1 candidat sur 3 est conservé et reçoit 3 fois plus d'arbres
+EARLY_STOPPING_ROUNDS = 20
+HIST_MAX_BIN = 256
+
 #import airflow
 
 #from airflow.providers.postgres.hooks.postgres import PostgresHook # Importation nécessaire
 
 def get_data_from_db(conn_id="postgres_default"):
     """
-    Récupère le jeu de données depuis la base de données.
-    Note : Cette fonction est un placeholder. Pour ce projet,
-    nous utilisons un fichier CSV pour simuler la base de données.
+    Récupère le jeu de données d'entraînement via le cache colonnaire local (training_data),
+    alimenté par la table all_transactions ou par le CSV selon TRAINING_DATA_SOURCE.
+    Seules les colonnes utiles au modèle sont chargées.
     """
-    url = "https://lead-program-assets.s3.eu-west-3.amazonaws.com/M05-Projects/fraudTest.csv"
-    df = pd.read_csv(url)
-    return df
+    columns = MODEL_COLUMNS + (['cc_num', 'unix_time', 'merch_lat', 'merch_long'] if USE_VELOCITY_FEATURES else [])
+    return load_training_data(columns)
 
 
-def preprocess_data(df):
-    """Prétraite les données pour le modèle en créant les colonnes manquantes et en ajustant le schéma."""
+def preprocess_data(df, encoder, extra_columns=()):
+    """
+    Prétraite les données pour le modèle en créant les colonnes manquantes et en ajustant le schéma.
+    'category' et 'merchant' sont encodés avec l'encodeur figé, identique à celui utilisé en production.
+    'extra_columns' liste les variables de vélocité à conserver après les colonnes de base.
+    """
     
     # Créer les colonnes 'hour' et 'dayofweek'
     df['current_time'] = pd.to_datetime(df['current_time'])
@@ -38,29 +69,123 @@ def preprocess_data(df):
     df['dayofweek'] = df['current_time'].dt.dayofweek
     
     # Encoder la colonne 'gender' en valeurs numériques (0 ou 1)
-    df['gender'] = df['gender'].map({'F': 0, 'M': 1})
+    df['gender'] = df['gender'].astype(str).map({'F': 0, 'M': 1})
     
     # Encodage de la colonne 'category' en valeurs numériques
-    df['category'] = df['category'].astype('category').cat.codes
+    df['category'] = encoder.encode(df['category'], 'category')
 
     # Encodage de la colonne 'merchant'
-    df['merchant_encoded'] = df['merchant'].astype('category').cat.codes
+    df['merchant_encoded'] = encoder.encode(df['merchant'], 'merchant')
     
-    # Sélectionner uniquement les colonnes requises par le modèle
+    # Sélectionner uniquement les colonnes requises par le modèle (et la cible si elle est présente)
     required_columns = ['category', 'amt', 'gender', 'city_pop', 'merchant_encoded', 'hour', 'dayofweek']
-    df_processed = df[required_columns].copy()
+    required_columns += list(extra_columns)
+    if 'is_fraud' in df.columns:
+        required_columns.append('is_fraud')
+    # Types du cache compact ramenés à ceux des transactions servies (signature MLflow)
+    df_processed = df[required_columns].astype({'amt': 'float64', 'city_pop': 'int64'})
     
     return df_processed
 
 
 
+class HalvingEarlyStopping(xgb.callback.TrainingCallback):
+    """
+    Arrêt précoce sur la log-loss de validation, conservé d'un tour à l'autre : la meilleure
+    itération est comptée depuis le premier arbre du candidat, et non depuis le début du tour
+    (un callback EarlyStopping neuf à chaque reprise ne verrait que les arbres du tour).
+    """
+
+    def __init__(self, rounds=EARLY_STOPPING_ROUNDS):
+        self.rounds = rounds
+        self.best_score = float("inf")
+        self.best_iteration = -1
+        self.stopped = False
+
+    def after_iteration(self, model, epoch, evals_log):
+        iteration = model.num_boosted_rounds() - 1
+        score = evals_log["valid"]["logloss"][-1]
+        if score < self.best_score:
+            self.best_score, self.best_iteration = score, iteration
+        self.stopped = iteration - self.best_iteration >= self.rounds
+        return self.stopped
+
+
+def successive_halving_search(X_train, y_train, param_grid=HALVING_PARAM_GRID):
+    """
+    Recherche d'hyperparamètres par divisions successives (successive halving).
+
+    Les données sont quantifiées une seule fois (QuantileDMatrix, arbres 'hist') et
+    partagées par tous les candidats. Chaque tour prolonge l'entraînement des candidats
+    restants (sans repartir de zéro), les évalue en F1 sur un jeu de validation et ne
+    garde que le meilleur tiers, qui reçoit davantage d'arbres au tour suivant. L'arrêt
+    précoce sur la log-loss de validation fige un candidat qui ne progresse plus.
+    """
+    start = time.perf_counter()
+    X_fit, X_valid, y_fit, y_valid = train_test_split(X_train, y_train, test_size=0.2, stratify=y_train, random_state=42)
+    dtrain = xgb.QuantileDMatrix(X_fit, label=y_fit, max_bin=HIST_MAX_BIN)
+    dvalid = xgb.QuantileDMatrix(X_valid, label=y_valid, ref=dtrain)
+
+    candidates = [
+        {"params": dict(zip(param_grid, values)), "booster": None, "early_stopping": HalvingEarlyStopping(), "f1": 0.0, "rounds": 0}
+        for values in product(*param_grid.values())
+    ]
+    fits = 0
+    rounds = HALVING_MIN_ROUNDS
+    while True:
+        for candidate in candidates:
+            early_stopping = candidate["early_stopping"]
+            if early_stopping.stopped:
+                continue
+            booster = candidate["booster"]
+            done = booster.num_boosted_rounds() if booster is not None else 0
+            params = {
+                "objective": "binary:logistic", "eval_metric": "logloss", "tree_method": "hist",
+                "max_bin": HIST_MAX_BIN, "seed": 42, **candidate["params"],
+            }
+            booster = xgb.train(
+                params, dtrain, num_boost_round=rounds - done, xgb_model=booster,
+                evals=[(dvalid, "valid")], callbacks=[early_stopping], verbose_eval=False,
+            )
+            fits += 1
+            # Meilleure itération depuis le premier arbre : F1 et nombre d'arbres retenus en découlent
+            best_rounds = early_stopping.best_iteration + 1
+            proba = booster.predict(dvalid, iteration_range=(0, best_rounds))
+            candidate.update(
+                booster=booster, rounds=best_rounds,
+                f1=f1_score(y_valid, (proba >= 0.5).astype(int), zero_division=0),
+            )
+
+        candidates.sort(key=lambda c: c["f1"], reverse=True)
+        print(f"✅ Tour à {rounds} arbres : {len(candidates)} candidats, meilleur F1 {candidates[0]['f1']:.4f}")
+        if len(candidates) == 1 or rounds >= HALVING_MAX_ROUNDS:
+            break
+        candidates = candidates[:max(1, len(candidates) // HALVING_FACTOR)]
+        rounds = min(rounds * HALVING_FACTOR, HALVING_MAX_ROUNDS)
+
+    best = candidates[0]
+    return {
+        "best_params": {**best["params"], "n_estimators": best["rounds"]},
+        "best_f1": best["f1"],
+        "fits": fits,
+        "seconds": time.perf_counter() - start,
+    }
+
+
 def train_and_log_model(**kwargs):
     """
     Fonction principale pour l'entraînement du modèle et le log dans MLflow.
     """
     print("✅ Récupération et pré-traitement des données...")
     df = get_data_from_db()
-    df_model = preprocess_data(df)
+    # Vocabulaire figé, construit une seule fois et journalisé avec le modèle
+    encoder = CategoricalEncoder.fit(df, ['category', 'merchant'])
+    extra_columns = []
+    if USE_VELOCITY_FEATURES:
+        # Mêmes variables que celles calculées en ligne par le service, rejouées dans l'ordre chronologique
+        df[VELOCITY_FEATURES] = VelocityFeatureStore(max_cards=df['cc_num'].nunique()).update(df)
+        extra_columns = VELOCITY_FEATURES
+    df_model = preprocess_data(df, encoder, extra_columns)
     
     X = df_model.drop(columns=["is_fraud"])
     y = df_model["is_fraud"]
@@ -68,6 +193,8 @@ def train_and_log_model(**kwargs):
     y = df_model["is_fraud"]
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, random_state=42)
 
+    search_mode = kwargs.get("search_mode", SEARCH_MODE)
+
     # Paramètres pour GridSearch
     param_grid = {
         "n_estimators": [50, 100],
@@ -91,23 +218,52 @@ def train_and_log_model(**kwargs):
     print("✅ Lancement de la session MLflow...")
     mlflow.set_experiment("Fraud Detection Training")
 
-    with mlflow.start_run(run_name="XGBoost_Fraud_GridSearch"):
-        grid_search.fit(X_train, y_train)
+    run_name = "XGBoost_Fraud_Halving" if search_mode == "halving" else "XGBoost_Fraud_GridSearch"
+    with mlflow.start_run(run_name=run_name):
+        search_start = time.perf_counter()
+        if search_mode == "halving":
+            search = successive_halving_search(X_train, y_train)
+            best_params = search["best_params"]
+            # Réentraînement final sur tout le jeu d'entraînement avec le nombre d'arbres retenu
+            best_estimator = xgb.XGBClassifier(
+                eval_metric="logloss", random_state=42, tree_method="hist", max_bin=HIST_MAX_BIN, **best_params
+            )
+            best_estimator.fit(X_train, y_train)
+            search_fits = search["fits"] + 1
+            best_f1 = search["best_f1"]
+            mlflow.log_metric("f1_validation", best_f1)
+        else:
+            grid_search.fit(X_train, y_train)
+            best_params = grid_search.best_params_
+            best_estimator = grid_search.best_estimator_
+            search_fits = len(grid_search.cv_results_["params"]) * grid_search.n_splits_ + 1
+            best_f1 = grid_search.best_score_
+            mlflow.log_metric("f1_train_cv", best_f1)
+        search_seconds = time.perf_counter() - search_start
+        print(f"✅ Recherche '{search_mode}' : {search_fits} entraînements en {search_seconds:.1f} s, meilleur F1 {best_f1:.4f}")
 
-        best_params = grid_search.best_params_
-        y_pred = grid_search.predict(X_test)
+        y_pred = best_estimator.predict(X_test)
 
         mlflow.log_params(best_params)
+        mlflow.log_param("search_mode", search_mode)
+        mlflow.log_dict(encoder.to_dict(), ENCODER_ARTIFACT_PATH)
+        # Jeu de test du run, relu par la porte de performance (F1 hors échantillon d'entraînement)
+        with tempfile.TemporaryDirectory() as tmp:
+            holdout_path = os.path.join(tmp, HOLDOUT_ARTIFACT_PATH)
+            save_holdout(holdout_path, df, X_test.index)
+            mlflow.log_artifact(holdout_path)
 
         report = classification_report(y_test, y_pred, output_dict=True)
-        mlflow.log_metric("f1_train_cv", grid_search.best_score_)
+        mlflow.log_metric("search_seconds", search_seconds)
+        mlflow.log_metric("search_fits", search_fits)
+        mlflow.log_metric("best_f1_search", best_f1)
         mlflow.log_metric("precision", report["1"]["precision"])
         mlflow.log_metric("recall", report["1"]["recall"])
         mlflow.log_metric("f1_test", report["1"]["f1-score"])
 
-        signature = infer_signature(X_train, grid_search.best_estimator_.predict(X_train))
+        signature = infer_signature(X_train, best_estimator.predict(X_train))
         mlflow.sklearn.log_model(
-            sk_model=grid_search.best_estimator_,
+            sk_model=best_estimator,
             artifact_path="model",
             signature=signature,
             input_example=X_train.iloc[[0]],
@@ -130,10 +286,11 @@ def train_and_log_model(**kwargs):
     # Note: MLflow gère déjà l'enregistrement, mais cela peut être utile pour d'autres usages.
     os.makedirs("models", exist_ok=True)
     local_model_path = "models/xgboost_fraud_model.pkl"
-    joblib.dump(grid_search.best_estimator_, local_model_path)
+    joblib.dump(best_estimator, local_model_path)
     print("✅ Sauvegarde MLflow terminé avec succès !")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     train_and_log_model()
 
 
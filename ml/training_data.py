@@ -0,0 +1,285 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+# Source des données d'entraînement : "csv" (fichier fraudTest.csv) ou "db" (table all_transactions)
+TRAINING_DATA_SOURCE = os.environ.get("TRAINING_DATA_SOURCE", "csv")
+TRAINING_DATA_URL = os.environ.get(
+    "TRAINING_DATA_URL", "https://lead-program-assets.s3.eu-west-3.amazonaws.com/M05-Projects/fraudTest.csv"
+)
+DB_URI = os.environ.get("PROD_DB_URI")
+# Répertoire du cache colonnaire local (un fichier .npy par colonne + meta.json)
+TRAINING_CACHE_DIR = os.environ.get("TRAINING_CACHE_DIR", "data/training_cache")
+
+CHUNK_SIZE = 100000  # Lignes lues par morceau (CSV) ou par aller-retour du curseur serveur (base)
+SOURCE_TABLE = "all_transactions"
+WATERMARK_COLUMN = "unix_time"
+
+# Colonnes du source renommées dans le cache (même nom qu'en production)
+SOURCE_RENAMES = {"trans_date_trans_time": "current_time"}
+
+# Schéma du cache : type compact de chaque colonne conservée
+#   "category" : codes int32 + vocabulaire dans meta.json (-1 = valeur manquante)
+#   "bytes"    : chaînes ASCII de longueur fixe (identifiants)
+#   entiers    : -1 pour une valeur manquante
+CACHE_SCHEMA = {
+    "current_time": "datetime64[s]",
+    "unix_time": "int64",
+    "cc_num": "int64",
+    "trans_num": "bytes",
+    "merchant": "category",
+    "category": "category",
+    "gender": "category",
+    "city": "category",
+    "state": "category",
+    "job": "category",
+    "zip": "int32",
+    "city_pop": "int32",
+    "amt": "float32",
+    "lat": "float32",
+    "long": "float32",
+    "merch_lat": "float32",
+    "merch_long": "float32",
+    "dob": "datetime64[s]",
+    "is_fraud": "int8",
+}
+
+# Colonnes nécessaires au modèle actuel (préprocessing compris)
+MODEL_COLUMNS = ["current_time", "category", "merchant", "amt", "gender", "city_pop", "is_fraud"]
+
+# Artefact du run d'entraînement : lignes du cache gardées pour le test (jamais vues à l'entraînement)
+HOLDOUT_ARTIFACT_PATH = "holdout.npz"
+
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du processus (Mo)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def source_columns():
+    """Noms des colonnes du cache tels qu'ils apparaissent dans la source."""
+    reverse = {cached: source for source, cached in SOURCE_RENAMES.items()}
+    return [reverse.get(column, column) for column in CACHE_SCHEMA]
+
+
+def read_meta(cache_dir):
+    """Métadonnées du cache, ou None si le cache n'existe pas encore."""
+    path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def compact_chunk(chunk, vocabularies):
+    """
+    Convertit un morceau brut en tableaux NumPy compacts, colonne par colonne.
+    Les vocabulaires catégoriels sont complétés en place : les nouvelles modalités
+    sont ajoutées en fin de liste, si bien que les codes déjà écrits restent valables.
+    """
+    chunk = chunk.rename(columns=SOURCE_RENAMES)
+    arrays = {}
+    for column, kind in CACHE_SCHEMA.items():
+        if column not in chunk.columns:
+            continue
+        values = chunk[column]
+        if kind == "category":
+            vocabulary = vocabularies.setdefault(column, [])
+            positions = pd.Index(vocabulary)
+            new_values = pd.Index(values.dropna().astype(str).unique()).difference(positions)
+            vocabulary.extend(new_values)
+            codes = pd.Index(vocabulary).get_indexer(values.astype(str))
+            codes[values.isna().to_numpy()] = -1
+            arrays[column] = codes.astype(np.int32)
+        elif kind == "bytes":
+            arrays[column] = values.astype(str).to_numpy().astype("S")
+        elif kind.startswith("datetime64"):
+            arrays[column] = pd.to_datetime(values).to_numpy().astype(kind)
+        elif kind.startswith("int"):
+            arrays[column] = values.fillna(-1).to_numpy(dtype=kind)  # -1 = valeur manquante
+        else:
+            arrays[column] = values.to_numpy(dtype=kind)
+    return arrays
+
+
+def iter_csv_chunks(url, watermark):
+    """Morceaux du CSV (colonnes utiles uniquement), limités aux lignes postérieures au watermark."""
+    wanted = set(source_columns())
+    float_columns = {c: "float32" for c, kind in CACHE_SCHEMA.items() if kind == "float32"}
+    for chunk in pd.read_csv(url, usecols=lambda c: c in wanted, dtype=float_columns, chunksize=CHUNK_SIZE):
+        if watermark is not None:
+            chunk = chunk[chunk[WATERMARK_COLUMN] > watermark]
+        if not chunk.empty:
+            yield chunk
+
+
+def iter_db_chunks(db_uri, watermark):
+    """
+    Morceaux de la table all_transactions, lus via un curseur côté serveur (mémoire bornée),
+    limités aux transactions étiquetées postérieures au watermark.
+    """
+    engine = create_engine(db_uri)
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema()",
+                (SOURCE_TABLE,),
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+        if "is_fraud" not in existing:
+            raise ValueError(f"La table {SOURCE_TABLE} ne contient pas d'étiquettes (colonne is_fraud).")
+        columns = [c for c in source_columns() if c in existing]
+        with connection.cursor(name="training_data_export") as cursor:
+            cursor.itersize = CHUNK_SIZE
+            cursor.execute(
+                f"SELECT {', '.join(columns)} FROM {SOURCE_TABLE} "
+                f"WHERE is_fraud IS NOT NULL AND {WATERMARK_COLUMN} > %(watermark)s ORDER BY {WATERMARK_COLUMN}",
+                {"watermark": watermark if watermark is not None else -1},
+            )
+            while True:
+                rows = cursor.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                yield pd.DataFrame(rows, columns=columns)
+        connection.commit()
+    finally:
+        connection.close()
+        engine.dispose()
+
+
+def refresh_cache(cache_dir=TRAINING_CACHE_DIR, source=TRAINING_DATA_SOURCE):
+    """
+    Crée le cache colonnaire, ou y ajoute les lignes plus récentes que son watermark.
+    Chaque colonne est réécrite via un répertoire temporaire puis remplacée d'un bloc.
+    Retourne le nombre de lignes ajoutées.
+    """
+    start = time.perf_counter()
+    meta = read_meta(cache_dir)
+    if meta is not None and meta["source"] != source:
+        logging.warning(f"⚠️ Cache construit depuis '{meta['source']}', reconstruction depuis '{source}'.")
+        meta = None
+    watermark = meta["watermark"] if meta else None
+    vocabularies = {column: list(values) for column, values in (meta["vocabularies"] if meta else {}).items()}
+
+    chunks = iter_db_chunks(DB_URI, watermark) if source == "db" else iter_csv_chunks(TRAINING_DATA_URL, watermark)
+    parts = {}
+    for chunk in chunks:
+        for column, array in compact_chunk(chunk, vocabularies).items():
+            parts.setdefault(column, []).append(array)
+    added = sum(len(a) for a in parts.get(WATERMARK_COLUMN, []))
+    if not added:
+        logging.info(f"✅ Cache d'entraînement à jour ({meta['rows'] if meta else 0} lignes, watermark {watermark}).")
+        return 0
+
+    if meta is not None and set(parts) != set(meta["columns"]):
+        logging.warning("⚠️ Colonnes de la source modifiées, reconstruction complète du cache.")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return refresh_cache(cache_dir, source)
+
+    tmp_dir = f"{cache_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for column, arrays in parts.items():
+        if meta is not None and column in meta["columns"]:
+            arrays.insert(0, np.load(os.path.join(cache_dir, f"{column}.npy"), mmap_mode="r"))
+        np.save(os.path.join(tmp_dir, f"{column}.npy"), np.concatenate(arrays))
+
+    new_watermark = max(int(max(a.max() for a in parts[WATERMARK_COLUMN])), watermark or 0)
+    meta = {
+        "source": source,
+        "rows": (meta["rows"] if meta else 0) + added,
+        "watermark": new_watermark,
+        "columns": list(parts),
+        "vocabularies": {column: vocabularies[column] for column in parts if column in vocabularies},
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+    logging.info(
+        f"✅ Cache d'entraînement : {added} lignes ajoutées ({meta['rows']} au total, watermark {new_watermark}) "
+        f"en {time.perf_counter() - start:.1f} s."
+    )
+    return added
+
+
+def save_holdout(path, df, index):
+    """
+    Enregistre les lignes de test de 'df' (données de load_training_data) : positions dans
+    le cache, triées, et leur 'current_time', qui permet de vérifier que le cache n'a pas
+    été reconstruit entre l'entraînement et l'évaluation.
+    """
+    positions = np.sort(np.asarray(index, dtype=np.int64))
+    np.savez_compressed(path, positions=positions, current_time=holdout_times(df, positions))
+
+
+def holdout_times(df, positions):
+    return df['current_time'].to_numpy()[positions].astype("datetime64[s]").astype(np.int64)
+
+
+def load_holdout(path, df):
+    """Positions (triées) des lignes de test enregistrées par save_holdout, contrôlées sur 'df'."""
+    holdout = np.load(path)
+    positions = holdout["positions"]
+    if len(positions) == 0 or positions[-1] >= len(df) \
+            or not np.array_equal(holdout_times(df, positions), holdout["current_time"]):
+        raise ValueError("Le jeu de test enregistré ne correspond plus au cache d'entraînement (cache reconstruit ?).")
+    return positions
+
+
+def load_training_data(columns=MODEL_COLUMNS, cache_dir=TRAINING_CACHE_DIR, source=TRAINING_DATA_SOURCE, refresh=None):
+    """
+    Retourne les données d'entraînement à partir du cache colonnaire local.
+
+    Seules les colonnes demandées sont ouvertes (projection de mémoire, sans lecture
+    complète du fichier) ; les colonnes catégorielles sont rendues en pd.Categorical.
+    Le cache est construit au premier appel ; par défaut, il n'est rafraîchi qu'avec
+    la base comme source (le CSV de référence ne change pas).
+    """
+    start = time.perf_counter()
+    if refresh is None:
+        refresh = source == "db" or read_meta(cache_dir) is None
+    if refresh:
+        refresh_cache(cache_dir, source)
+
+    meta = read_meta(cache_dir)
+    columns = [c for c in (columns or meta["columns"]) if c in meta["columns"]]
+    data = {}
+    for column in columns:
+        values = np.load(os.path.join(cache_dir, f"{column}.npy"), mmap_mode="r")
+        if CACHE_SCHEMA[column] == "category":
+            data[column] = pd.Categorical.from_codes(values, categories=meta["vocabularies"][column])
+        elif CACHE_SCHEMA[column] == "bytes":
+            data[column] = values.astype(str)
+        else:
+            data[column] = values
+    df = pd.DataFrame(data, copy=False)
+    logging.info(
+        f"📊 Données d'entraînement : {len(df)} lignes x {len(columns)} colonnes chargées en "
+        f"{time.perf_counter() - start:.2f} s ({df.memory_usage(deep=True).sum() / 2**20:.0f} Mo, "
+        f"pic de mémoire du processus : {peak_rss_mb():.0f} Mo)."
+    )
+    return df
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Construit ou rafraîchit le cache colonnaire des données d'entraînement")
+    parser.add_argument("--source", choices=["csv", "db"], default=TRAINING_DATA_SOURCE)
+    parser.add_argument("--cache-dir", default=TRAINING_CACHE_DIR)
+    parser.add_argument("--rebuild", action="store_true", help="Supprime le cache existant avant de le reconstruire")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        shutil.rmtree(args.cache_dir, ignore_errors=True)
+    refresh_cache(args.cache_dir, args.source)
+    load_training_data(None, args.cache_dir, args.source, refresh=False)
@@ -0,0 +1,277 @@
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+import fraud_schema
+from db_utils import dataframe_to_csv_buffer, copy_buffer
+from fraud_rollup import upsert_batch_rollup
+
+
+class WriteBehindBuffer:
+    """
+    Tampon d'écriture différée des transactions scorées.
+
+    Les lots ajoutés par add() sont accumulés en mémoire puis écrits par un thread
+    dédié, en un seul COPY par table ('fraud_predictions', 'all_transactions') et une
+    mise à jour du rollup, le tout dans une seule transaction. Le flush est déclenché
+    dès que 'max_rows' lignes sont en attente ou que la plus ancienne attend depuis
+    'max_delay' secondes. close() vide le tampon avant l'arrêt du service, en réessayant
+    'close_retries' fois (délai croissant à partir de 'close_backoff' secondes) ; si la base
+    reste injoignable, les lignes restantes sont sauvegardées dans 'spill_path', rechargées
+    en tête de file au démarrage suivant (le fichier est supprimé après leur écriture).
+    'on_flush(rows, frauds, seconds)' est appelé après chaque flush réussi (métriques), puis
+    'on_frauds(frauds)' avec les fraudes effectivement écrites (alertes).
+
+    Les tables sont créées (partitionnées par jour de détection) et leurs partitions
+    ajoutées au besoin par plugins/fraud_schema.py.
+    Avec 'unique_key' (ex: 'trans_num'), les clés du lot sont enregistrées dans la table
+    des clés (clé primaire, ON CONFLICT DO NOTHING) dans la transaction du flush : une
+    transaction déjà enregistrée, quelle que soit sa date, est ignorée, et seules les
+    transactions réellement insérées dans 'all_transactions' sont reportées dans
+    'fraud_predictions', le rollup et les alertes.
+    """
+
+    def __init__(self, engine, max_rows=5000, max_delay=5.0, max_pending_rows=100000, on_flush=None,
+                 on_frauds=None, unique_key=None, spill_path=None, close_retries=3, close_backoff=1.0):
+        self.engine = engine
+        self.unique_key = unique_key
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending_rows = max_pending_rows
+        self.on_flush = on_flush
+        self.on_frauds = on_frauds
+        self.spill_path = spill_path
+        self.close_retries = close_retries
+        self.close_backoff = close_backoff
+
+        self._frames = []
+        self._pending_rows = 0
+        self._oldest_at = None
+        self._columns = {}  # Colonnes des tables cibles, lues une seule fois
+        self._closed = False
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._spill_loaded = False  # Lignes du fichier de secours en file, pas encore écrites
+
+        self.flush_count = 0
+        self.rows_written = 0
+        self.duplicates_rejected = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+        if spill_path and os.path.exists(spill_path):
+            self._load_spill()
+
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _load_spill(self):
+        """Remet en file les lignes sauvegardées lors d'un arrêt précédent (base injoignable)."""
+        df = pd.read_pickle(self.spill_path)
+        if not df.empty:
+            self._frames.append(df)
+            self._pending_rows += len(df)
+            self._oldest_at = time.monotonic()
+        self._spill_loaded = True
+        logging.info(f"🔄 {len(df)} transactions non écrites lors du dernier arrêt rechargées depuis {self.spill_path}.")
+
+    @property
+    def pending_rows(self):
+        """Profondeur de la file : nombre de lignes en attente d'écriture."""
+        return self._pending_rows
+
+    def stats(self):
+        """Indicateurs du tampon (profondeur de file, latence des flushs)."""
+        return {
+            "pending_rows": self._pending_rows,
+            "flush_count": self.flush_count,
+            "rows_written": self.rows_written,
+            "duplicates_rejected": self.duplicates_rejected,
+            "last_flush_seconds": self.last_flush_seconds,
+            "avg_flush_seconds": self.total_flush_seconds / self.flush_count if self.flush_count else 0.0,
+        }
+
+    def add(self, df):
+        """
+        Ajoute un lot scoré au tampon. Bloque si trop de lignes sont déjà en attente
+        (base indisponible ou trop lente), ce qui ralentit le service au lieu de saturer la mémoire.
+        """
+        if df.empty:
+            return
+        with self._condition:
+            while self._pending_rows >= self.max_pending_rows and not self._closed:
+                self._condition.wait(timeout=1.0)
+            if self._closed:
+                raise RuntimeError("Le tampon d'écriture est fermé.")
+            self._frames.append(df)
+            self._pending_rows += len(df)
+            if self._oldest_at is None:
+                # Réveille le thread d'écriture pour qu'il arme le délai maximal
+                self._oldest_at = time.monotonic()
+                self._condition.notify_all()
+            if self._pending_rows >= self.max_rows:
+                self._condition.notify_all()
+
+    def _run(self):
+        """Boucle du thread d'écriture : flush sur seuil de taille ou de délai."""
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if self._pending_rows >= self.max_rows:
+                        break
+                    if self._oldest_at is not None:
+                        remaining = self.max_delay - (time.monotonic() - self._oldest_at)
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(timeout=remaining)
+                    else:
+                        self._condition.wait()
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"❌ Erreur lors de l'écriture différée, nouvel essai au prochain flush : {e}")
+                time.sleep(1.0)
+
+    def _table_columns(self, cursor, table, sample):
+        """Colonnes de la table cible (tables partitionnées créées si elles n'existent pas)."""
+        if table not in self._columns:
+            fraud_schema.create_tables(cursor)
+            cursor.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema()",
+                (table,),
+            )
+            self._columns[table] = {row[0] for row in cursor.fetchall()}
+        return [c for c in sample.columns if c in self._columns[table]]
+
+    def _write(self, cursor, table, data, unique=False):
+        """
+        Écrit un lot dans une table ; retourne les lignes effectivement insérées.
+        Avec 'unique', seules les transactions dont la clé est nouvelle dans la table des clés sont écrites.
+        """
+        columns = self._table_columns(cursor, table, data)
+        if unique:
+            inserted, _ = fraud_schema.register_keys(cursor, data)
+            if len(inserted) < len(data):
+                data = data[data[self.unique_key].isin(inserted)].drop_duplicates(self.unique_key)
+            if data.empty:
+                return data
+        fraud_schema.ensure_partitions_for(cursor, table, data[fraud_schema.PARTITION_COLUMN])
+        copy_buffer(cursor, table, columns, dataframe_to_csv_buffer(data, columns))
+        return data
+
+    def flush(self):
+        """Écrit toutes les lignes en attente dans une seule transaction. Retourne le nombre de lignes écrites."""
+        with self._flush_lock:
+            with self._condition:
+                frames, self._frames = self._frames, []
+                rows, self._oldest_at = self._pending_rows, None
+            if not frames:
+                return 0
+
+            start = time.perf_counter()
+            df = pd.concat(frames, ignore_index=True)
+            connection = None
+            try:
+                # Connexion ouverte dans le try : une base injoignable remet aussi les lignes en file
+                connection = self.engine.raw_connection()
+                with connection.cursor() as cursor:
+                    # all_transactions d'abord : les doublons rejetés n'alimentent ni les fraudes ni le rollup
+                    written = self._write(cursor, 'all_transactions', df, unique=self.unique_key is not None)
+                    frauds = written[written['is_fraud_predicted'] == 1]
+                    if not frauds.empty:
+                        self._write(cursor, 'fraud_predictions', frauds)
+                    upsert_batch_rollup(cursor, written)
+                connection.commit()
+            except Exception:
+                if connection is not None:
+                    connection.rollback()
+                # Le schéma a pu changer et les partitions créées sont annulées : relus au prochain essai
+                self._columns.clear()
+                fraud_schema.forget_partitions()
+                with self._condition:
+                    # Les lignes non écrites sont remises en tête de file (toujours comptées dans _pending_rows)
+                    self._frames = frames + self._frames
+                    self._oldest_at = self._oldest_at or time.monotonic()
+                raise
+            finally:
+                if connection is not None:
+                    connection.close()
+
+            elapsed = time.perf_counter() - start
+            with self._condition:
+                self._pending_rows -= rows
+                self._condition.notify_all()
+            if self._spill_loaded:
+                # Les lignes rechargées étaient en tête de file : elles font partie de ce flush
+                self._spill_loaded = False
+                os.remove(self.spill_path)
+            duplicates = rows - len(written)
+            self.flush_count += 1
+            self.rows_written += len(written)
+            self.duplicates_rejected += duplicates
+            self.last_flush_seconds = elapsed
+            self.total_flush_seconds += elapsed
+            if self.on_flush is not None:
+                self.on_flush(len(written), len(frauds), elapsed)
+            if self.on_frauds is not None and not frauds.empty:
+                self.on_frauds(frauds.copy())
+            logging.info(
+                f"✅ Écriture différée : {len(written)} transactions ({len(frauds)} fraudes) en {elapsed * 1000:.0f} ms "
+                + (f"({duplicates} doublons ignorés) " if duplicates else "")
+                + f"(file : {self._pending_rows} lignes)."
+            )
+            return len(written)
+
+    def spill(self):
+        """
+        Sauvegarde les lignes en attente dans 'spill_path' (écriture atomique), pour les
+        recharger au prochain démarrage. Sans fichier configuré, elles sont perdues (journalisé).
+        Retourne le nombre de lignes sauvegardées.
+        """
+        with self._condition:
+            frames, self._frames = self._frames, []
+            self._pending_rows, self._oldest_at = 0, None
+            self._condition.notify_all()
+        if not frames:
+            return 0
+        df = pd.concat(frames, ignore_index=True)
+        if not self.spill_path:
+            logging.error(f"❌ {len(df)} transactions non écrites perdues : aucun fichier de secours configuré.")
+            return 0
+        if os.path.exists(self.spill_path) and not self._spill_loaded:
+            # Fichier d'un arrêt précédent jamais rechargé : conservé en tête
+            df = pd.concat([pd.read_pickle(self.spill_path), df], ignore_index=True)
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        df.to_pickle(self.spill_path + ".tmp")
+        os.replace(self.spill_path + ".tmp", self.spill_path)
+        self._spill_loaded = False
+        logging.warning(f"⚠️ {len(df)} transactions non écrites sauvegardées dans {self.spill_path}, rechargées au prochain démarrage.")
+        return len(df)
+
+    def close(self):
+        """
+        Arrête le thread d'écriture et écrit les lignes restantes, avec quelques essais
+        espacés ; en dernier recours, elles sont sauvegardées sur disque (spill).
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout=self.max_delay + 5)
+        delay = self.close_backoff
+        for attempt in range(1, self.close_retries + 1):
+            try:
+                written = self.flush()
+                logging.info(f"✅ Tampon d'écriture vidé à l'arrêt ({written} transactions).")
+                return written
+            except Exception as e:
+                logging.error(f"❌ Écriture à l'arrêt impossible (essai {attempt}/{self.close_retries}) : {e}")
+                if attempt < self.close_retries:
+                    time.sleep(delay)
+                    delay *= 2
+        self.spill()
+        return 0
@@ -0,0 +1,121 @@
+import io
+
+
+def quote_ident(name: str) -> str:
+    """
+    Protège un identifiant SQL (nom de table ou de colonne) par des guillemets doubles.
+    Nécessaire pour les colonnes du CSV comme 'Unnamed: 0'.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def dataframe_to_csv_buffer(df, columns=None):
+    """
+    Encode un DataFrame en CSV (sans en-tête ni index) dans un buffer mémoire,
+    au format attendu par COPY ... FROM STDIN WITH (FORMAT csv).
+    Les valeurs manquantes deviennent des champs vides, interprétés comme NULL.
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, columns=columns)
+    buffer.seek(0)
+    return buffer
+
+
+def copy_buffer(cursor, table: str, columns, buffer):
+    """
+    Envoie un buffer CSV dans une table PostgreSQL via COPY FROM STDIN (curseur psycopg2).
+    """
+    column_list = ", ".join(quote_ident(column) for column in columns)
+    sql = f"COPY {quote_ident(table)} ({column_list}) FROM STDIN WITH (FORMAT csv)"
+    cursor.copy_expert(sql, buffer)
+
+
+def copy_upsert(cursor, table: str, df, conflict_columns, update_columns=(), returning=None):
+    """
+    Insère un DataFrame dans une table via une table temporaire alimentée par COPY,
+    puis INSERT ... ON CONFLICT. Les colonnes de 'update_columns' sont mises à jour
+    en cas de conflit ; si la liste est vide, les lignes déjà présentes sont ignorées.
+    'update_columns' peut aussi être un dict colonne -> expression SQL (ex. cumul).
+    Nécessite un index unique sur 'conflict_columns'.
+    Avec 'returning' (nom de colonne), retourne les valeurs de cette colonne pour les
+    lignes effectivement insérées ou mises à jour au lieu de leur nombre.
+    """
+    staging = quote_ident(f"staging_{table}")
+    columns = list(df.columns)
+    column_list = ", ".join(quote_ident(column) for column in columns)
+    conflict_list = ", ".join(quote_ident(column) for column in conflict_columns)
+
+    # Une table temporaire du même nom peut subsister si la fonction est appelée deux fois dans la transaction
+    cursor.execute(f"DROP TABLE IF EXISTS pg_temp.{staging}")
+    cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {quote_ident(table)} INCLUDING DEFAULTS) ON COMMIT DROP")
+    copy_buffer(cursor, f"staging_{table}", columns, dataframe_to_csv_buffer(df))
+
+    if isinstance(update_columns, dict):
+        assignments = ", ".join(f"{quote_ident(c)} = {expression}" for c, expression in update_columns.items())
+        on_conflict = f"DO UPDATE SET {assignments}"
+    elif update_columns:
+        assignments = ", ".join(f"{quote_ident(c)} = EXCLUDED.{quote_ident(c)}" for c in update_columns)
+        on_conflict = f"DO UPDATE SET {assignments}"
+    else:
+        on_conflict = "DO NOTHING"
+
+    # DISTINCT ON : une même clé ne peut pas être mise à jour deux fois dans la même requête
+    cursor.execute(
+        f"INSERT INTO {quote_ident(table)} ({column_list}) "
+        f"SELECT DISTINCT ON ({conflict_list}) {column_list} FROM {staging} "
+        f"ON CONFLICT ({conflict_list}) {on_conflict}"
+        + (f" RETURNING {quote_ident(returning)}" if returning else "")
+    )
+    if returning:
+        return [row[0] for row in cursor.fetchall()]
+    return cursor.rowcount
+
+
+def copy_merge(cursor, table: str, df, key_columns, update_columns=(), returning=None,
+               window_column=None, since=None):
+    """
+    Variante de copy_upsert pour une clé sans index unique : c'est le cas de trans_num
+    dans les tables partitionnées sur detection_timestamp, où une contrainte d'unicité
+    doit inclure la clé de partitionnement. Les lignes dont la clé existe déjà sont mises
+    à jour ('update_columns') ou ignorées (liste vide), les autres sont insérées.
+    Les écrivains d'une même table sont sérialisés par un verrou consultatif de
+    transaction. Nécessite un index (même non unique) commençant par 'key_columns'.
+    Avec 'returning', retourne les valeurs de cette colonne pour les lignes insérées,
+    sinon leur nombre.
+    Avec 'window_column' et 'since', la recherche des clés existantes est bornée aux lignes
+    où 'window_column' >= 'since' : sur la clé de partitionnement, seules les partitions
+    récentes sont lues (élagage dès la planification, 'since' étant une constante).
+    Une clé plus ancienne que la fenêtre n'est pas vue et la ligne est insérée.
+    """
+    staging = quote_ident(f"staging_{table}")
+    columns = list(df.columns)
+    column_list = ", ".join(quote_ident(column) for column in columns)
+    key_list = ", ".join(quote_ident(column) for column in key_columns)
+    key_match = " AND ".join(f"t.{quote_ident(column)} = s.{quote_ident(column)}" for column in key_columns)
+    params = None
+    if window_column is not None and since is not None:
+        key_match += f" AND t.{quote_ident(window_column)} >= %(since)s"
+        params = {"since": since}
+
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table,))
+    cursor.execute(f"DROP TABLE IF EXISTS pg_temp.{staging}")
+    cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {quote_ident(table)} INCLUDING DEFAULTS) ON COMMIT DROP")
+    copy_buffer(cursor, f"staging_{table}", columns, dataframe_to_csv_buffer(df))
+
+    if update_columns:
+        assignments = ", ".join(f"{quote_ident(c)} = s.{quote_ident(c)}" for c in update_columns)
+        cursor.execute(
+            f"UPDATE {quote_ident(table)} AS t SET {assignments} "
+            f"FROM (SELECT DISTINCT ON ({key_list}) * FROM {staging}) AS s WHERE {key_match}",
+            params,
+        )
+    cursor.execute(
+        f"INSERT INTO {quote_ident(table)} ({column_list}) "
+        f"SELECT DISTINCT ON ({key_list}) {column_list} FROM {staging} AS s "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {quote_ident(table)} AS t WHERE {key_match})"
+        + (f" RETURNING {quote_ident(returning)}" if returning else ""),
+        params,
+    )
+    if returning:
+        return [row[0] for row in cursor.fetchall()]
+    return cursor.rowcount
@@ -0,0 +1,143 @@
+import csv
+import os
+from datetime import datetime, timedelta
+
+from fraud_rollup import ROLLUP_TABLE
+
+# Répertoire des fichiers de détail (volume ./data partagé par les workers Airflow)
+REPORTS_DIR = os.environ.get("FRAUD_REPORTS_DIR", "/opt/airflow/data/reports")
+TOP_MERCHANTS = 10
+FETCH_SIZE = 5000  # Nombre de lignes rapatriées à chaque aller-retour du curseur serveur
+DETAIL_COLUMNS = ["detection_timestamp", "trans_num", "amt", "category", "merchant"]
+
+
+def report_bounds(report_date):
+    """
+    Retourne l'intervalle semi-ouvert [début, fin) couvrant la journée du rapport.
+    Comparer directement detection_timestamp à ces bornes permet d'utiliser l'index.
+    """
+    start = datetime.combine(report_date, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def summarize_grouping_sets(report_date, rows, top_merchants=TOP_MERCHANTS):
+    """
+    Construit le résumé sérialisable (compatible XCom) à partir des lignes d'une requête
+    GROUPING SETS ((category), (hour), (merchant), ()) :
+    (g_category, g_hour, g_merchant, category, hour, merchant, fraud_count, total_amt).
+    """
+    summary = {
+        "report_date": report_date.isoformat(),
+        "fraud_count": 0,
+        "total_amt": 0.0,
+        "by_category": [],
+        "by_hour": [],
+        "top_merchants": [],
+    }
+    merchants = []
+    for g_category, g_hour, g_merchant, category, hour, merchant, count, amount in rows:
+        count, amount = int(count or 0), round(float(amount or 0), 2)
+        if not g_category:
+            summary["by_category"].append({"category": category, "fraud_count": count, "total_amt": amount})
+        elif not g_hour:
+            summary["by_hour"].append({"hour": int(hour), "fraud_count": count, "total_amt": amount})
+        elif not g_merchant:
+            merchants.append({"merchant": merchant, "fraud_count": count, "total_amt": amount})
+        else:
+            summary["fraud_count"], summary["total_amt"] = count, amount
+
+    summary["by_category"].sort(key=lambda row: row["fraud_count"], reverse=True)
+    summary["by_hour"].sort(key=lambda row: row["hour"])
+    merchants.sort(key=lambda row: (row["fraud_count"], row["total_amt"]), reverse=True)
+    summary["top_merchants"] = merchants[:top_merchants]
+    return summary
+
+
+def fetch_report_aggregates(connection, report_date, top_merchants=TOP_MERCHANTS):
+    """
+    Calcule côté serveur, en un seul parcours de la journée, le nombre et le montant
+    des fraudes au total, par catégorie, par heure et par marchand.
+    """
+    start, end = report_bounds(report_date)
+    sql = """
+        SELECT GROUPING(category) AS g_category,
+               GROUPING(EXTRACT(HOUR FROM detection_timestamp)) AS g_hour,
+               GROUPING(merchant) AS g_merchant,
+               category,
+               EXTRACT(HOUR FROM detection_timestamp)::int AS hour,
+               merchant,
+               COUNT(*) AS fraud_count,
+               COALESCE(SUM(amt), 0) AS total_amt
+        FROM fraud_predictions
+        WHERE detection_timestamp >= %(start)s AND detection_timestamp < %(end)s
+        GROUP BY GROUPING SETS ((category), (EXTRACT(HOUR FROM detection_timestamp)), (merchant), ())
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {"start": start, "end": end})
+        return summarize_grouping_sets(report_date, cursor.fetchall(), top_merchants)
+
+
+def fetch_rollup_aggregates(connection, report_date, top_merchants=TOP_MERCHANTS):
+    """
+    Même résumé que fetch_report_aggregates, lu dans la table de rollup
+    (quelques centaines de lignes agrégées au lieu des transactions brutes).
+    """
+    sql = f"""
+        SELECT GROUPING(category), GROUPING(hour), GROUPING(merchant),
+               category, hour, merchant,
+               SUM(fraud_count), SUM(fraud_amt_sum)
+        FROM {ROLLUP_TABLE}
+        WHERE day = %(day)s AND fraud_count > 0
+        GROUP BY GROUPING SETS ((category), (hour), (merchant), ())
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {"day": report_date})
+        return summarize_grouping_sets(report_date, cursor.fetchall(), top_merchants)
+
+
+def export_report_details(connection, report_date, path, fetch_size=FETCH_SIZE):
+    """
+    Écrit le détail des fraudes de la journée dans un fichier CSV, en streamant
+    les lignes via un curseur côté serveur (mémoire bornée quel que soit le volume).
+    Retourne le nombre de lignes écrites.
+    """
+    start, end = report_bounds(report_date)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    rows = 0
+    with connection.cursor(name=f"fraud_report_{report_date:%Y%m%d}") as cursor, open(path, "w", newline="") as f:
+        cursor.itersize = fetch_size
+        cursor.execute(
+            f"SELECT {', '.join(DETAIL_COLUMNS)} FROM fraud_predictions "
+            "WHERE detection_timestamp >= %(start)s AND detection_timestamp < %(end)s "
+            "ORDER BY detection_timestamp",
+            {"start": start, "end": end},
+        )
+        writer = csv.writer(f)
+        writer.writerow(DETAIL_COLUMNS)
+        for row in cursor:
+            writer.writerow(row)
+            rows += 1
+    return rows
+
+
+def render_report(summary):
+    """Construit le corps texte de l'e-mail à partir du résumé agrégé."""
+    if not summary["fraud_count"]:
+        return "Aucune fraude n'a été détectée le jour précédent."
+
+    lines = [
+        f"📊 Rapport de fraude pour le {summary['report_date']}:",
+        "",
+        f"Nombre de fraudes détectées : {summary['fraud_count']}",
+        f"Montant total des fraudes : {summary['total_amt']:.2f}",
+        "",
+        "Par catégorie :",
+    ]
+    lines += [f"  {row['category']:<20} {row['fraud_count']:>6}  {row['total_amt']:>12.2f}" for row in summary["by_category"]]
+    lines += ["", "Par heure de détection :"]
+    lines += [f"  {row['hour']:02d}h {row['fraud_count']:>6}  {row['total_amt']:>12.2f}" for row in summary["by_hour"]]
+    lines += ["", f"Top {len(summary['top_merchants'])} marchands :"]
+    lines += [f"  {row['merchant']:<40} {row['fraud_count']:>6}  {row['total_amt']:>12.2f}" for row in summary["top_merchants"]]
+    if summary.get("details_file"):
+        lines += ["", f"Détail des transactions : {os.path.basename(summary['details_file'])} (pièce jointe)"]
+    return "\n".join(lines)
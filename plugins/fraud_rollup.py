@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+
+from db_utils import copy_upsert
+
+# Agrégats par jour / heure / catégorie / marchand, maintenus au fil de l'eau
+ROLLUP_TABLE = "fraud_daily_rollup"
+ROLLUP_KEY = ["day", "hour", "category", "merchant"]
+UNKNOWN_LABEL = "inconnu"  # Les clés de la table de rollup ne peuvent pas être NULL
+
+CREATE_ROLLUP_TABLE_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+        day DATE NOT NULL,
+        hour SMALLINT NOT NULL,
+        category TEXT NOT NULL,
+        merchant TEXT NOT NULL,
+        tx_count BIGINT NOT NULL,
+        amt_sum DOUBLE PRECISION NOT NULL,
+        amt_max DOUBLE PRECISION,
+        fraud_count BIGINT NOT NULL,
+        fraud_amt_sum DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (day, hour, category, merchant)
+    )
+"""
+
+# Cumul des compteurs lorsqu'un lot touche une clé déjà présente
+INCREMENT_EXPRESSIONS = {
+    "tx_count": f"{ROLLUP_TABLE}.tx_count + EXCLUDED.tx_count",
+    "amt_sum": f"{ROLLUP_TABLE}.amt_sum + EXCLUDED.amt_sum",
+    "amt_max": f"GREATEST({ROLLUP_TABLE}.amt_max, EXCLUDED.amt_max)",
+    "fraud_count": f"{ROLLUP_TABLE}.fraud_count + EXCLUDED.fraud_count",
+    "fraud_amt_sum": f"{ROLLUP_TABLE}.fraud_amt_sum + EXCLUDED.fraud_amt_sum",
+}
+
+# Recalcul complet d'une journée à partir des tables brutes
+RECONCILE_DAY_SQL = f"""
+    INSERT INTO {ROLLUP_TABLE} (day, hour, category, merchant, tx_count, amt_sum, amt_max, fraud_count, fraud_amt_sum)
+    SELECT %(day)s, hour, category, merchant,
+           SUM(tx_count), SUM(amt_sum), MAX(amt_max), SUM(fraud_count), SUM(fraud_amt_sum)
+    FROM (
+        SELECT EXTRACT(HOUR FROM detection_timestamp)::int AS hour,
+               COALESCE(category, '{UNKNOWN_LABEL}') AS category,
+               COALESCE(merchant, '{UNKNOWN_LABEL}') AS merchant,
+               COUNT(*) AS tx_count, COALESCE(SUM(amt), 0) AS amt_sum, MAX(amt) AS amt_max,
+               0 AS fraud_count, 0 AS fraud_amt_sum
+        FROM all_transactions
+        WHERE detection_timestamp >= %(start)s AND detection_timestamp < %(end)s
+        GROUP BY 1, 2, 3
+        UNION ALL
+        SELECT EXTRACT(HOUR FROM detection_timestamp)::int,
+               COALESCE(category, '{UNKNOWN_LABEL}'),
+               COALESCE(merchant, '{UNKNOWN_LABEL}'),
+               0, 0, NULL,
+               COUNT(*), COALESCE(SUM(amt), 0)
+        FROM fraud_predictions
+        WHERE detection_timestamp >= %(start)s AND detection_timestamp < %(end)s
+        GROUP BY 1, 2, 3
+    ) AS per_source
+    GROUP BY hour, category, merchant
+"""
+
+
+def ensure_rollup_table(cursor):
+    """Crée la table de rollup si elle n'existe pas."""
+    cursor.execute(CREATE_ROLLUP_TABLE_SQL)
+
+
+def compute_batch_rollup(df, fraud_column="is_fraud_predicted"):
+    """
+    Agrège un lot de transactions scorées par jour / heure / catégorie / marchand
+    (nombre, somme et maximum des montants, nombre et montant des fraudes).
+    """
+    timestamps = df["detection_timestamp"]
+    frauds = df[fraud_column].fillna(0).astype(int) == 1
+    batch = df.assign(
+        day=timestamps.dt.date,
+        hour=timestamps.dt.hour,
+        category=df["category"].fillna(UNKNOWN_LABEL).astype(str),
+        merchant=df["merchant"].fillna(UNKNOWN_LABEL).astype(str),
+        fraud_count=frauds.astype(int),
+        fraud_amt=df["amt"].where(frauds, 0.0),
+    )
+    rollup = batch.groupby(ROLLUP_KEY, as_index=False).agg(
+        tx_count=("amt", "size"),
+        amt_sum=("amt", "sum"),
+        amt_max=("amt", "max"),
+        fraud_count=("fraud_count", "sum"),
+        fraud_amt_sum=("fraud_amt", "sum"),
+    )
+    return rollup
+
+
+def upsert_batch_rollup(cursor, df, fraud_column="is_fraud_predicted"):
+    """
+    Met à jour incrémentalement la table de rollup avec un lot de transactions scorées.
+    Retourne le nombre de clés (jour, heure, catégorie, marchand) touchées.
+    """
+    if df.empty:
+        return 0
+    ensure_rollup_table(cursor)
+    rollup = compute_batch_rollup(df, fraud_column)
+    copy_upsert(cursor, ROLLUP_TABLE, rollup, ROLLUP_KEY, INCREMENT_EXPRESSIONS)
+    return len(rollup)
+
+
+def reconcile_rollup_day(cursor, day):
+    """
+    Recalcule entièrement la journée 'day' du rollup à partir de 'all_transactions'
+    et 'fraud_predictions' (intervalle semi-ouvert sur detection_timestamp).
+    Corrige toute dérive de la mise à jour incrémentale. Retourne le nombre de clés écrites.
+    """
+    start = datetime.combine(day, datetime.min.time())
+    ensure_rollup_table(cursor)
+    cursor.execute(f"DELETE FROM {ROLLUP_TABLE} WHERE day = %(day)s", {"day": day})
+    cursor.execute(RECONCILE_DAY_SQL, {"day": day, "start": start, "end": start + timedelta(days=1)})
+    return cursor.rowcount
@@ -0,0 +1,411 @@
+import argparse
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from db_utils import copy_buffer, dataframe_to_csv_buffer, quote_ident
+
+# Tables des transactions, partitionnées par plages de detection_timestamp
+TABLES = ("all_transactions", "fraud_predictions")
+PARTITION_COLUMN = "detection_timestamp"
+KEY_COLUMN = "trans_num"
+# Table des clés, non partitionnée : un trans_num par transaction de all_transactions, avec sa
+# date de détection. Sa clé primaire garantit l'unicité de trans_num, que les index des tables
+# partitionnées ne peuvent pas porter seuls.
+KEY_TABLE = "transaction_keys"
+
+# Granularité des partitions ("day" ou "month"), partitions créées à l'avance (en périodes),
+# durée de conservation (jours, 0 = illimitée) et répertoire d'archivage (vide = suppression sans archive)
+PARTITION_INTERVAL = os.environ.get("PARTITION_INTERVAL", "day")
+PARTITION_PRECREATE = int(os.environ.get("PARTITION_PRECREATE", 7))
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 90))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "data/archive")
+
+ARCHIVE_FETCH_SIZE = 100000  # Lignes rapatriées à chaque aller-retour lors de l'archivage
+
+# Colonnes communes aux deux tables : celles du CSV, celles de l'API temps réel (current_time)
+# et les colonnes de scoring. Les horodatages bruts restent en texte, comme dans les sources.
+TRANSACTION_COLUMNS = {
+    "trans_num": "TEXT NOT NULL",
+    "trans_date_trans_time": "TEXT",
+    "current_time": "TEXT",
+    "unix_time": "BIGINT",
+    "cc_num": "BIGINT",
+    "merchant": "TEXT",
+    "category": "TEXT",
+    "amt": "DOUBLE PRECISION",
+    "first": "TEXT",
+    "last": "TEXT",
+    "gender": "TEXT",
+    "street": "TEXT",
+    "city": "TEXT",
+    "state": "TEXT",
+    "zip": "BIGINT",
+    "lat": "DOUBLE PRECISION",
+    "long": "DOUBLE PRECISION",
+    "city_pop": "BIGINT",
+    "job": "TEXT",
+    "dob": "TEXT",
+    "merch_lat": "DOUBLE PRECISION",
+    "merch_long": "DOUBLE PRECISION",
+    "is_fraud": "BIGINT",
+    "is_fraud_predicted": "BIGINT",
+    PARTITION_COLUMN: "TIMESTAMP NOT NULL",
+}
+
+# Index créés sur la table mère (et donc sur chaque partition). Une contrainte d'unicité doit
+# inclure la clé de partitionnement : l'index unique (trans_num, detection_timestamp) sert aux
+# recherches par trans_num (upsert du chargeur) ; l'unicité de trans_num seul est portée par KEY_TABLE.
+INDEXES = {
+    "uq_{table}_trans_num_detection": (True, [KEY_COLUMN, PARTITION_COLUMN]),
+    "idx_{table}_detection_timestamp": (False, [PARTITION_COLUMN]),
+}
+
+# Partitions dont l'existence est connue (évite une requête par écriture)
+_known_partitions = set()
+_known_lock = threading.Lock()
+
+
+def period_start(timestamp, interval=PARTITION_INTERVAL):
+    """Début de la période (jour ou mois) contenant 'timestamp'."""
+    day = datetime(timestamp.year, timestamp.month, timestamp.day)
+    return day.replace(day=1) if interval == "month" else day
+
+
+def next_period(start, interval=PARTITION_INTERVAL):
+    if interval == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(table, start, interval=PARTITION_INTERVAL):
+    """Nom de la partition couvrant la période débutant à 'start' (ex: all_transactions_p20240131)."""
+    return f"{table}_p{start:%Y%m}" if interval == "month" else f"{table}_p{start:%Y%m%d}"
+
+
+def table_kind(cursor, table):
+    """'p' (partitionnée), 'r' (table classique, créée avant ce module) ou None (absente)."""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def create_tables(cursor, indexes=True):
+    """
+    Crée les tables partitionnées et la table des clés si elles n'existent pas. Les index
+    peuvent être différés ('indexes=False') pour un chargement massif, puis créés par create_indexes.
+    """
+    columns = ",\n    ".join(f"{quote_ident(name)} {kind}" for name, kind in TRANSACTION_COLUMNS.items())
+    for table in TABLES:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} (\n    {columns}\n) PARTITION BY RANGE ({PARTITION_COLUMN})")
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {KEY_TABLE} ({KEY_COLUMN} TEXT PRIMARY KEY, {PARTITION_COLUMN} TIMESTAMP NOT NULL)"
+    )
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{KEY_TABLE}_{PARTITION_COLUMN} ON {KEY_TABLE} ({PARTITION_COLUMN})")
+    if indexes:
+        create_indexes(cursor)
+
+
+def create_indexes(cursor):
+    """
+    Crée les index des tables mères, propagés à toutes les partitions existantes et futures,
+    puis remplit la table des clés si besoin (backfill_keys).
+    """
+    for table in TABLES:
+        if table_kind(cursor, table) != "p":
+            continue
+        for name, (unique, columns) in INDEXES.items():
+            cursor.execute(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name.format(table=table)} "
+                f"ON {table} ({', '.join(columns)})"
+            )
+    backfill_keys(cursor)
+
+
+def backfill_keys(cursor):
+    """
+    Remplit la table des clés à partir de all_transactions lorsqu'elle est vide alors que
+    la table ne l'est pas : tables créées avant elle, ou chargement massif (COPY, to_sql)
+    qui ne l'alimente pas. Une clé présente plusieurs fois garde sa date de détection la
+    plus ancienne. Retourne le nombre de clés ajoutées.
+    """
+    table = TABLES[0]
+    if table_kind(cursor, table) != "p" or table_kind(cursor, KEY_TABLE) is None:
+        return 0
+    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {KEY_TABLE}), EXISTS (SELECT 1 FROM {table})")
+    has_keys, has_rows = cursor.fetchone()
+    if has_keys or not has_rows:
+        return 0
+    start = time.perf_counter()
+    cursor.execute(
+        f"INSERT INTO {KEY_TABLE} ({KEY_COLUMN}, {PARTITION_COLUMN}) "
+        f"SELECT DISTINCT ON ({KEY_COLUMN}) {KEY_COLUMN}, {PARTITION_COLUMN} FROM {table} "
+        f"ORDER BY {KEY_COLUMN}, {PARTITION_COLUMN}"
+    )
+    logging.info(f"✅ Table {KEY_TABLE} remplie : {cursor.rowcount} clés en {time.perf_counter() - start:.1f} s.")
+    return cursor.rowcount
+
+
+def register_keys(cursor, df):
+    """
+    Enregistre les trans_num de 'df' et leur date de détection dans la table des clés
+    (une clé déjà présente garde sa date d'origine). Retourne (clés nouvelles, borne) :
+    'borne' est la plus ancienne date de détection enregistrée pour les clés du lot,
+    donc une borne inférieure exacte des lignes existantes de ces transactions
+    (recherche limitée aux partitions utiles). À appeler dans la transaction d'écriture.
+    """
+    keys = df[[KEY_COLUMN, PARTITION_COLUMN]]
+    cursor.execute("DROP TABLE IF EXISTS pg_temp.staging_keys")
+    cursor.execute(f"CREATE TEMP TABLE staging_keys (LIKE {KEY_TABLE}) ON COMMIT DROP")
+    copy_buffer(cursor, "staging_keys", keys.columns, dataframe_to_csv_buffer(keys))
+    cursor.execute(
+        f"INSERT INTO {KEY_TABLE} ({KEY_COLUMN}, {PARTITION_COLUMN}) "
+        f"SELECT DISTINCT ON ({KEY_COLUMN}) {KEY_COLUMN}, {PARTITION_COLUMN} FROM staging_keys "
+        f"ON CONFLICT ({KEY_COLUMN}) DO NOTHING RETURNING {KEY_COLUMN}"
+    )
+    inserted = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f"SELECT min(k.{PARTITION_COLUMN}) FROM {KEY_TABLE} AS k JOIN staging_keys AS s USING ({KEY_COLUMN})")
+    return inserted, cursor.fetchone()[0]
+
+
+def forget_partitions():
+    """Vide le cache des partitions connues (ex: après l'annulation d'une transaction qui en a créé)."""
+    with _known_lock:
+        _known_partitions.clear()
+
+
+def drop_tables(cursor):
+    """Supprime les tables, toutes leurs partitions et la table des clés (rechargement complet)."""
+    for table in TABLES + (KEY_TABLE,):
+        cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+    forget_partitions()
+
+
+def ensure_partitions(cursor, table, start, end, interval=PARTITION_INTERVAL):
+    """
+    Crée les partitions de 'table' couvrant l'intervalle [start, end] qui n'existent pas encore.
+    Sans effet sur une table non partitionnée. Retourne le nombre de partitions créées.
+    """
+    period = period_start(start, interval)
+    names = []
+    while period <= end:
+        names.append((partition_name(table, period, interval), period, next_period(period, interval)))
+        period = next_period(period, interval)
+    with _known_lock:
+        missing = [entry for entry in names if entry[0] not in _known_partitions]
+    if not missing:
+        return 0
+    if table_kind(cursor, table) != "p":
+        return 0
+
+    created = 0
+    for name, lower, upper in missing:
+        cursor.execute("SELECT to_regclass(%s) IS NULL", (name,))
+        if cursor.fetchone()[0]:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                (lower, upper),
+            )
+            created += 1
+    with _known_lock:
+        _known_partitions.update(name for name, _, _ in missing)
+    return created
+
+
+def ensure_partitions_for(cursor, table, timestamps):
+    """Crée les partitions nécessaires pour écrire des lignes datées de 'timestamps'."""
+    timestamps = pd.to_datetime(timestamps)
+    if timestamps.empty:
+        return 0
+    return ensure_partitions(cursor, table, timestamps.min().to_pydatetime(), timestamps.max().to_pydatetime())
+
+
+def precreate_partitions(cursor, now=None, ahead=PARTITION_PRECREATE, interval=PARTITION_INTERVAL):
+    """Crée à l'avance les partitions de la période courante et des 'ahead' suivantes."""
+    start = period_start(now or datetime.now(), interval)
+    end = start
+    for _ in range(ahead):
+        end = next_period(end, interval)
+    return sum(ensure_partitions(cursor, table, start, end, interval) for table in TABLES)
+
+
+def list_partitions(cursor, table):
+    """Partitions de 'table' : [(nom, début, fin)] triées par date."""
+    cursor.execute(
+        """
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(%s)
+        """,
+        (table,),
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        values = re.findall(r"'([^']+)'", bound)
+        if len(values) == 2:
+            partitions.append((name, datetime.fromisoformat(values[0]), datetime.fromisoformat(values[1])))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def conform(df):
+    """Colonnes de 'df' présentes dans le schéma des tables (variables dérivées, index du CSV... écartés)."""
+    return df[[column for column in df.columns if column in TRANSACTION_COLUMNS]]
+
+
+def archive_partition(connection, partition, path):
+    """
+    Exporte une partition dans un fichier NumPy compressé, un tableau par colonne
+    (chaînes en unicode de longueur fixe, horodatages en datetime64). Écriture atomique.
+    Retourne le nombre de lignes archivées.
+    """
+    chunks = []
+    with connection.cursor(name=f"archive_{partition}") as cursor:
+        cursor.itersize = ARCHIVE_FETCH_SIZE
+        cursor.execute(f"SELECT * FROM {partition}")
+        while True:
+            rows = cursor.fetchmany(ARCHIVE_FETCH_SIZE)
+            if not rows:
+                break
+            # La description d'un curseur serveur n'est connue qu'après le premier fetch
+            chunks.append(pd.DataFrame(rows, columns=[description[0] for description in cursor.description]))
+    df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(TRANSACTION_COLUMNS))
+
+    arrays = {}
+    for column in df.columns:
+        kind = TRANSACTION_COLUMNS.get(column, "TEXT").split()[0]
+        if kind == "TIMESTAMP":
+            arrays[column] = pd.to_datetime(df[column]).to_numpy(dtype="datetime64[us]")
+        elif kind == "TEXT":
+            arrays[column] = df[column].fillna("").astype(str).to_numpy(dtype=str)
+        else:
+            arrays[column] = pd.to_numeric(df[column]).to_numpy(dtype=np.float64 if kind == "DOUBLE" else None)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+    return len(df)
+
+
+def load_archive(path):
+    """Relit une partition archivée sous forme de DataFrame."""
+    with np.load(path) as archive:
+        return pd.DataFrame({column: archive[column] for column in archive.files})
+
+
+def apply_retention(connection, retention_days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR, now=None):
+    """
+    Détache et supprime les partitions entièrement antérieures à la durée de conservation,
+    après les avoir archivées dans 'archive_dir/<table>/<partition>.npz' si un répertoire est
+    fourni. Une transaction par partition. Les clés des transactions supprimées de
+    all_transactions sont retirées de la table des clés dans la même transaction.
+    Retourne la liste des partitions supprimées.
+    """
+    if retention_days <= 0:
+        return []
+    cutoff = (now or datetime.now()) - timedelta(days=retention_days)
+    dropped = []
+    for table in TABLES:
+        with connection.cursor() as cursor:
+            if table_kind(cursor, table) != "p":
+                continue
+            expired = [partition for partition in list_partitions(cursor, table) if partition[2] <= cutoff]
+        connection.commit()
+        for name, lower, upper in expired:
+            start = time.perf_counter()
+            rows = None
+            if archive_dir:
+                rows = archive_partition(connection, name, os.path.join(archive_dir, table, f"{name}.npz"))
+            with connection.cursor() as cursor:
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE {name}")
+                if table == TABLES[0] and table_kind(cursor, KEY_TABLE) is not None:
+                    cursor.execute(
+                        f"DELETE FROM {KEY_TABLE} WHERE {PARTITION_COLUMN} >= %s AND {PARTITION_COLUMN} < %s",
+                        (lower, upper),
+                    )
+            connection.commit()
+            with _known_lock:
+                _known_partitions.discard(name)
+            dropped.append(name)
+            archived = f"{rows} lignes archivées, " if rows is not None else ""
+            logging.info(f"🔄 Partition {name} ({lower:%Y-%m-%d} -> {upper:%Y-%m-%d}) supprimée ({archived}{time.perf_counter() - start:.1f} s).")
+    return dropped
+
+
+def migrate_table(connection, table, interval=PARTITION_INTERVAL):
+    """
+    Convertit une table classique (créée par to_sql) en table partitionnée : la table est
+    renommée, la table partitionnée créée avec les partitions couvrant ses données, les
+    colonnes communes recopiées, puis l'ancienne table supprimée. Une seule transaction.
+    Retourne le nombre de lignes migrées (None si la table n'avait pas à l'être).
+    """
+    legacy = f"{table}_legacy"
+    with connection.cursor() as cursor:
+        if table_kind(cursor, table) != "r":
+            return None
+        start = time.perf_counter()
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema()",
+            (legacy,),
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        create_tables(cursor, indexes=False)
+        cursor.execute(f"SELECT min({PARTITION_COLUMN})::timestamp, max({PARTITION_COLUMN})::timestamp FROM {legacy}")
+        lower, upper = cursor.fetchone()
+        if lower is not None:
+            ensure_partitions(cursor, table, lower, upper, interval)
+        columns = [column for column in TRANSACTION_COLUMNS if column in existing]
+        casts = ", ".join(f"{quote_ident(c)}::{TRANSACTION_COLUMNS[c].split(' NOT NULL')[0]}" for c in columns)
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(quote_ident(c) for c in columns)}) "
+            f"SELECT DISTINCT ON ({KEY_COLUMN}, {PARTITION_COLUMN}) {casts} FROM {legacy} "
+            f"WHERE {PARTITION_COLUMN} IS NOT NULL AND {KEY_COLUMN} IS NOT NULL"
+        )
+        rows = cursor.rowcount
+        # Les index de l'ancienne table portent les mêmes noms : supprimés avec elle avant recréation
+        cursor.execute(f"DROP TABLE {legacy}")
+        create_indexes(cursor)
+    connection.commit()
+    logging.info(f"✅ Table {table} migrée en table partitionnée : {rows} lignes en {time.perf_counter() - start:.1f} s.")
+    return rows
+
+
+def maintain_partitions(connection, retention_days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR, now=None):
+    """Maintenance quotidienne : création des tables et des partitions à venir, puis rétention."""
+    with connection.cursor() as cursor:
+        create_tables(cursor)
+        created = precreate_partitions(cursor, now)
+    connection.commit()
+    dropped = apply_retention(connection, retention_days, archive_dir, now)
+    logging.info(f"✅ Partitions : {created} créée(s) à l'avance, {len(dropped)} supprimée(s) par la rétention.")
+    return created, dropped
+
+
+if __name__ == "__main__":
+    import psycopg2
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Gestion des tables partitionnées all_transactions / fraud_predictions")
+    parser.add_argument("--migrate", action="store_true", help="Convertit les tables classiques existantes en tables partitionnées")
+    parser.add_argument("--retention-days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help="Répertoire d'archivage (vide = suppression sans archive)")
+    args = parser.parse_args()
+
+    # psycopg2 n'accepte pas le préfixe de dialecte SQLAlchemy (postgresql+psycopg2://)
+    connection = psycopg2.connect(os.environ["PROD_DB_URI"].replace("+psycopg2", ""))
+    try:
+        if args.migrate:
+            for table in TABLES:
+                migrate_table(connection, table)
+        maintain_partitions(connection, args.retention_days, args.archive_dir)
+    finally:
+        connection.close()
@@ -1,30 +1,307 @@
+import logging
+import os
+import queue
+import random
 import smtplib
+import threading
+import time
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import os
 
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 APP_PASSWORD = os.getenv("APP_PASSWORD")
 RECEIVER_EMAIL = os.getenv("RECEIVER_EMAIL")
 
-def send_email(subject: str, body: str):
-    """
-    Envoie un email via SMTP Gmail
-    """
+# Serveur SMTP (Gmail par défaut ; un serveur local sans TLS ni authentification pour les tests)
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 30))
+SMTP_IDLE_TIMEOUT = 60.0  # Session fermée après N secondes sans envoi (les serveurs coupent les sessions inactives)
+
+# Nouvelles tentatives d'envoi : délai doublé à chaque échec, avec une part aléatoire
+SMTP_MAX_RETRIES = int(os.getenv("SMTP_MAX_RETRIES", 5))
+SMTP_BACKOFF_SECONDS = 1.0
+SMTP_BACKOFF_MAX_SECONDS = 60.0
+
+# Alertes de fraude : fenêtre de regroupement (digest) et nombre maximal d'e-mails par heure
+ALERT_DIGEST_WINDOW = float(os.getenv("ALERT_DIGEST_WINDOW", 60))
+ALERT_MAX_PER_HOUR = int(os.getenv("ALERT_MAX_PER_HOUR", 30))
+ALERT_MAX_PENDING_ROWS = 100000  # Au-delà, les nouvelles fraudes sont ignorées (et comptées)
+DIGEST_MAX_ROWS = 200  # Lignes détaillées dans le corps du digest
+DIGEST_COLUMNS = ['detection_timestamp', 'trans_num', 'amt', 'category', 'merchant']
+
+
+def build_message(subject, body, sender=None, receiver=None, attachment_path=None):
+    """Construit le message MIME (texte, pièce jointe optionnelle)."""
     msg = MIMEMultipart()
-    msg["From"] = SENDER_EMAIL
-    msg["To"] = RECEIVER_EMAIL
+    msg["From"] = sender or SENDER_EMAIL
+    msg["To"] = receiver or RECEIVER_EMAIL
     msg["Subject"] = subject
-
     msg.attach(MIMEText(body, "plain"))
+    if attachment_path and os.path.exists(attachment_path):
+        with open(attachment_path, "rb") as f:
+            attachment = MIMEApplication(f.read(), Name=os.path.basename(attachment_path))
+        attachment["Content-Disposition"] = f'attachment; filename="{os.path.basename(attachment_path)}"'
+        msg.attach(attachment)
+    return msg
+
 
+def backoff_delay(attempt):
+    """Délai avant la tentative suivante : exponentiel, plafonné, avec gigue."""
+    delay = min(SMTP_BACKOFF_SECONDS * 2 ** attempt, SMTP_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class SMTPSession:
+    """
+    Connexion SMTP persistante : la connexion, STARTTLS et l'authentification ne sont
+    faits qu'une fois, puis la session est réutilisée pour les envois suivants.
+    Une session coupée par le serveur est rouverte au prochain envoi.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, starttls=SMTP_STARTTLS, user=None, password=None,
+                 timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.user = user or SENDER_EMAIL
+        self.password = password if password is not None else APP_PASSWORD
+        self.timeout = timeout
+        self._server = None
+        self.last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.password:
+            server.login(self.user, self.password)
+        self._server = server
+        logging.info(f"✅ Session SMTP ouverte sur {self.host}:{self.port}.")
+
+    def send(self, msg):
+        """Envoie un message, en rouvrant la session si le serveur l'a fermée entre-temps."""
+        for reconnect in (False, True):
+            if self._server is None:
+                self._connect()
+            try:
+                self._server.send_message(msg)
+                self.last_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self.close()
+                if reconnect:
+                    raise
+                logging.warning(f"⚠️ Session SMTP interrompue, reconnexion : {e}")
+
+    def close_if_idle(self, idle_timeout=SMTP_IDLE_TIMEOUT):
+        if self._server is not None and time.monotonic() - self.last_used > idle_timeout:
+            self.close()
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+
+def send_with_retry(session, msg, max_retries=SMTP_MAX_RETRIES):
+    """Envoie un message avec nouvelles tentatives espacées. Lève la dernière erreur en cas d'échec."""
+    for attempt in range(max_retries + 1):
+        try:
+            session.send(msg)
+            return
+        except (smtplib.SMTPException, OSError) as e:
+            session.close()
+            if attempt == max_retries or isinstance(e, smtplib.SMTPAuthenticationError):
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"⚠️ Échec de l'envoi ({e}), nouvelle tentative dans {delay:.1f} s.")
+            time.sleep(delay)
+
+
+def send_email(subject: str, body: str, attachment_path: str = None, sender=None, receiver=None, password=None):
+    """
+    Envoie un e-mail isolé (ex: rapport quotidien), avec pièce jointe optionnelle et
+    nouvelles tentatives. Retourne True si l'e-mail est parti.
+    """
+    sender = sender or SENDER_EMAIL
+    receiver = receiver or RECEIVER_EMAIL
+    if not sender or not receiver:
+        logging.error("Les adresses d'envoi et de réception ne sont pas configurées. E-mail non envoyé.")
+        return False
+
+    session = SMTPSession(user=sender, password=password)
     try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(SENDER_EMAIL, APP_PASSWORD)
-        server.sendmail(SENDER_EMAIL, RECEIVER_EMAIL, msg.as_string())
-        print("Email envoyé avec succès")
+        send_with_retry(session, build_message(subject, body, sender, receiver, attachment_path))
+        logging.info("✅ Email envoyé avec succès.")
+        return True
     except Exception as e:
-        print(f" Erreur lors de l'envoi : {e}")
+        logging.error(f"❌ Erreur lors de l'envoi de l'e-mail : {e}")
+        return False
     finally:
-        server.quit()
\ No newline at end of file
+        session.close()
+
+
+def render_fraud_digest(frames):
+    """Sujet et corps d'un digest regroupant les fraudes de plusieurs lots."""
+    import pandas as pd
+
+    frauds = pd.concat(frames, ignore_index=True)
+    columns = [c for c in DIGEST_COLUMNS if c in frauds.columns]
+    subject = f"🚨 {len(frauds)} fraude(s) détectée(s)"
+    lines = [f"{len(frauds)} transaction(s) frauduleuse(s) détectée(s) sur {len(frames)} lot(s).", ""]
+    lines.append(frauds[columns].head(DIGEST_MAX_ROWS).to_string(index=False))
+    if len(frauds) > DIGEST_MAX_ROWS:
+        lines += ["", f"... et {len(frauds) - DIGEST_MAX_ROWS} autre(s)."]
+    return subject, "\n".join(lines)
+
+
+class FraudAlertDispatcher:
+    """
+    Envoi asynchrone des alertes de fraude.
+
+    submit() ne bloque jamais l'appelant : les lots de fraudes sont déposés dans une file
+    et un thread dédié les regroupe en un seul e-mail (digest) par fenêtre de
+    'digest_window' secondes. Les envois passent par une session SMTP persistante, sont
+    limités à 'max_per_hour' e-mails (les fraudes s'accumulent alors dans le digest suivant)
+    et sont retentés avec un délai croissant en cas d'échec.
+    'on_sent(frauds, seconds)' est appelé après chaque envoi réussi (métriques).
+    """
+
+    def __init__(self, session=None, digest_window=ALERT_DIGEST_WINDOW, max_per_hour=ALERT_MAX_PER_HOUR,
+                 max_retries=SMTP_MAX_RETRIES, max_pending_rows=ALERT_MAX_PENDING_ROWS, on_sent=None):
+        self.session = session or SMTPSession()
+        self.digest_window = digest_window
+        self.max_retries = max_retries
+        self.max_pending_rows = max_pending_rows
+        self.on_sent = on_sent
+
+        # Seau à jetons : un e-mail consomme un jeton, rechargé au rythme de max_per_hour
+        self._capacity = max(1, max_per_hour)
+        self._tokens = float(self._capacity)
+        self._refill_per_second = max_per_hour / 3600
+        self._refilled_at = time.monotonic()
+
+        self.configured = bool(SENDER_EMAIL and RECEIVER_EMAIL)
+        if not self.configured:
+            logging.error("Les variables d'environnement pour l'envoi d'e-mail ne sont pas configurées. Alertes désactivées.")
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()  # Protège le décompte des fraudes en attente (appelants et thread d'envoi)
+        self._pending = []
+        self._pending_rows = 0
+        self._window_started = None
+        self._closed = threading.Event()
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.frauds_notified = 0
+
+        self._thread = threading.Thread(target=self._run, name="fraud-alerts", daemon=True)
+        self._thread.start()
+
+    @property
+    def pending_rows(self):
+        """Fraudes en attente d'envoi (file et digest en cours)."""
+        return self._pending_rows
+
+    def stats(self):
+        return {
+            "sent": self.sent, "failed": self.failed, "dropped": self.dropped,
+            "frauds_notified": self.frauds_notified, "pending_rows": self._pending_rows,
+        }
+
+    def submit(self, frauds):
+        """Dépose un lot de fraudes (DataFrame) à notifier. Ne bloque pas."""
+        if frauds.empty or not self.configured:
+            return
+        with self._lock:
+            accepted = not self._closed.is_set() and self._pending_rows + len(frauds) <= self.max_pending_rows
+            if accepted:
+                self._pending_rows += len(frauds)
+                self._queue.put(frauds)  # File non bornée : ne bloque jamais (taille limitée par max_pending_rows)
+            else:
+                self.dropped += len(frauds)
+        if not accepted:
+            logging.warning(f"⚠️ {len(frauds)} fraude(s) non notifiée(s) : file d'alertes pleine ou fermée.")
+
+    def _take_token(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._refilled_at) * self._refill_per_second)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _drain(self, timeout):
+        """Ajoute au digest les lots arrivés dans la file (attend au plus 'timeout' secondes le premier)."""
+        try:
+            frames = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return
+        while True:
+            try:
+                frames.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if self._window_started is None:
+            self._window_started = time.monotonic()
+        self._pending += frames
+
+    def _send_digest(self):
+        frames, self._pending, self._window_started = self._pending, [], None
+        rows = sum(len(frame) for frame in frames)
+        start = time.perf_counter()
+        try:
+            subject, body = render_fraud_digest(frames)
+            send_with_retry(self.session, build_message(subject, body), self.max_retries)
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"❌ Alerte de fraude non envoyée ({rows} fraude(s)) : {e}")
+        else:
+            self.sent += 1
+            self.frauds_notified += rows
+            logging.info(f"✅ Alerte envoyée : {rows} fraude(s) sur {len(frames)} lot(s).")
+            if self.on_sent is not None:
+                self.on_sent(rows, time.perf_counter() - start)
+        finally:
+            with self._lock:
+                self._pending_rows -= rows
+
+    def _run(self):
+        while True:
+            if self._window_started is None:
+                timeout = 1.0
+            else:
+                timeout = max(0.0, self.digest_window - (time.monotonic() - self._window_started))
+            self._drain(timeout if not self._closed.is_set() else 0.0)
+
+            if self._pending:
+                window_over = time.monotonic() - self._window_started >= self.digest_window
+                if self._closed.is_set() or (window_over and self._take_token()):
+                    self._send_digest()
+                elif window_over:
+                    # Limite atteinte : le digest continue d'accumuler jusqu'au prochain jeton
+                    time.sleep(min(1.0, 1 / self._refill_per_second if self._refill_per_second else 1.0))
+            else:
+                self.session.close_if_idle()
+                if self._closed.is_set():
+                    break
+        self.session.close()
+
+    def close(self, timeout=None):
+        """Envoie le digest en cours (sans attendre la fin de la fenêtre) puis ferme la session SMTP."""
+        with self._lock:
+            self._closed.set()
+        self._thread.join(timeout)
+        logging.info(f"✅ Alertes de fraude arrêtées : {self.stats()}")